@@ -1,13 +1,38 @@
 from werkzeug.exceptions import MethodNotAllowed
+from werkzeug.middleware.proxy_fix import ProxyFix
 import json
+import logging
+import logging.handlers
+import math
 import os
+import queue
+import sys
 import time
 import traceback
 import re
-from flask import Flask, jsonify, request, make_response
+import random
+import asyncio
+import atexit
+import bisect
+import gzip
+import hashlib
+import socket
+import sqlite3
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from flask import Flask, Response, g, has_request_context, jsonify, request, make_response, stream_with_context
 from flask_cors import CORS
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout, as_completed, wait,
+)
+from functools import lru_cache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # ---------------------------
 # 🔧 AI client setup
@@ -19,6 +44,26 @@ except Exception:
     genai = None
     ResourceExhausted = Exception  # fallback
 
+try:
+    import numpy as np
+except ImportError:  # NumPy là tùy chọn: chỉ dùng để tăng tốc lọc câu gần trùng
+    np = None
+
+try:
+    import brotli
+except ImportError:  # Brotli là tùy chọn: không có thì chỉ nén gzip
+    brotli = None
+
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn: không có thì dùng json chuẩn
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # MessagePack là tùy chọn: không có thì chỉ trả JSON
+    msgpack = None
+
 # ---------------------------
 # ⚙️ Load environment
 # ---------------------------
@@ -29,21 +74,702 @@ CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 
 app.config["JSON_SORT_KEYS"] = False
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY") or os.getenv("GOOGLE_API_FALLBACK", "")
+# GEMINI_FAKE=1 -> thay google.generativeai bằng bản giả lập offline (fake_genai.py) để
+# chạy benchmark/load test mà không tốn quota; không cần GOOGLE_API_KEY
+GEMINI_FAKE = os.getenv("GEMINI_FAKE", "0") == "1"
+if GEMINI_FAKE:
+    # fake_genai.py nằm cạnh app.py: import được cả khi chạy từ thư mục khác (gunicorn --chdir, python -m từ gốc repo)
+    if BASE_DIR not in sys.path:
+        sys.path.append(BASE_DIR)
+    import fake_genai as genai
+    ResourceExhausted = genai.ResourceExhausted
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY") or os.getenv("GOOGLE_API_FALLBACK", "") or ("fake" if GEMINI_FAKE else "")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# "grpc" (mặc định của thư viện) hoặc "rest"; đường async chỉ dùng được với gRPC
+GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT", "").strip().lower() or None
 
-if genai and GOOGLE_API_KEY:
-    try:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        app.logger.info(f"✅ Google Generative AI configured (model={GEMINI_MODEL}).")
-    except Exception as e:
-        app.logger.error(f"❌ Failed to configure Gemini API: {e}")
+
+def configure_genai():
+    if genai and GOOGLE_API_KEY:
+        try:
+            genai.configure(api_key=GOOGLE_API_KEY, transport=GEMINI_TRANSPORT)
+            app.logger.info(f"✅ Google Generative AI configured (model={GEMINI_MODEL}, transport={GEMINI_TRANSPORT or 'grpc'}"
+                            + (", offline fake" if GEMINI_FAKE else "") + ").")
+        except Exception as e:
+            app.logger.error(f"❌ Failed to configure Gemini API: {e}")
+
+
+configure_genai()
+
+# ---------------------------
+# 🔑 Chuẩn hóa khóa môn/lớp/chủ đề
+# ---------------------------
+def canonical_text(value):
+    """Chuẩn hóa Unicode (NFC), gộp khoảng trắng và bỏ phân biệt hoa/thường."""
+    return " ".join(unicodedata.normalize("NFC", str(value or "")).split()).casefold()
+
+
+def canonical_grade(grade):
+    """"Lớp 10", " 10 ", 10 -> "10"."""
+    digits = re.search(r"\d+", str(grade or ""))
+    return str(int(digits.group(0))) if digits else canonical_text(grade)
+
+# ---------------------------
+# 🧾 Serialize JSON / MessagePack
+# ---------------------------
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/x-msgpack"
+# Định dạng response theo Accept; JSON là mặc định (và là định dạng duy nhất nếu thiếu msgpack)
+RESPONSE_FORMATS = [JSON_MIMETYPE] + ([MSGPACK_MIMETYPE] if msgpack is not None else [])
+
+
+def dumps_json(obj):
+    """JSON UTF-8 gọn (bytes, không escape tiếng Việt); dùng orjson nếu có."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # kiểu orjson không hỗ trợ (vd. khóa không phải str) -> json chuẩn
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads_json(data):
+    """Parse JSON từ bytes hoặc str (orjson đọc thẳng bytes, không cần decode); lỗi -> ValueError."""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def dumps_msgpack(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def loads_msgpack(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify/get_json qua orjson khi có; UTF-8 thay vì \\uXXXX (mỗi ký tự có dấu tốn 6 byte)."""
+
+    ensure_ascii = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.get("indent") is not None:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        try:
+            return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode("utf-8")
+        except TypeError:
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+app.json = FastJSONProvider(app)
+
+
+def negotiate_format():
+    """Định dạng response client muốn theo Accept (mặc định JSON)."""
+    return request.accept_mimetypes.best_match(RESPONSE_FORMATS, default=JSON_MIMETYPE)
+
+# ---------------------------
+# 💾 Cache đề thi (LRU + TTL, thread-safe)
+# ---------------------------
+class EncodedQuiz:
+    """
+    Một đề đã được serialize sẵn: body JSON UTF-8, ETag theo hash nội dung (giống
+    nhau giữa các worker) và các bản MessagePack / nén gzip/brotli, mỗi bản chỉ
+    tạo một lần ở lần đầu có client yêu cầu.
+    """
+
+    __slots__ = ("data", "body", "etag", "_encoded")
+
+    def __init__(self, data):
+        self.data = data
+        self.body = dumps_json(data)
+        self.etag = hashlib.blake2b(self.body, digest_size=12).hexdigest()
+        self._encoded = {(JSON_MIMETYPE, "identity"): self.body}
+
+    def etag_for(self, mimetype=JSON_MIMETYPE):
+        # Cùng nội dung nhưng khác định dạng là hai representation: ETag phải khác nhau
+        return self.etag if mimetype == JSON_MIMETYPE else self.etag + "-mp"
+
+    def encode(self, encoding, mimetype=JSON_MIMETYPE):
+        """
+        Body theo định dạng `mimetype` (JSON | MessagePack) và `encoding`
+        ("identity" | "gzip" | "br"); hai thread cùng tạo lần đầu thì chỉ tốn thêm một lần.
+        """
+        body = self._encoded.get((mimetype, encoding))
+        if body is None:
+            if encoding == "identity":
+                body = dumps_msgpack(self.data)  # bản JSON thô đã có sẵn từ __init__
+            elif encoding == "gzip":
+                body = gzip.compress(self.encode("identity", mimetype), compresslevel=6, mtime=0)
+            else:
+                body = brotli.compress(self.encode("identity", mimetype), quality=5)
+            self._encoded[(mimetype, encoding)] = body
+        return body
+
+
+class QuizCache:
+    """
+    Cache đề trong bộ nhớ, giới hạn theo số mục và dung lượng (byte).
+
+    Loại bỏ mục ít dùng nhất (LRU) khi vượt giới hạn, mục quá TTL được dọn dần
+    mỗi `sweep_interval` giây ngay trong các lần get/set nên không cần thread
+    riêng. Mọi thao tác đều giữ khóa nên an toàn với nhiều thread cùng lúc.
+    """
+
+    def __init__(self, ttl=120, max_entries=256, max_bytes=16 * 1024 * 1024, sweep_interval=30):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._entries = OrderedDict()  # key -> (EncodedQuiz, stored_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(subject, grade, topic, num_mcq, num_tf):
+        """
+        Chuẩn hóa khóa để các yêu cầu gần giống nhau (khoảng trắng, hoa/thường,
+        "Lớp 10"/"10") dùng chung cache. Khóa là tuple (hash nhanh, không cần
+        serialize mỗi request); cache SQLite tự đổi sang chuỗi khi cần.
+        """
+        return (canonical_text(subject), canonical_grade(grade), canonical_text(topic), int(num_mcq), int(num_tf))
+
+    def get(self, key):
+        entry = self.get_encoded(key)
+        return entry.data if entry is not None else None
+
+    def get_encoded(self, key):
+        """Như get nhưng trả về EncodedQuiz (body, ETag, bản nén) của mục."""
+        with self._lock:
+            now = time.monotonic()
+            self._maybe_sweep(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if now - entry[1] >= self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key):
+        """EncodedQuiz của mục (kể cả đã quá TTL) mà không tính hit/miss hay đổi thứ tự LRU."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def set(self, key, data, age=0.0):
+        """
+        Lưu `data` (dict hoặc EncodedQuiz đã serialize sẵn); `age` (giây) cho biết
+        mục đã tồn tại bao lâu ở tầng khác (vd. SQLite).
+        """
+        encoded = data if isinstance(data, EncodedQuiz) else EncodedQuiz(data)
+        # Tính theo body chưa nén; các bản nén (nếu có) nhỏ hơn nhiều
+        size = len(encoded.body)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (encoded, now - age, size)
+            self._bytes += size
+            self._maybe_sweep(now)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                old_key = next(iter(self._entries))
+                self._remove(old_key)
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _maybe_sweep(self, now):
+        # Gọi khi đang giữ khóa
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        expired = [k for k, (_, stored_at, _) in self._entries.items() if now - stored_at >= self.ttl]
+        for k in expired:
+            self._remove(k)
+        self.expirations += len(expired)
+
+# ---------------------------
+# 🗄️ Kho SQLite dùng chung giữa các worker
+# ---------------------------
+class SQLiteStore:
+    """
+    Cơ sở cho các kho SQLite ở chế độ WAL: mỗi thread một kết nối riêng,
+    schema được tạo ở lần kết nối đầu tiên qua `_init_schema`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._init_schema(conn)
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self, conn):
+        pass
+
+    @contextmanager
+    def _transaction(self, immediate=False):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+# ---------------------------
+# 💽 Cache đề thi dùng chung giữa các worker (SQLite, WAL)
+# ---------------------------
+class PersistentQuizCache(SQLiteStore):
+    """
+    Tầng cache L2 nằm sau QuizCache, lưu đề (JSON nén zlib) trong một file
+    SQLite ở chế độ WAL. Mọi worker gunicorn trên cùng máy dùng chung file này
+    và dữ liệu còn nguyên sau khi khởi động lại.
+
+    Mỗi thread dùng một kết nối riêng; lỗi SQLite chỉ được ghi log, không bao
+    giờ làm hỏng request. Các dòng quá TTL được một thread nền xóa định kỳ.
+    """
+
+    def __init__(self, path, ttl=120, prune_interval=300):
+        super().__init__(path)
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._pruner = None
+        self._pruner_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _init_schema(self, conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS quiz_cache ("
+            " cache_key TEXT PRIMARY KEY,"
+            " data BLOB NOT NULL,"
+            " created_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_quiz_cache_created_at ON quiz_cache (created_at)")
+
+    def _connect(self):
+        conn = super()._connect()
+        self._start_pruner()
+        return conn
+
+    @staticmethod
+    def _db_key(key):
+        # Giữ dạng chuỗi JSON của khóa cũ để các dòng đã lưu trước đây vẫn dùng được
+        subject, grade, topic, num_mcq, num_tf = key
+        return json.dumps(
+            {"subject": subject, "grade": grade, "topic": topic, "num_mcq": num_mcq, "num_tf": num_tf},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+
+    def get(self, key):
+        """Trả về (data, age) nếu còn trong TTL, ngược lại None."""
+        try:
+            row = self._connect().execute(
+                "SELECT data, created_at FROM quiz_cache WHERE cache_key = ?", (self._db_key(key),)
+            ).fetchone()
+        except sqlite3.Error as e:
+            self.errors += 1
+            app.logger.warning(f"⚠️ SQLite cache get failed: {e}")
+            return None
+        age = time.time() - row[1] if row else None
+        if row is None or age >= self.ttl:
+            self.misses += 1
+            return None
+        try:
+            data = loads_json(zlib.decompress(row[0]))
+        except (zlib.error, ValueError) as e:
+            self.errors += 1
+            app.logger.warning(f"⚠️ SQLite cache entry corrupt: {e}")
+            return None
+        self.hits += 1
+        return data, age
+
+    def set(self, key, data, body=None):
+        """`body`: JSON UTF-8 đã serialize sẵn của `data` (nếu có) để khỏi serialize lại."""
+        blob = zlib.compress(body if body is not None else dumps_json(data))
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO quiz_cache (cache_key, data, created_at) VALUES (?, ?, ?)",
+                (self._db_key(key), blob, time.time()),
+            )
+        except sqlite3.Error as e:
+            self.errors += 1
+            app.logger.warning(f"⚠️ SQLite cache set failed: {e}")
+
+    def prune(self):
+        try:
+            cur = self._connect().execute(
+                "DELETE FROM quiz_cache WHERE created_at < ?", (time.time() - self.ttl,)
+            )
+            return cur.rowcount
+        except sqlite3.Error as e:
+            self.errors += 1
+            app.logger.warning(f"⚠️ SQLite cache prune failed: {e}")
+            return 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+    def _start_pruner(self):
+        # Khởi động trễ (lần dùng đầu tiên) để thread được tạo sau khi gunicorn fork worker
+        if self._pruner is not None:
+            return
+        with self._pruner_lock:
+            if self._pruner is None:
+                self._pruner = threading.Thread(target=self._prune_loop, name="quiz-cache-pruner", daemon=True)
+                self._pruner.start()
+
+    def _prune_loop(self):
+        while True:
+            time.sleep(self.prune_interval)
+            removed = self.prune()
+            if removed:
+                app.logger.info(f"🧹 Đã xóa {removed} đề hết hạn khỏi cache SQLite.")
 
 # ---------------------------
 # ⚙️ Global state
 # ---------------------------
 executor = ThreadPoolExecutor(max_workers=3)
-quiz_cache = {}
+quiz_cache = QuizCache(
+    ttl=float(os.getenv("QUIZ_CACHE_TTL", 120)),  # ⏱ 2 phút
+    max_entries=int(os.getenv("QUIZ_CACHE_MAX_ENTRIES", 256)),
+    max_bytes=int(os.getenv("QUIZ_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+)
+# Đặt QUIZ_CACHE_DB="" để tắt tầng cache SQLite
+QUIZ_CACHE_DB = os.getenv("QUIZ_CACHE_DB", os.path.join(BASE_DIR, "quiz_cache.db"))
+persistent_cache = PersistentQuizCache(
+    QUIZ_CACHE_DB,
+    ttl=float(os.getenv("QUIZ_CACHE_DB_TTL", quiz_cache.ttl)),
+    prune_interval=float(os.getenv("QUIZ_CACHE_DB_PRUNE_INTERVAL", 300)),
+) if QUIZ_CACHE_DB else None
+
+
+def get_cached_encoded(cache_key):
+    """Tra cache RAM rồi tới cache SQLite (nạp lại vào RAM); trả về EncodedQuiz hoặc None."""
+    entry = quiz_cache.get_encoded(cache_key)
+    if entry is not None:
+        app.logger.info("⚡ Trả đề từ cache RAM (hợp lệ trong TTL).")
+        return entry
+    if persistent_cache is None:
+        return None
+    hit = persistent_cache.get(cache_key)
+    if hit is None:
+        return None
+    data, age = hit
+    quiz_cache.set(cache_key, data, age=age)
+    app.logger.info("💽 Trả đề từ cache SQLite (hợp lệ trong TTL).")
+    return quiz_cache.peek(cache_key) or EncodedQuiz(data)
+
+
+def get_cached_quiz(cache_key):
+    entry = get_cached_encoded(cache_key)
+    return entry.data if entry is not None else None
+
+
+def store_cached_quiz(cache_key, data):
+    # Serialize một lần cho cả hai tầng cache
+    encoded = EncodedQuiz(data)
+    quiz_cache.set(cache_key, encoded)
+    if persistent_cache is not None:
+        persistent_cache.set(cache_key, data, body=encoded.body)
+
+# ---------------------------
+# 📈 Metrics (định dạng text của Prometheus)
+# ---------------------------
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metrics:
+    """
+    Registry metrics tối giản, xuất theo định dạng text của Prometheus.
+
+    inc/observe chỉ giữ khóa trong một lần cộng vào dict. Các số đếm đã có sẵn ở
+    chỗ khác (cache, single-flight, executor...) được đọc qua `collector` lúc
+    scrape nên không tốn gì trên đường phục vụ request.
+
+    Nhiều worker gunicorn: đặt `directory` (METRICS_DIR) là một thư mục dùng chung.
+    Mỗi process ghi snapshot ra <directory>/<pid>.json mỗi `flush_interval` giây,
+    và /metrics của worker nào cũng cộng snapshot của mọi worker. Counter và
+    histogram của worker đã tắt vẫn được cộng để tổng không bị giảm; gauge chỉ
+    tính các snapshot còn mới (worker còn sống).
+    """
+
+    def __init__(self, directory="", flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._types = {}  # tên -> (loại, mô tả)
+        self._buckets = {}  # tên histogram -> các mốc (giây)
+        self._values = {}  # (tên, labels) -> giá trị counter
+        self._histograms = {}  # (tên, labels) -> [số mẫu theo từng mốc..., +Inf, tổng]
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def counter(self, name, help_text):
+        self._types[name] = ("counter", help_text)
+
+    def gauge(self, name, help_text):
+        self._types[name] = ("gauge", help_text)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._types[name] = ("histogram", help_text)
+        self._buckets[name] = tuple(buckets)
+
+    def collector(self, fn):
+        """`fn()` trả về các (tên, {labels}, giá trị) của counter/gauge đã khai báo; gọi lúc scrape."""
+        self._collectors.append(fn)
+        return fn
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self._buckets[name], value)
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = [0] * (len(self._buckets[name]) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """Giá trị của process này: {"counters": [...], "gauges": [...], "histograms": [...]} (dạng JSON được)."""
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self._values.items()]
+            histograms = [[name, list(labels), list(counts)] for (name, labels), counts in self._histograms.items()]
+        gauges = []
+        for fn in self._collectors:
+            try:
+                samples = list(fn())
+            except Exception as e:
+                app.logger.warning(f"⚠️ Metrics collector failed: {e}")
+                continue
+            for name, labels, value in samples:
+                target = gauges if self._types[name][0] == "gauge" else counters
+                target.append([name, sorted(labels.items()), value])
+        return {"pid": os.getpid(), "time": time.time(), "counters": counters, "gauges": gauges, "histograms": histograms}
+
+    # --- Nhiều process ---
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def flush(self):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self._path(os.getpid()) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f, ensure_ascii=False)
+            os.replace(tmp, self._path(os.getpid()))
+        except OSError as e:
+            app.logger.warning(f"⚠️ Metrics flush failed: {e}")
+
+    def start_flusher(self):
+        if not self.directory:
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _snapshots(self):
+        own = self.snapshot()
+        if not self.directory:
+            return [own]
+        snapshots = [own]
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        stale_after = max(3 * self.flush_interval, 30)
+        for file_name in names:
+            if not file_name.endswith(".json") or file_name == f"{own['pid']}.json":
+                continue
+            try:
+                with open(os.path.join(self.directory, file_name), encoding="utf-8") as f:
+                    other = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if own["time"] - other.get("time", 0) > stale_after:
+                other["gauges"] = []  # worker đã tắt: bỏ gauge, giữ counter/histogram
+            snapshots.append(other)
+        return snapshots
+
+    # --- Xuất ---
+    def render(self):
+        """Văn bản theo định dạng exposition 0.0.4 của Prometheus, đã cộng mọi worker."""
+        scalars = {}
+        histograms = {}
+        for snap in self._snapshots():
+            for name, labels, value in snap["counters"] + snap["gauges"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                scalars[key] = scalars.get(key, 0) + value
+            for name, labels, counts in snap["histograms"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                merged = histograms.get(key)
+                if merged is None:
+                    histograms[key] = list(counts)
+                elif len(merged) == len(counts):
+                    histograms[key] = [a + b for a, b in zip(merged, counts)]
+
+        lines = []
+        for name, (kind, help_text) in self._types.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                bounds = self._buckets[name]
+                for (hname, labels), counts in sorted(histograms.items()):
+                    if hname != name or len(counts) != len(bounds) + 2:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(bounds + ("+Inf",), counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {round(counts[-1], 6)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+            else:
+                for (sname, labels), value in sorted(scalars.items()):
+                    if sname == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# METRICS_DIR: thư mục dùng chung giữa các worker gunicorn để /metrics cộng số liệu mọi worker
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+metrics = Metrics(METRICS_DIR, flush_interval=float(os.getenv("METRICS_FLUSH_INTERVAL", 5)))
+metrics.histogram("quiz_request_duration_seconds", "Thời gian xử lý yêu cầu sinh đề, theo endpoint và nguồn đề.")
+metrics.histogram("model_request_duration_seconds", "Thời gian một lần gọi model, theo model và kết quả.")
+metrics.counter("model_requests_total", "Số lần gọi model, theo model và kết quả (ok, quota, error).")
+metrics.counter("quiz_cache_hits_total", "Số lần tra cache trúng, theo tầng (memory, sqlite).")
+metrics.counter("quiz_cache_misses_total", "Số lần tra cache trượt, theo tầng (memory, sqlite).")
+metrics.counter("quiz_cache_evictions_total", "Số đề bị loại khỏi cache RAM, theo lý do (capacity, expired).")
+metrics.gauge("quiz_cache_entries", "Số đề đang có trong cache RAM.")
+metrics.gauge("quiz_cache_bytes", "Dung lượng ước lượng của cache RAM (byte).")
+metrics.counter("quiz_chunks_total", "Số chunk sinh câu hỏi, theo kết quả (ok, empty, failed, timeout).")
+metrics.counter("quiz_parse_failures_total", "Lỗi khi tách output của model: dropped (object hỏng bị bỏ), no_questions (không tách được câu nào).")
+metrics.counter("quiz_parse_repairs_total", "Số object câu hỏi phải sửa JSON mới đọc được.")
+metrics.counter("quiz_topup_rounds_total", "Số vòng sinh bổ sung câu hỏi còn thiếu, theo dạng câu còn thiếu.")
+metrics.counter("quiz_partial_total", "Số đề trả về thiếu câu vì hết hạn hoặc model lỗi.")
+metrics.counter("quiz_near_duplicates_total", "Số câu gần trùng bị bỏ khỏi đề.")
+metrics.counter("quiz_single_flight_total", "Số yêu cầu sinh đề theo vai trò single-flight (leader, coalesced).")
+metrics.counter("model_hedges_total", "Số vòng gọi model có hedging: rounds, fired (đã gửi lời gọi dự phòng), won (lời gọi dự phòng về trước).")
+metrics.histogram("quiz_hedges_per_request", "Số hedge đã gửi cho mỗi đề phải gọi model (tối đa HEDGE_BUDGET).", buckets=(0, 1, 2, 3, 5, 8))
+metrics.gauge("executor_queue_depth", "Số việc đang chờ trong ThreadPoolExecutor.")
+metrics.gauge("executor_active_workers", "Số thread của ThreadPoolExecutor đang chạy việc.")
+metrics.gauge("executor_max_workers", "Số thread tối đa của ThreadPoolExecutor.")
+metrics.gauge("generation_loop_in_flight", "Số lời gọi sinh nội dung đang chạy trên event loop dùng chung (ASYNC_GENERATION).")
+
+
+@metrics.collector
+def _cache_metrics():
+    stats = quiz_cache.stats()
+    yield "quiz_cache_hits_total", {"layer": "memory"}, stats["hits"]
+    yield "quiz_cache_misses_total", {"layer": "memory"}, stats["misses"]
+    yield "quiz_cache_evictions_total", {"reason": "capacity"}, stats["evictions"]
+    yield "quiz_cache_evictions_total", {"reason": "expired"}, stats["expirations"]
+    yield "quiz_cache_entries", {}, stats["entries"]
+    yield "quiz_cache_bytes", {}, stats["bytes"]
+    if persistent_cache is not None:
+        stats = persistent_cache.stats()
+        yield "quiz_cache_hits_total", {"layer": "sqlite"}, stats["hits"]
+        yield "quiz_cache_misses_total", {"layer": "sqlite"}, stats["misses"]
+
+
+@metrics.collector
+def _generation_metrics():
+    stats = quiz_inflight.stats()
+    yield "quiz_single_flight_total", {"role": "leader"}, stats["leaders"]
+    yield "quiz_single_flight_total", {"role": "coalesced"}, stats["coalesced"]
+    hedges = hedge_stats.snapshot()
+    for event in ("rounds", "fired", "won"):
+        yield "model_hedges_total", {"event": event}, hedges[event]
+
+
+@metrics.collector
+def _executor_metrics():
+    # ThreadPoolExecutor không công bố số thread bận: suy ra từ số thread đã tạo trừ số thread rảnh
+    threads = len(getattr(executor, "_threads", ()))
+    idle = getattr(getattr(executor, "_idle_semaphore", None), "_value", 0)
+    yield "executor_queue_depth", {}, executor._work_queue.qsize()
+    yield "executor_active_workers", {}, max(0, threads - idle)
+    yield "executor_max_workers", {}, executor._max_workers
+    # Đường mặc định (ASYNC_GENERATION) không dùng executor: đếm lời gọi đang chạy trên event loop
+    yield "generation_loop_in_flight", {}, generation_loop.in_flight
+
+
+metrics.start_flusher()
 
 # ---------------------------
 # 🔁 Danh sách model fallback (2.x trở lên)
@@ -60,20 +786,285 @@ MODELS_TO_TRY = [
 ]
 
 # ---------------------------
-# Middleware: log request for debugging
+# 🚦 Điều phối model theo tình trạng (circuit breaker)
+# ---------------------------
+def _is_text_model(model_name):
+    # ❌ Không dùng model 1.5 nữa; model audio/TTS/ảnh không trả được JSON dạng text
+    name = model_name.lower()
+    return "1.5" not in name and not any(tag in name for tag in ("audio", "tts", "image"))
+
+
+class ModelHealth:
+    """Tình trạng gần đây của một model: kết quả, độ trễ và trạng thái breaker."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window=50):
+        self.outcomes = deque(maxlen=window)  # "ok" | "error" | "quota"
+        self.latencies = deque(maxlen=window)  # giây, chỉ các lần thành công
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.cooldown = 0.0
+        self.probe_in_flight = False
+
+    def rate(self, outcome):
+        return self.outcomes.count(outcome) / len(self.outcomes) if self.outcomes else 0.0
+
+    def latency(self, quantile=0.5):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+class ModelRouter:
+    """
+    Chọn thứ tự thử model dựa trên tình trạng dùng chung giữa mọi request trong process.
+
+    Mỗi model có một circuit breaker: hết quota mở breaker ngay, lỗi liên tiếp
+    `failure_threshold` lần cũng mở breaker. Khi hết thời gian chờ, breaker
+    chuyển sang half-open và chỉ cho một request thử lại; thành công thì đóng,
+    thất bại thì mở lại với thời gian chờ gấp đôi (tối đa `max_cooldown`).
+    Các model còn dùng được xếp theo xác suất thành công / độ trễ trung vị.
+    """
+
+    def __init__(self, models, failure_threshold=3, error_cooldown=30.0, quota_cooldown=60.0,
+                 max_cooldown=600.0, default_latency=5.0):
+        self.models = [m for m in dict.fromkeys(models) if _is_text_model(m)]
+        self.failure_threshold = failure_threshold
+        self.error_cooldown = error_cooldown
+        self.quota_cooldown = quota_cooldown
+        self.max_cooldown = max_cooldown
+        self.default_latency = default_latency
+        self._health = {m: ModelHealth() for m in self.models}
+        self._lock = threading.Lock()
+
+    def _refresh(self, health, now):
+        if health.state == ModelHealth.OPEN and now >= health.open_until:
+            health.state = ModelHealth.HALF_OPEN
+            health.probe_in_flight = False
+
+    def _score(self, health):
+        # Ước lượng Laplace để model chưa có dữ liệu không bị loại hẳn
+        p_success = (health.outcomes.count("ok") + 1) / (len(health.outcomes) + 2)
+        return p_success / (health.latency() or self.default_latency)
+
+    def candidates(self):
+        """Các model nên thử, theo thứ tự ưu tiên; bỏ qua model đang mở breaker."""
+        now = time.monotonic()
+        with self._lock:
+            usable = []
+            for index, name in enumerate(self.models):
+                health = self._health[name]
+                self._refresh(health, now)
+                if health.state == ModelHealth.OPEN:
+                    continue
+                if health.state == ModelHealth.HALF_OPEN and health.probe_in_flight:
+                    continue
+                usable.append((-self._score(health), index, name))
+        return [name for _, _, name in sorted(usable)]
+
+    def acquire(self, name):
+        """Gọi ngay trước khi thử model; False nếu breaker mở hoặc đã có request khác đang thử half-open."""
+        now = time.monotonic()
+        with self._lock:
+            health = self._health.get(name)
+            if health is None:
+                return False
+            self._refresh(health, now)
+            if health.state == ModelHealth.OPEN:
+                return False
+            if health.state == ModelHealth.HALF_OPEN:
+                if health.probe_in_flight:
+                    return False
+                health.probe_in_flight = True
+            return True
+
+    def release(self, name):
+        """Trả lại lượt thử half-open khi lời gọi bị hủy giữa chừng (không tính là thành công hay thất bại)."""
+        with self._lock:
+            self._health[name].probe_in_flight = False
+
+    def record_success(self, name, latency):
+        with self._lock:
+            health = self._health[name]
+            health.outcomes.append("ok")
+            health.latencies.append(latency)
+            health.consecutive_failures = 0
+            health.state = ModelHealth.CLOSED
+            health.cooldown = 0.0
+            health.probe_in_flight = False
+        metrics.inc("model_requests_total", model=name, outcome="ok")
+        metrics.observe("model_request_duration_seconds", latency, model=name, outcome="ok")
+
+    def record_failure(self, name, quota=False, retry_after=None, latency=None):
+        """`retry_after`: số giây server gợi ý chờ khi hết quota, thay cho quota_cooldown nếu có."""
+        outcome = "quota" if quota else "error"
+        metrics.inc("model_requests_total", model=name, outcome=outcome)
+        if latency is not None:
+            metrics.observe("model_request_duration_seconds", latency, model=name, outcome=outcome)
+        with self._lock:
+            health = self._health[name]
+            health.outcomes.append("quota" if quota else "error")
+            health.consecutive_failures += 1
+            health.probe_in_flight = False
+            if quota or health.state == ModelHealth.HALF_OPEN or health.consecutive_failures >= self.failure_threshold:
+                if quota and retry_after:
+                    health.cooldown = min(self.max_cooldown, retry_after)
+                else:
+                    base = self.quota_cooldown if quota else self.error_cooldown
+                    health.cooldown = min(self.max_cooldown, max(base, health.cooldown * 2))
+                health.state = ModelHealth.OPEN
+                health.open_until = time.monotonic() + health.cooldown
+
+    def latency_quantile(self, name, quantile):
+        with self._lock:
+            health = self._health.get(name)
+            return health.latency(quantile) if health else None
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for name in self.models:
+                health = self._health[name]
+                self._refresh(health, now)
+                p50, p90 = health.latency(0.5), health.latency(0.9)
+                result[name] = {
+                    "state": health.state,
+                    "calls": len(health.outcomes),
+                    "success_rate": round(health.rate("ok"), 3),
+                    "error_rate": round(health.rate("error"), 3),
+                    "quota_rate": round(health.rate("quota"), 3),
+                    "latency_p50_ms": round(p50 * 1000) if p50 is not None else None,
+                    "latency_p90_ms": round(p90 * 1000) if p90 is not None else None,
+                    "open_for_s": round(max(0.0, health.open_until - now), 1) if health.state == ModelHealth.OPEN else 0,
+                }
+            return result
+
+
+model_router = ModelRouter(
+    MODELS_TO_TRY,
+    failure_threshold=int(os.getenv("MODEL_FAILURE_THRESHOLD", 3)),
+    error_cooldown=float(os.getenv("MODEL_ERROR_COOLDOWN", 30)),
+    quota_cooldown=float(os.getenv("MODEL_QUOTA_COOLDOWN", 60)),
+)
+
+# ---------------------------
+# 📝 Access log có cấu trúc (JSON, lấy mẫu, ghi ở thread nền)
 # ---------------------------
+# Mỗi request được log một dòng JSON khi response đã gửi xong (kể cả stream). Thread
+# xử lý request chỉ dựng dict và bỏ vào hàng đợi; json.dumps và ghi ra stdout do
+# thread của QueueListener làm. Hàng đợi đầy thì bỏ bản ghi (đếm ở metrics) thay vì chặn.
+ACCESS_LOG = os.getenv("ACCESS_LOG", "1") == "1"
+# Tỉ lệ request bình thường được log; request lỗi (>= 500) hoặc chậm luôn được log
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", 1.0))
+ACCESS_LOG_SLOW_MS = float(os.getenv("ACCESS_LOG_SLOW_MS", 5000))
+# Route không log (health check, keep-alive, scrape metrics); preflight OPTIONS cũng bỏ qua
+ACCESS_LOG_EXCLUDE = {p.strip() for p in os.getenv("ACCESS_LOG_EXCLUDE", "/ping,/healthz,/metrics").split(",") if p.strip()}
+ACCESS_LOG_OPTIONS = os.getenv("ACCESS_LOG_OPTIONS", "0") == "1"
+# Header được ghi kèm (không phân biệt hoa thường); header nhạy cảm luôn bị che
+ACCESS_LOG_HEADERS = [h.strip() for h in os.getenv("ACCESS_LOG_HEADERS", "User-Agent,X-Request-Timeout").split(",") if h.strip()]
+REDACTED_HEADERS = {"authorization", "proxy-authorization", "cookie", "set-cookie", "x-api-key", "x-goog-api-key"}
+ACCESS_LOG_QUEUE_SIZE = int(os.getenv("ACCESS_LOG_QUEUE_SIZE", 10000))
+
+metrics.counter("access_log_dropped_total", "Số bản ghi access log bị bỏ vì hàng đợi đầy.")
+
+
+class _JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, ensure_ascii=False, default=str)
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # record.msg là dict dựng xong ở request thread: để nguyên, định dạng ở thread nền
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("access_log_dropped_total")
+
+
+access_logger = logging.getLogger("chiron26.access")
+access_logger.setLevel(logging.INFO)
+access_logger.propagate = False
+_access_handler = _NonBlockingQueueHandler(queue.Queue(maxsize=ACCESS_LOG_QUEUE_SIZE))
+access_logger.addHandler(_access_handler)
+_access_output = logging.StreamHandler(sys.stdout)
+_access_output.setFormatter(_JsonLineFormatter())
+access_listener = None
+
+
+def start_access_log():
+    global access_listener
+    if not ACCESS_LOG:
+        return
+    # Hàng đợi mới mỗi lần (kể cả sau fork): khóa của hàng đợi cũ có thể đang bị giữ lúc fork
+    _access_handler.queue = queue.Queue(maxsize=ACCESS_LOG_QUEUE_SIZE)
+    access_listener = logging.handlers.QueueListener(_access_handler.queue, _access_output)
+    access_listener.start()
+
+
+def stop_access_log():
+    # Ghi nốt các bản ghi còn trong hàng đợi khi tắt process
+    if access_listener is not None and access_listener._thread is not None:
+        access_listener.stop()
+
+
+def redact_headers(headers):
+    return {
+        name: "[REDACTED]" if name.lower() in REDACTED_HEADERS else value
+        for name, value in ((name, headers.get(name)) for name in ACCESS_LOG_HEADERS)
+        if value is not None
+    }
+
+
+def annotate_access_log(**fields):
+    """Thêm trường vào dòng access log của request hiện tại (vd. thông số đề)."""
+    if has_request_context():
+        g.setdefault("access_log_fields", {}).update(fields)
+
+
 @app.before_request
-def log_request_info():
-    try:
-        app.logger.info("----- Incoming Request -----")
-        app.logger.info(f"Remote Addr: {request.remote_addr}")
-        app.logger.info(f"Method: {request.method} URL: {request.url}")
-        headers = {k: v for k, v in request.headers.items()}
-        app.logger.info(f"Headers: {headers}")
-        # Avoid logging huge bodies but log content-type and length
-        app.logger.info(f"Content-Type: {request.content_type} Content-Length: {request.content_length}")
-    except Exception as e:
-        app.logger.warning(f"Failed to log request info: {e}")
+def begin_access_log():
+    if not ACCESS_LOG or request.path in ACCESS_LOG_EXCLUDE or (request.method == "OPTIONS" and not ACCESS_LOG_OPTIONS):
+        return
+    g.access_log_started = time.monotonic()
+    g.access_log_sampled = ACCESS_LOG_SAMPLE_RATE >= 1 or random.random() < ACCESS_LOG_SAMPLE_RATE
+
+
+@app.after_request
+def finish_access_log(response):
+    started = g.get("access_log_started")
+    if started is None:
+        return response
+    record = {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "method": request.method,
+        "path": request.path,
+        "route": request.url_rule.rule if request.url_rule else None,
+        "status": response.status_code,
+        "remote": request.remote_addr,
+        "request_bytes": request.content_length,
+        "response_bytes": response.content_length,
+        "source": response.headers.get("X-Quiz-Source"),
+        "headers": redact_headers(request.headers),
+        **g.get("access_log_fields", {}),
+    }
+    sampled = g.access_log_sampled
+
+    def emit():
+        # Gọi khi response đã gửi xong: duration_ms gồm cả thời gian stream
+        record["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+        if sampled or record["status"] >= 500 or record["duration_ms"] >= ACCESS_LOG_SLOW_MS:
+            access_logger.info(record)
+
+    response.call_on_close(emit)
+    return response
 
 # Ensure preflight requests (OPTIONS) return 200 quickly
 @app.route("/", methods=["OPTIONS"])
@@ -88,8 +1079,11 @@ def handle_options(anypath=None):
 def add_cors_headers(response):
     response.headers.setdefault("Access-Control-Allow-Origin", "*")
     response.headers.setdefault("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-    response.headers.setdefault("Access-Control-Allow-Headers", "Content-Type, Authorization, X-Requested-With, Accept")
-    response.headers.setdefault("Access-Control-Expose-Headers", "Content-Type, Authorization")
+    response.headers.setdefault("Access-Control-Allow-Headers",
+                                "Content-Type, Authorization, X-Requested-With, Accept, If-None-Match")
+    # ETag để trình duyệt gửi lại If-None-Match; X-Quiz-Source / Retry-After cho client hiển thị
+    response.headers.setdefault("Access-Control-Expose-Headers",
+                                "Content-Type, Authorization, ETag, X-Quiz-Source, Retry-After")
     return response
 
 # Health check route
@@ -100,343 +1094,2995 @@ def healthz():
 # ---------------------------
 # 🧠 Sinh nội dung từ AI
 # ---------------------------
-def generate_text(prompt, retries=2):
-    if genai is None:
-        raise RuntimeError("Google generative AI client not available.")
+GENERATION_CONFIG = {
+    "temperature": 0.3,
+    "top_p": 0.8,
+    "max_output_tokens": 1600,
+    "response_mime_type": "application/json",
+}
 
-    generation_config = {
-        "temperature": 0.3,
-        "top_p": 0.8,
-        "max_output_tokens": 1600,
-        "response_mime_type": "application/json",
-    }
 
-    for attempt in range(retries):
-        for model_name in MODELS_TO_TRY:
-            if "1.5" in model_name:
-                continue  # ❌ Không dùng model 1.5 nữa
+def _response_text(response):
+    text = ""
+    if response and hasattr(response, "candidates") and response.candidates:
+        parts = getattr(response.candidates[0].content, "parts", [])
+        text = "".join(getattr(p, "text", "") for p in parts)
+    return text.strip()
 
-            try:
-                app.logger.info(f"🔍 Trying model: {model_name}")
-                model = genai.GenerativeModel(model_name)
-                response = model.generate_content(prompt, generation_config=generation_config)
 
-                text = ""
-                if response and hasattr(response, "candidates") and response.candidates:
-                    parts = getattr(response.candidates[0].content, "parts", [])
-                    text = "".join(getattr(p, "text", "") for p in parts)
+# ---------------------------
+# ⏳ Deadline của request & backoff giữa các lần thử
+# ---------------------------
+class DeadlineExceeded(TimeoutError):
+    """Hết thời gian của request trước khi có câu hỏi nào."""
 
-                if text.strip():
-                    return text.strip()
 
-            except ResourceExhausted:
-                app.logger.warning(f"⚠️ Model {model_name} quota exhausted.")
-                continue
-            except Exception as e:
-                app.logger.warning(f"⚠️ Model {model_name} failed: {e}")
-                continue
+class Deadline:
+    """
+    Mốc hết hạn (theo time.monotonic) của một request, được truyền xuống mọi bước:
+    chờ chunk, timeout của từng lần gọi model, thời gian nghỉ giữa các lần thử và
+    các vòng sinh bổ sung. Việc không thể xong trước mốc này thì bỏ luôn.
+    """
 
-        time.sleep(0.6)
+    def __init__(self, seconds):
+        self.at = time.monotonic() + seconds
 
-    raise Exception("❌ All models failed or returned invalid data.")
+    def remaining(self):
+        return max(0.0, self.at - time.monotonic())
 
-# ---------------------------
-# 🔍 Parse JSON an toàn
-# ---------------------------
-def safe_parse_json(text):
-    def try_load(s):
-        try:
-            return json.loads(s)
-        except Exception:
-            return None
+    def expired(self):
+        return time.monotonic() >= self.at
 
-    if not text:
-        return None
+    def cap(self, seconds):
+        return min(seconds, self.remaining())
 
-    try:
-        json_match = re.search(r'\{[\s\S]*\}', text)
-        if not json_match:
-            raise ValueError("No JSON object found.")
-        clean_text = json_match.group(0).strip()
-
-        parsed = try_load(clean_text)
-        if parsed:
-            return parsed
-
-        fix_text = (
-            clean_text.replace("\n", " ")
-            .replace("\r", "")
-            .replace(", }", "}")
-            .replace(",]", "]")
-            .replace("’", "'")
-            .replace("“", '"')
-            .replace("”", '"')
-            .replace("'", '"')
-        )
+    def within(self, seconds):
+        """Deadline con hết hạn sau `seconds` giây nhưng không muộn hơn deadline này."""
+        return Deadline(self.cap(seconds))
 
-        parsed = try_load(fix_text)
-        if parsed:
-            return parsed
 
-        first, last = fix_text.find("{"), fix_text.rfind("}")
-        if first != -1 and last != -1:
-            parsed = try_load(fix_text[first:last + 1])
-            if parsed:
-                return parsed
+MODEL_CALL_TIMEOUT = float(os.getenv("MODEL_CALL_TIMEOUT", 60))  # giây tối đa cho một lần gọi model
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", 0.5))
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", 8))
+_RETRY_IN_RE = re.compile(r"retry in ([0-9.]+)\s*s", re.IGNORECASE)
 
-        raise ValueError("Could not parse cleaned JSON.")
-    except Exception as e:
-        app.logger.warning(f"⚠️ JSON parse thất bại: {e}")
-        return None
 
-# ---------------------------
-# 🔢 Chuẩn hóa ký hiệu
-# ---------------------------
-def normalize_math_symbols(text: str) -> str:
-    """
-    Chuẩn hóa một chuỗi văn bản chứa các ký hiệu và công thức toán học,
-    hóa học và vật lý về định dạng Unicode đẹp mắt.
+def call_timeout(deadline):
+    return MODEL_CALL_TIMEOUT if deadline is None else deadline.cap(MODEL_CALL_TIMEOUT)
 
-    Args:
-        text: Chuỗi văn bản đầu vào.
 
-    Returns:
-        Chuỗi văn bản đã được chuẩn hóa.
+def retry_after_hint(error):
+    """Số giây server đề nghị chờ (RetryInfo của lỗi gRPC hoặc "Please retry in 12.3s"); None nếu không có."""
+    for detail in getattr(error, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and (delay.seconds or delay.nanos):
+            return delay.seconds + delay.nanos / 1e9
+    m = _RETRY_IN_RE.search(str(error))
+    return float(m.group(1)) if m else None
+
+
+def backoff_delay(attempt, retry_after=None):
     """
-    if not text or not isinstance(text, str):
-        return text
+    Thời gian nghỉ trước lần thử thứ `attempt + 1`: full jitter trong
+    [0, RETRY_BACKOFF_BASE·2^attempt] (tối đa RETRY_BACKOFF_MAX); nếu server có
+    gợi ý retry-after thì chờ đúng gợi ý đó cộng thêm một chút jitter.
+    """
+    if retry_after:
+        return retry_after + random.uniform(0, RETRY_BACKOFF_BASE)
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
 
-    # --- 1. Từ điển chuyển đổi (Giữ nguyên như cũ) ---
-    latex_unicode_map = {
-        r'\\alpha': 'α', r'\\beta': 'β', r'\\gamma': 'γ', r'\\delta': 'δ', r'\\epsilon': 'ε',
-        r'\\zeta': 'ζ', r'\\eta': 'η', r'\\theta': 'θ', r'\\iota': 'ι', r'\\kappa': 'κ',
-        r'\\lambda': 'λ', r'\\mu': 'μ', r'\\nu': 'ν', r'\\xi': 'ξ', r'\\omicron': 'ο',
-        r'\\pi': 'π', r'\\rho': 'ρ', r'\\sigma': 'σ', r'\\tau': 'τ', r'\\upsilon': 'υ',
-        r'\\phi': 'φ', r'\\chi': 'χ', r'\\psi': 'ψ', r'\\omega': 'ω',
-        r'\\Gamma': 'Γ', r'\\Delta': 'Δ', r'\\Theta': 'Θ', r'\\Lambda': 'Λ', r'\\Xi': 'Ξ',
-        r'\\Pi': 'Π', r'\\Sigma': 'Σ', r'\\Upsilon': 'Υ', r'\\Phi': 'Φ', r'\\Psi': 'Ψ',
-        r'\\Omega': 'Ω',
-        r'\\pm': '±', r'\\times': '×', r'\\div': '÷', r'\\cdot': '⋅', r'\\neq': '≠',
-        r'\\leq': '≤', r'\\geq': '≥', r'\\approx': '≈', r'\\equiv': '≡', r'\\in': '∈',
-        r'\\notin': '∉', r'\\subset': '⊂', r'\\supset': '⊃', r'\\subseteq': '⊆',
-        r'\\supseteq': '⊇', r'\\sum': '∑', r'\\int': '∫', r'\\partial': '∂',
-        r'\\nabla': '∇', r'\\infty': '∞', r'\\forall': '∀', r'\\exists': '∃',
-        r'\\angle': '∠', r'\\perp': '⊥',
-        r'\\rightarrow': '→', r'\\leftarrow': '←', r'\\leftrightarrow': '↔',
-        r'\\Rightarrow': '⇒', r'\\Leftarrow': '⇐', r'\\Leftrightarrow': '⇔',
-        r'\\uparrow': '↑', r'\\downarrow': '↓',
-        r'\\ldots': '…', r'\\cdots': '⋯', r'\\vdots': '⋮', r'\\ddots': '⋱',
-        r'\\circ': '°',
-    }
-    keyword_map = {
-        r'sqrt': '√', 'inf': '∞',
-    }
-    operator_map = {
-        '>=': '≥', '<=': '≤', '!=': '≠', '->': '→', '<-': '←', '<=>': '⇔'
-    }
-    superscript_map = str.maketrans("0123456789+-=()n", "⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ⁿ")
-    subscript_map = str.maketrans("0123456789+-=()aehijklmnoprstuvx", "₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎ₐₑₕᵢⱼₖₗₘₙₒₚᵣₛₜᵤᵥₓ")
 
-    # --- 2. Thực hiện chuyển đổi ---
+def _next_delay(attempt, retries, hints, deadline):
+    """
+    Thời gian nghỉ trước lượt thử kế tiếp, hoặc None nếu nên dừng (hết lượt, hoặc
+    nghỉ xong thì đã quá deadline). Chỉ chờ theo retry-after khi mọi lần thất bại
+    của lượt vừa rồi đều là hết quota kèm gợi ý.
+    """
+    if attempt + 1 >= retries:
+        return None
+    retry_after = min(hints) if hints and None not in hints else None
+    delay = backoff_delay(attempt, retry_after)
+    if deadline is not None and delay >= deadline.remaining():
+        return None
+    return delay
+
+
+def _backoff_or_stop(attempt, retries, hints, deadline):
+    delay = _next_delay(attempt, retries, hints, deadline)
+    if delay is None:
+        return False
+    time.sleep(delay)
+    return True
+
+
+# ---------------------------
+# 🔌 Pool model Gemini dùng chung
+# ---------------------------
+class ModelPool:
+    """
+    Mỗi model một GenerativeModel dựng sẵn (đã gắn GENERATION_CONFIG), dựng một
+    lần khi cần và dùng chung giữa mọi thread. Client gRPC/REST bên dưới được genai
+    cache theo process nên mọi handle cùng đi qua một channel đã mở sẵn.
+    """
+
+    def __init__(self, generation_config):
+        self.generation_config = generation_config
+        self.last_used = 0.0
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name):
+        self.last_used = time.monotonic()
+        model = self._models.get(model_name)
+        if model is None:
+            with self._lock:
+                model = self._models.get(model_name)
+                if model is None:
+                    model = genai.GenerativeModel(model_name, generation_config=self.generation_config)
+                    self._models[model_name] = model
+        return model
+
+    def reset(self):
+        with self._lock:
+            self._models.clear()
+
+    def ping(self, model_name):
+        # count_tokens là RPC rẻ (không tính quota sinh nội dung) -> đủ để mở/giữ channel
+        self.get(model_name).count_tokens("ping")
+
+    async def ping_async(self, model_name):
+        await self.get(model_name).count_tokens_async("ping")
+
+    def warm(self, model_names, loop=None):
+        """Dựng sẵn handle cho mọi model rồi mở channel đồng bộ (và async nếu có `loop`)."""
+        for name in model_names:
+            self.get(name)
+        if not model_names:
+            return
+        started = time.monotonic()
+        try:
+            self.ping(model_names[0])
+            if loop is not None:
+                loop.submit(self.ping_async(model_names[0])).result(timeout=30)
+            app.logger.info(f"🔌 Model pool warmed: {len(model_names)} models ({round((time.monotonic() - started) * 1000)} ms)")
+        except Exception as e:
+            app.logger.warning(f"⚠️ Model pool warm-up failed: {e}")
+
+    def keep_alive(self, model_name, interval):
+        """Ping channel khi đã rảnh quá `interval` giây để proxy/NAT không đóng kết nối."""
+        while True:
+            time.sleep(interval)
+            if time.monotonic() - self.last_used < interval:
+                continue
+            try:
+                self.ping(model_name)
+            except Exception as e:
+                app.logger.warning(f"⚠️ Model pool keep-alive failed: {e}")
+
+
+model_pool = ModelPool(GENERATION_CONFIG)
+
+
+def _generation_overrides(max_output_tokens, timeout=None):
+    # Budget token riêng cho lời gọi này; các tham số khác lấy từ GENERATION_CONFIG của handle.
+    # Timeout của lời gọi được cắt theo deadline để thread/task không treo quá hạn request.
+    options = {"generation_config": {"max_output_tokens": max_output_tokens}} if max_output_tokens else {}
+    if timeout is not None:
+        options["request_options"] = {"timeout": max(timeout, 0.001)}
+    return options
+
+
+def generate_text(prompt, retries=2, max_output_tokens=None, deadline=None):
+    """
+    Gọi lần lượt các model theo model_router, thử lại tối đa `retries` lượt với
+    backoff (có jitter, theo gợi ý retry-after nếu hết quota). Ném DeadlineExceeded
+    nếu hết `deadline` (Deadline) trước khi có kết quả.
+    """
+    if genai is None:
+        raise RuntimeError("Google generative AI client not available.")
+
+    for attempt in range(retries):
+        hints = []  # retry-after của từng lần thất bại (None nếu lỗi không phải hết quota)
+        for model_name in model_router.candidates():
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded("❌ Hết thời gian trước khi model trả lời.")
+            if not model_router.acquire(model_name):
+                continue
+
+            started = time.monotonic()
+            try:
+                app.logger.info(f"🔍 Trying model: {model_name}")
+                response = model_pool.get(model_name).generate_content(
+                    prompt, **_generation_overrides(max_output_tokens, call_timeout(deadline)))
+
+                text = _response_text(response)
+                if text:
+                    model_router.record_success(model_name, time.monotonic() - started)
+                    return text
+                model_router.record_failure(model_name, latency=time.monotonic() - started)
+                hints.append(None)
+
+            except ResourceExhausted as e:
+                hint = retry_after_hint(e)
+                hints.append(hint)
+                model_router.record_failure(model_name, quota=True, retry_after=hint, latency=time.monotonic() - started)
+                app.logger.warning(f"⚠️ Model {model_name} quota exhausted.")
+                continue
+            except Exception as e:
+                if deadline is not None and deadline.expired():
+                    # Bị cắt vì hết hạn request chứ không phải lỗi của model
+                    model_router.release(model_name)
+                    raise DeadlineExceeded("❌ Hết thời gian trước khi model trả lời.")
+                model_router.record_failure(model_name, latency=time.monotonic() - started)
+                hints.append(None)
+                app.logger.warning(f"⚠️ Model {model_name} failed: {e}")
+                continue
+
+        if not _backoff_or_stop(attempt, retries, hints, deadline):
+            break
+
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded("❌ Hết thời gian trước khi model trả lời.")
+    raise Exception("❌ All models failed or returned invalid data.")
+
+# ---------------------------
+# ⚡ Sinh nội dung bất đồng bộ (asyncio)
+# ---------------------------
+class AsyncLoopThread:
+    """
+    Một event loop asyncio chạy trong thread nền, dùng chung cho mọi request của
+    process: hàng chục lời gọi model có thể cùng chờ mạng mà không chiếm mỗi
+    lời gọi một thread của executor.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+        self.in_flight = 0  # số coroutine đã lên lịch mà chưa xong (cho /metrics)
+
+    def loop(self):
+        # Khởi động trễ để thread được tạo sau khi gunicorn fork worker
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="generation-loop", daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, coro):
+        """Lên lịch `coro` trên loop, trả về concurrent.futures.Future."""
+        fut = asyncio.run_coroutine_threadsafe(coro, self.loop())
+        with self._lock:
+            self.in_flight += 1
+        fut.add_done_callback(self._done)
+        return fut
+
+    def _done(self, _fut):
+        with self._lock:
+            self.in_flight -= 1
+
+
+async def _call_model_async(model_name, prompt, max_output_tokens=None, deadline=None, hints=None):
+    """
+    Một lần gọi model đã được model_router.acquire; trả về text (rỗng nếu thất bại).
+    Khi thất bại, gợi ý retry-after (None nếu không phải hết quota) được thêm vào `hints`.
+    """
+    started = time.monotonic()
+    hint = None
+    try:
+        app.logger.info(f"🔍 Trying model (async): {model_name}")
+        response = await model_pool.get(model_name).generate_content_async(
+            prompt, **_generation_overrides(max_output_tokens, call_timeout(deadline)))
+
+        text = _response_text(response)
+        if text:
+            model_router.record_success(model_name, time.monotonic() - started)
+            return text
+        model_router.record_failure(model_name, latency=time.monotonic() - started)
+
+    except ResourceExhausted as e:
+        hint = retry_after_hint(e)
+        model_router.record_failure(model_name, quota=True, retry_after=hint, latency=time.monotonic() - started)
+        app.logger.warning(f"⚠️ Model {model_name} quota exhausted.")
+    except asyncio.CancelledError:
+        model_router.release(model_name)
+        raise
+    except Exception as e:
+        if deadline is not None and deadline.expired():
+            # Bị cắt vì hết hạn request chứ không phải lỗi của model
+            model_router.release(model_name)
+            return ""
+        model_router.record_failure(model_name, latency=time.monotonic() - started)
+        app.logger.warning(f"⚠️ Model {model_name} failed: {e}")
+    if hints is not None:
+        hints.append(hint)
+    return ""
+
+
+class HedgeStats:
+    """Đếm số lần gửi request dự phòng (hedge) và số lần hedge thắng; chỉ cập nhật trên generation_loop."""
+
+    def __init__(self):
+        self.rounds = 0
+        self.fired = 0
+        self.won = 0
+
+    def snapshot(self):
+        return {
+            "rounds": self.rounds,
+            "fired": self.fired,
+            "won": self.won,
+            "fire_rate": round(self.fired / self.rounds, 3) if self.rounds else 0.0,
+            "win_rate": round(self.won / self.fired, 3) if self.fired else 0.0,
+        }
+
+
+class HedgeBudget:
+    """
+    Số hedge còn được gửi cho một đề: dùng chung cho mọi chunk và vòng bổ sung
+    của đề đó (kể cả các lần thử lại). Chỉ cập nhật trên generation_loop.
+    """
+
+    def __init__(self, limit=None):
+        self.left = HEDGE_BUDGET if limit is None else limit
+        self.fired = 0
+
+    def take(self):
+        if self.left <= 0:
+            return False
+        self.left -= 1
+        self.fired += 1
+        return True
+
+
+# HEDGE_REQUESTS=1 -> nếu model chính chưa trả lời sau độ trễ p90 của nó, gửi thêm bản sao tới model kế tiếp
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_BUDGET = int(os.getenv("HEDGE_BUDGET", 1))  # số hedge tối đa cho mỗi đề (mọi chunk và vòng bổ sung)
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 1.0))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", 10.0))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", 4.0))
+hedge_stats = HedgeStats()
+
+
+def _hedge_delay(model_name):
+    p90 = model_router.latency_quantile(model_name, 0.9)
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p90 if p90 is not None else HEDGE_DEFAULT_DELAY))
+
+
+async def _hedged_round(prompt, hedges, max_output_tokens=None, deadline=None, hints=None):
+    """
+    Thử lần lượt các model như bình thường, nhưng nếu model đang chờ chưa trả lời
+    sau _hedge_delay thì gửi thêm bản sao tới model kế tiếp (trừ vào `hedges`,
+    HedgeBudget của cả đề). Kết quả đầu tiên tách được câu hỏi hợp lệ thắng, các
+    lời gọi còn lại bị hủy (kể cả khi hết `deadline`).
+    """
+    candidates = iter(model_router.candidates())
+
+    def start_next():
+        for name in candidates:
+            if model_router.acquire(name):
+                call = _call_model_async(name, prompt, max_output_tokens, deadline, hints)
+                return asyncio.ensure_future(call), name
+        return None, None
+
+    hedge_stats.rounds += 1
+    pending = {}  # task -> (model_name, is_hedge)
+    task, name = start_next()
+    if task is None:
+        return ""
+    pending[task] = (name, False)
+    newest = name
+    fallback_text = ""
+    can_hedge = True  # còn model để gửi hedge trong vòng này
+    try:
+        while pending:
+            timeout = _hedge_delay(newest) if can_hedge and hedges.left > 0 else None
+            if deadline is not None:
+                timeout = deadline.remaining() if timeout is None else deadline.cap(timeout)
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if deadline is not None and deadline.expired():
+                    return fallback_text
+                if hedges.left <= 0:
+                    continue  # chunk khác của đề vừa dùng hết budget
+                task, name = start_next()
+                if task is None:
+                    can_hedge = False
+                    continue
+                hedges.take()
+                hedge_stats.fired += 1
+                app.logger.info(f"🪁 Hedge: {newest} chậm, gửi thêm tới {name}")
+                pending[task] = (name, True)
+                newest = name
+                continue
+            for finished in done:
+                finished_name, is_hedge = pending.pop(finished)
+                text = finished.result()
+                if text and extract_questions(text)[0]:
+                    if is_hedge:
+                        hedge_stats.won += 1
+                    return text
+                fallback_text = fallback_text or text
+            if not pending:
+                # Model đang chờ đều lỗi -> chuyển sang model kế tiếp như đường không hedge
+                task, name = start_next()
+                if task is not None:
+                    pending[task] = (name, False)
+                    newest = name
+        return fallback_text
+    finally:
+        for leftover in pending:
+            leftover.cancel()
+
+
+async def generate_text_async(prompt, retries=2, max_output_tokens=None, deadline=None, hedges=None):
+    """
+    Bản bất đồng bộ của generate_text, dùng generate_content_async của client (có
+    hedge nếu bật HEDGE_REQUESTS, trừ vào `hedges` - HedgeBudget của cả đề).
+    """
+    if genai is None:
+        raise RuntimeError("Google generative AI client not available.")
+
+    if hedges is None:
+        hedges = HedgeBudget()
+    for attempt in range(retries):
+        hints = []
+        if HEDGE_REQUESTS:
+            text = await _hedged_round(prompt, hedges, max_output_tokens, deadline, hints)
+            if text:
+                return text
+        else:
+            for model_name in model_router.candidates():
+                if deadline is not None and deadline.expired():
+                    break
+                if not model_router.acquire(model_name):
+                    continue
+                text = await _call_model_async(model_name, prompt, max_output_tokens, deadline, hints)
+                if text:
+                    return text
+
+        delay = _next_delay(attempt, retries, hints, deadline)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded("❌ Hết thời gian trước khi model trả lời.")
+    raise Exception("❌ All models failed or returned invalid data.")
+
+
+# ASYNC_GENERATION=0 -> quay về đường đồng bộ cũ (generate_text trên ThreadPoolExecutor)
+ASYNC_GENERATION = os.getenv("ASYNC_GENERATION", "1") == "1"
+generation_loop = AsyncLoopThread()
+
+
+def async_generation_enabled():
+    return (ASYNC_GENERATION and genai is not None and GEMINI_TRANSPORT != "rest"
+            and hasattr(genai.GenerativeModel, "generate_content_async"))
+
+
+def submit_generation(prompt, max_output_tokens=None, deadline=None, hedges=None):
+    """
+    Lên lịch sinh nội dung cho `prompt` và trả về concurrent.futures.Future:
+    trên event loop dùng chung nếu bật ASYNC_GENERATION, ngược lại trên executor.
+    `max_output_tokens` ghi đè budget token của GENERATION_CONFIG cho riêng lời gọi này;
+    mọi lần gọi model và thời gian nghỉ đều kết thúc trước `deadline`, nên hủy
+    Future quá hạn sẽ sớm trả lại slot của executor. Các lời gọi của cùng một đề
+    truyền chung một `hedges` (HedgeBudget) để tổng số hedge không vượt HEDGE_BUDGET.
+    """
+    if async_generation_enabled():
+        return generation_loop.submit(generate_text_async(
+            prompt, max_output_tokens=max_output_tokens, deadline=deadline, hedges=hedges))
+    return executor.submit(generate_text, prompt, max_output_tokens=max_output_tokens, deadline=deadline)
+
+
+# MODEL_POOL_WARMUP=0 -> không mở channel khi khởi động (lời gọi đầu tiên sẽ tự mở)
+MODEL_POOL_WARMUP = os.getenv("MODEL_POOL_WARMUP", "1") == "1"
+GEMINI_KEEPALIVE = float(os.getenv("GEMINI_KEEPALIVE", 0))  # giây; 0 = tắt ping giữ kết nối
+
+
+def _warm_model_pool():
+    model_pool.warm(model_router.models, loop=generation_loop if async_generation_enabled() else None)
+    if GEMINI_KEEPALIVE > 0 and model_router.models:
+        model_pool.keep_alive(model_router.models[0], GEMINI_KEEPALIVE)
+
+
+def start_model_pool_warmup():
+    if MODEL_POOL_WARMUP and genai is not None and GOOGLE_API_KEY:
+        threading.Thread(target=_warm_model_pool, name="model-pool-warmup", daemon=True).start()
+
+
+def _reset_after_fork():
+    # Channel gRPC và event loop không sống sót qua fork (vd. gunicorn --preload): dựng lại trong worker
+    global generation_loop
+    generation_loop = AsyncLoopThread()
+    model_pool.reset()
+    metrics.reset()
+    metrics.start_flusher()
+    start_access_log()
+    configure_genai()
+    start_model_pool_warmup()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+start_model_pool_warmup()
+start_access_log()
+atexit.register(stop_access_log)
+
+# ---------------------------
+# 🔍 Tách câu hỏi từ output của model (parse JSON tăng dần)
+# ---------------------------
+_QUOTES = "\"'“”‘’"
+# Ký tự cấu trúc, hoặc cả một chuỗi JSON chuẩn đã đóng (theo sau là : , } ]) để nhảy qua trong một bước
+_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"(?=\s*[:,}\]])|[{}\[\],"\'“”‘’]')
+_STRICT_STRING_RE = re.compile(r'[\\"]')
+_LOOSE_STRING_RE = re.compile(r"[\\\"'“”‘’]")
+_NON_SPACE_RE = re.compile(r"\S")
+_REPAIR_OUTSIDE_RE = re.compile(r"[,\"'“”‘’]")
+# Lệnh LaTeX trùng với escape JSON hợp lệ (\f \b \n \r \t): json.loads vẫn nhận nhưng thành ký tự điều khiển
+_LATEX_ESCAPE_WORDS = (
+    "frac", "forall", "beta", "bar", "binom", "begin", "theta", "tau", "times", "tan",
+    "text", "to", "triangle", "rho", "right", "rightarrow", "nu", "ne", "neq", "neg",
+    "nabla", "notin",
+)
+# Cặp "\\" (thay bằng chính nó), hoặc dấu "\" không mở escape JSON hợp lệ / mở một lệnh LaTeX ở trên
+_STRAY_BACKSLASH_RE = re.compile(
+    r"\\\\|\\(?=[^\"\\/bfnrtu']|u(?![0-9A-Fa-f]{4})|(?:"
+    + "|".join(_LATEX_ESCAPE_WORDS) + r")(?![A-Za-z]))"
+)
+_CLOSING_QUOTE = {"“": "”", "‘": "’"}
+
+
+class QuestionStreamParser:
+    """
+    Đọc output JSON của model một lượt (có thể theo từng đoạn stream) và trả về
+    từng câu hỏi ngay khi object của nó đóng lại, thay cho việc regex + json.loads
+    cả chuỗi rồi thay thế ký tự trên toàn văn bản.
+
+    Câu hỏi là object nằm trực tiếp trong một mảng (thường là "questions") và
+    không lồng trong câu hỏi khác. Mỗi object được json.loads riêng; nếu hỏng thì
+    chỉ sửa cục bộ object đó: dấu phẩy thừa, chuỗi bọc bằng nháy cong/nháy đơn,
+    dấu " chưa escape trong chuỗi, dấu "\\" của LaTeX. Object cuối bị cắt cụt (hết
+    token) được cứu bằng cách đóng lại như đang có, không được thì bỏ trường dở
+    dang. Chỉ câu qua được is_valid_question mới được trả về.
+
+        parser = QuestionStreamParser()
+        for chunk in chunks:
+            for q in parser.feed(chunk): ...
+        rest = parser.close()
+        parser.stats  # {"recovered": ..., "repaired": ..., "dropped": ...}
+    """
+
+    def __init__(self):
+        self.stats = {"recovered": 0, "repaired": 0, "dropped": 0}
+        self._buf = ""
+        self._pos = 0
+        self._stack = []  # các ký tự "{" / "[" đang mở
+        self._string = None  # dấu nháy mở chuỗi đang đọc dở; '"' là chuỗi JSON chuẩn
+        self._item_start = None  # vị trí "{" của câu hỏi đang đọc dở
+        self._item_depth = 0
+        self._item_commas = []  # vị trí các dấu phẩy ở cấp trường của câu hỏi đang đọc
+
+    def feed(self, chunk):
+        """Nạp thêm một đoạn output; trả về các câu hỏi vừa hoàn chỉnh."""
+        self._buf += chunk
+        out = []
+        self._scan(out, final=False)
+        self._compact()
+        return out
+
+    def close(self):
+        """Báo hết output; cứu câu hỏi cuối nếu bị cắt cụt và trả về các câu còn lại."""
+        out = []
+        self._scan(out, final=True)
+        if self._item_start is not None:
+            # Thử đóng object như đang có trước (giữ được trường cuối, vd. "answer"); không được mới bỏ trường dở dang
+            commas = self._item_commas
+            if not (self._emit(self._complete_item(), out, truncated=True)
+                    or commas and self._emit(self._buf[self._item_start:commas[-1]] + "}", out, truncated=True)):
+                self.stats["dropped"] += 1
+            self._item_start = None
+        self._buf, self._pos = "", 0
+        return out
+
+    def _complete_item(self):
+        """Câu hỏi đang đọc dở + các dấu đóng còn thiếu: nháy của chuỗi đang mở, rồi ] / } theo thứ tự."""
+        text = self._buf[self._item_start:]
+        if self._string is not None:
+            if (len(text) - len(text.rstrip("\\"))) % 2:
+                text = text[:-1]  # escape bị cắt giữa chừng
+            text += _CLOSING_QUOTE.get(self._string, self._string)
+        return text + "".join("}" if ch == "{" else "]" for ch in reversed(self._stack[self._item_depth - 1:]))
+
+    def _closes_string(self, quote_at, final):
+        """Dấu nháy ở `quote_at` đóng chuỗi nếu theo sau là : , } ] (hoặc hết output). None = chưa đủ dữ liệu."""
+        m = _NON_SPACE_RE.search(self._buf, quote_at + 1)
+        if m is None:
+            return True if final else None
+        return m.group(0) in ":,}]"
+
+    def _scan(self, out, final):
+        # Trạng thái được chép ra biến cục bộ: vòng lặp này chạy cho mọi ký tự cấu trúc của output
+        buf = self._buf
+        pos = self._pos
+        stack = self._stack
+        string = self._string
+        item_start, item_depth, commas = self._item_start, self._item_depth, self._item_commas
+        while True:
+            if string is not None:
+                m = (_STRICT_STRING_RE if string == '"' else _LOOSE_STRING_RE).search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                i = m.start()
+                if buf[i] == "\\":
+                    if i + 1 >= len(buf) and not final:
+                        pos = i
+                        break
+                    pos = i + 2
+                    continue
+                closes = self._closes_string(i, final)
+                if closes is None:
+                    pos = i
+                    break
+                pos = i + 1
+                if closes:
+                    string = None
+                continue
+
+            for m in _TOKEN_RE.finditer(buf, pos):
+                ch = m.group(0)
+                if len(ch) > 1:
+                    continue  # cả một chuỗi JSON đã đóng
+                if ch == "{":
+                    if item_start is None and stack and stack[-1] == "[":
+                        item_start = m.start()
+                        item_depth = len(stack) + 1
+                        commas = []
+                    stack.append(ch)
+                elif ch == ",":
+                    if item_start is not None and len(stack) == item_depth:
+                        commas.append(m.start())
+                elif ch == "[":
+                    stack.append(ch)
+                elif ch in _QUOTES:
+                    # Chuỗi chưa đóng trong buffer hoặc bọc bằng nháy lạ -> đọc từng đoạn ở nhánh trên
+                    string = ch
+                    pos = m.end()
+                    break
+                else:  # "}" hoặc "]"
+                    if stack:
+                        stack.pop()
+                    if ch == "}" and item_start is not None and len(stack) == item_depth - 1:
+                        self._emit(buf[item_start:m.end()], out)
+                        item_start = None
+            else:
+                pos = len(buf)
+                break
+        self._pos = pos
+        self._string = string
+        self._item_start, self._item_depth, self._item_commas = item_start, item_depth, commas
+
+    def _compact(self):
+        # Bỏ phần đã đọc xong khỏi buffer để output dài không bị quét/giữ lại nhiều lần
+        cut = self._pos if self._item_start is None else self._item_start
+        if cut:
+            self._buf = self._buf[cut:]
+            self._pos -= cut
+            if self._item_start is not None:
+                self._item_start -= cut
+                self._item_commas = [c - cut for c in self._item_commas]
+
+    def _emit(self, text, out, truncated=False):
+        repaired = truncated
+        if "\\" in text:
+            text = escape_stray_backslashes(text)
+        try:
+            obj = json.loads(text, strict=False)
+        except ValueError:
+            try:
+                obj = json.loads(repair_json_object(text), strict=False)
+                repaired = True
+            except ValueError:
+                obj = None
+        if not is_valid_question(obj):
+            if not truncated:
+                self.stats["dropped"] += 1
+            return False
+        self.stats["recovered"] += 1
+        self.stats["repaired"] += repaired
+        out.append(obj)
+        return True
+
+
+def escape_stray_backslashes(text):
+    """
+    Nhân đôi các dấu "\\" không mở escape JSON hợp lệ trước khi decode: model hay
+    viết LaTeX với một dấu "\\" (\\sqrt, \\alpha) làm json.loads báo lỗi. Các lệnh
+    trùng escape hợp lệ (\\frac, \\beta, \\theta, \\neq...) cũng được giữ nguyên
+    thay vì thành ký tự điều khiển; \\' để repair_json_object xử lý.
+    """
+    return _STRAY_BACKSLASH_RE.sub(r"\\\\", text)
+
+
+def repair_json_object(text):
+    """
+    Sửa cục bộ một object JSON: bỏ dấu phẩy thừa trước } / ], đổi chuỗi bọc bằng
+    nháy cong/nháy đơn thành nháy kép và escape dấu " nằm trong chuỗi.
+    Dấu nháy đơn trong nội dung chuỗi (vd. "Newton's law") được giữ nguyên.
+    """
+    out = []
+    n = len(text)
+    i = 0
+    while i < n:
+        m = _REPAIR_OUTSIDE_RE.search(text, i)
+        if m is None:
+            out.append(text[i:])
+            break
+        out.append(text[i:m.start()])
+        i = m.start()
+        if text[i] == ",":
+            nxt = _NON_SPACE_RE.search(text, i + 1)
+            if nxt is None or nxt.group(0) not in "}]":
+                out.append(",")
+            i += 1
+            continue
+
+        # Chuỗi: mở bằng bất kỳ dấu nháy nào, đóng ở dấu nháy theo sau là : , } ] (hoặc hết object)
+        string_re = _STRICT_STRING_RE if text[i] == '"' else _LOOSE_STRING_RE
+        out.append('"')
+        i += 1
+        while i < n:
+            m = string_re.search(text, i)
+            if m is None:
+                out.append(text[i:])
+                i = n
+                break
+            out.append(text[i:m.start()])
+            i = m.start()
+            ch = text[i]
+            if ch == "\\":
+                # \' không hợp lệ trong JSON -> nháy đơn thường
+                out.append("'" if text[i + 1:i + 2] == "'" else text[i:i + 2])
+                i += 2
+                continue
+            nxt = _NON_SPACE_RE.search(text, i + 1)
+            if nxt is None or nxt.group(0) in ":,}]":
+                i += 1
+                break
+            out.append('\\"' if ch == '"' else ch)
+            i += 1
+        out.append('"')
+    return "".join(out)
+
+
+def _load_whole(text):
+    # Đường nhanh cho output đã là JSON hợp lệ (đa số): một lần parse bằng C (orjson nếu có)
+    start = min((i for i in (text.find("{"), text.find("[")) if i != -1), default=-1)
+    end = max(text.rfind("}"), text.rfind("]"))
+    if start == -1 or end <= start:
+        return None
+    text = text[start:end + 1]
+    if "\\" in text:
+        text = escape_stray_backslashes(text)
+    try:
+        parsed = loads_json(text)
+    except ValueError:
+        return None
+    items = parsed.get("questions") if isinstance(parsed, dict) else parsed
+    return items if isinstance(items, list) else None
+
+
+def extract_questions(text):
+    """
+    Tách các câu hỏi hợp lệ từ toàn bộ output của model; trả về (questions, stats).
+    Output hợp lệ được json.loads một lần; chỉ output hỏng mới đi qua QuestionStreamParser.
+    """
+    items = _load_whole(text) if text else None
+    if items is not None:
+        questions = [q for q in items if is_valid_question(q)]
+        return questions, {"recovered": len(questions), "repaired": 0, "dropped": len(items) - len(questions)}
+    parser = QuestionStreamParser()
+    questions = parser.feed(text or "") + parser.close()
+    if text and not questions:
+        app.logger.warning(f"⚠️ Không tách được câu hỏi nào từ output ({parser.stats['dropped']} object hỏng).")
+    return questions, parser.stats
+
+# ---------------------------
+# 🔢 Chuẩn hóa ký hiệu
+# ---------------------------
+# Các bảng chuyển đổi và regex được biên dịch một lần khi import module
+# thay vì dựng lại ở mỗi lần gọi normalize_math_symbols.
+LATEX_UNICODE_MAP = {
+    'alpha': 'α', 'beta': 'β', 'gamma': 'γ', 'delta': 'δ', 'epsilon': 'ε',
+    'zeta': 'ζ', 'eta': 'η', 'theta': 'θ', 'iota': 'ι', 'kappa': 'κ',
+    'lambda': 'λ', 'mu': 'μ', 'nu': 'ν', 'xi': 'ξ', 'omicron': 'ο',
+    'pi': 'π', 'rho': 'ρ', 'sigma': 'σ', 'tau': 'τ', 'upsilon': 'υ',
+    'phi': 'φ', 'chi': 'χ', 'psi': 'ψ', 'omega': 'ω',
+    'Gamma': 'Γ', 'Delta': 'Δ', 'Theta': 'Θ', 'Lambda': 'Λ', 'Xi': 'Ξ',
+    'Pi': 'Π', 'Sigma': 'Σ', 'Upsilon': 'Υ', 'Phi': 'Φ', 'Psi': 'Ψ',
+    'Omega': 'Ω',
+    'pm': '±', 'times': '×', 'div': '÷', 'cdot': '⋅', 'neq': '≠',
+    'leq': '≤', 'geq': '≥', 'approx': '≈', 'equiv': '≡', 'in': '∈',
+    'notin': '∉', 'subset': '⊂', 'supset': '⊃', 'subseteq': '⊆',
+    'supseteq': '⊇', 'sum': '∑', 'int': '∫', 'partial': '∂',
+    'nabla': '∇', 'infty': '∞', 'forall': '∀', 'exists': '∃',
+    'angle': '∠', 'perp': '⊥',
+    'rightarrow': '→', 'leftarrow': '←', 'leftrightarrow': '↔',
+    'Rightarrow': '⇒', 'Leftarrow': '⇐', 'Leftrightarrow': '⇔',
+    'uparrow': '↑', 'downarrow': '↓',
+    'ldots': '…', 'cdots': '⋯', 'vdots': '⋮', 'ddots': '⋱',
+    'circ': '°',
+}
+KEYWORD_MAP = {
+    'sqrt': '√', 'inf': '∞',
+}
+# Thứ tự có ý nghĩa: các toán tử được thay tuần tự như bản gốc
+OPERATOR_MAP = {
+    '>=': '≥', '<=': '≤', '!=': '≠', '->': '→', '<-': '←', '<=>': '⇔'
+}
+SUPERSCRIPT_MAP = str.maketrans("0123456789+-=()n", "⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ⁿ")
+SUBSCRIPT_MAP = str.maketrans("0123456789+-=()aehijklmnoprstuvx", "₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎ₐₑₕᵢⱼₖₗₘₙₒₚᵣₛₜᵤᵥₓ")
+_CHEM_DIGIT_MAP = str.maketrans("0123456789", "₀₁₂₃₄₅₆₇₈₉")
+
+NORMALIZE_CACHE_SIZE = int(os.getenv("NORMALIZE_CACHE_SIZE", 4096))
+
+_LATEX_ORDER = {name: i for i, name in enumerate(LATEX_UNICODE_MAP)}
+_WORD_CHAR_RE = re.compile(r"\w")
+# Lệnh LaTeX mà ký hiệu thay thế là "chữ" (chữ cái Hy Lạp) -> ảnh hưởng tới \b của lệnh đứng trước
+_LATEX_WORD_OUTPUT = {name for name, uni in LATEX_UNICODE_MAP.items() if _WORD_CHAR_RE.match(uni)}
+_LATEX_TOKEN_RE = re.compile(r"\\([A-Za-z]+)")
+_KEYWORD_RE = re.compile(r"(?i:\b(?:(sqrt)|(inf))\b)|(\^o\b)")
+_SQRT_RE = re.compile(r"√\s*[{<(]([^})>]+)[})>]")
+_FRAC_RE = re.compile(r"\\frac{([^}]+)}{([^}]+)}")
+_VEC_RE = re.compile(r"\\vec{([^}]+)}")
+_HAT_RE = re.compile(r"\\hat{([A-Za-z])}")
+_SUP_BRACE_RE = re.compile(r"\^\{([^}]+)\}")
+_SUP_RE = re.compile(r"\^([0-9n()+\-]+)")
+_SUB_BRACE_RE = re.compile(r"_{([^}]+)}")
+_SUB_RE = re.compile(r"_([0-9aehijklmnoprstuvx]+)")
+_CHEM_RE = re.compile(r"\b([A-Z][a-z]?\d*)+")
+_CHEM_DIGITS_RE = re.compile(r"(?<=[A-Za-z])([0-9]+)")
+_ASCII_DIGIT_RE = re.compile(r"[0-9]")
+
+
+def _replace_latex_commands(text):
+    """
+    Thay toàn bộ lệnh LaTeX trong một lượt quét.
+
+    Bản cũ chạy một re.sub(r'\\cmd\b') cho từng lệnh theo thứ tự của bảng, nên
+    một lệnh đứng ngay trước lệnh chữ Hy Lạp đã được thay ở lượt sớm hơn
+    (vd. "\\beta\\alpha") sẽ mất ranh giới từ và giữ nguyên. Duyệt từ phải sang
+    trái giúp tái hiện đúng hành vi đó.
+    """
+    tokens = [m for m in _LATEX_TOKEN_RE.finditer(text) if m.group(1) in _LATEX_ORDER]
+    if not tokens:
+        return text
+
+    replaced = {}  # vị trí bắt đầu -> (thứ tự lượt thay, tên lệnh)
+    text_len = len(text)
+    for m in reversed(tokens):
+        name = m.group(1)
+        order = _LATEX_ORDER[name]
+        end = m.end()
+        if end == text_len:
+            boundary = True
+        elif text[end] == "\\":
+            following = replaced.get(end)
+            boundary = not (following and following[0] < order and following[1] in _LATEX_WORD_OUTPUT)
+        else:
+            boundary = not _WORD_CHAR_RE.match(text[end])
+        if boundary:
+            replaced[m.start()] = (order, name)
+
+    if not replaced:
+        return text
+    parts = []
+    pos = 0
+    for m in tokens:
+        if m.start() in replaced:
+            parts.append(text[pos:m.start()])
+            parts.append(LATEX_UNICODE_MAP[m.group(1)])
+            pos = m.end()
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+def _replace_keyword(m):
+    if m.lastindex == 1:
+        return KEYWORD_MAP['sqrt']
+    if m.lastindex == 2:
+        return KEYWORD_MAP['inf']
+    return '°'
+
+
+def _add_hat(m):
+    return m.group(1) + '\u0302'
+
+
+def _to_superscript(m):
+    return m.group(1).translate(SUPERSCRIPT_MAP)
+
+
+def _to_subscript(m):
+    return m.group(1).translate(SUBSCRIPT_MAP)
+
+
+def _chemical_subscripts(m):
+    formula = m.group(0)
+    if formula.isascii():
+        # Trong công thức ASCII mọi chữ số đều đứng sau một chữ cái (trực tiếp hoặc qua chữ số khác)
+        return formula.translate(_CHEM_DIGIT_MAP)
+    return _CHEM_DIGITS_RE.sub(lambda d: d.group(1).translate(SUBSCRIPT_MAP), formula)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _normalize_math_symbols_cached(text):
+    # --- 1. Thay thế ký hiệu ---
     # Thay thế các toán tử đặc biệt
-    for op, uni in operator_map.items():
-        text = text.replace(op, uni)
-    # Thay thế các lệnh LaTeX
-    for latex, uni in latex_unicode_map.items():
-        text = re.sub(latex + r'\b', uni, text)
-    # Thay thế các từ khóa
-    for keyword, uni in keyword_map.items():
-        text = re.sub(r'\b' + keyword + r'\b', uni, text, flags=re.IGNORECASE)
-    # Thay thế ký hiệu độ dạng `^o`
-    text = re.sub(r'\^o\b', '°', text)
-
-    # --- 3. Xử lý các cấu trúc phức tạp hơn bằng Regex ---
-
-    # CẢI TIẾN: Chuẩn hóa căn bậc hai và thêm ngoặc để rõ ràng
-    # Thay vì r"√\1", ta dùng r"√(\1)"
-    text = re.sub(r"√\s*[{<(]([^})>]+)[})>]", r"√(\1)", text)
-
-    # Chuẩn hóa phân số
-    text = re.sub(r"\\frac{([^}]+)}{([^}]+)}", r"(\1/\2)", text)
-    # Chuẩn hóa vector
-    text = re.sub(r"\\vec{([^}]+)}", r"\1⃗", text)
-    # Chuẩn hóa góc dạng "hat"
-    def add_hat(m):
-        return m.group(1) + '\u0302'
-    text = re.sub(r"\\hat{([A-Za-z])}", add_hat, text)
+    for op, uni in OPERATOR_MAP.items():
+        if op in text:
+            text = text.replace(op, uni)
+    # Thay thế các lệnh LaTeX (một lượt quét duy nhất)
+    if "\\" in text:
+        text = _replace_latex_commands(text)
+    # Thay thế các từ khóa và ký hiệu độ dạng `^o`
+    text = _KEYWORD_RE.sub(_replace_keyword, text)
+
+    # --- 2. Xử lý các cấu trúc phức tạp hơn (bỏ qua lượt không thể khớp) ---
+    # Chuẩn hóa căn bậc hai và thêm ngoặc để rõ ràng
+    if "√" in text:
+        text = _SQRT_RE.sub(r"√(\1)", text)
+    if "\\" in text:
+        # Chuẩn hóa phân số, vector và góc dạng "hat"
+        if "\\frac{" in text:
+            text = _FRAC_RE.sub(r"(\1/\2)", text)
+        if "\\vec{" in text:
+            text = _VEC_RE.sub(r"\1⃗", text)
+        if "\\hat{" in text:
+            text = _HAT_RE.sub(_add_hat, text)
     # Chuẩn hóa chỉ số trên (superscript)
-    def to_superscript(m):
-        return m.group(1).translate(superscript_map)
-    text = re.sub(r"\^\{([^}]+)\}", to_superscript, text)
-    text = re.sub(r"\^([0-9n()+\-]+)", to_superscript, text)
+    if "^" in text:
+        text = _SUP_BRACE_RE.sub(_to_superscript, text)
+        text = _SUP_RE.sub(_to_superscript, text)
     # Chuẩn hóa chỉ số dưới (subscript)
-    def to_subscript(m):
-        return m.group(1).translate(subscript_map)
-    text = re.sub(r"_{([^}]+)}", to_subscript, text)
-    text = re.sub(r"_([0-9aehijklmnoprstuvx]+)", to_subscript, text)
-    # Chuẩn hóa công thức hóa học
-    def chemical_subscripts(match):
-        formula = match.group(0)
-        return re.sub(r"(?<=[A-Za-z])([0-9]+)", lambda m: m.group(1).translate(subscript_map), formula)
-    text = re.sub(r"\b([A-Z][a-z]?\d*)+", chemical_subscripts, text)
-
-    # --- 4. Dọn dẹp cuối cùng ---
+    if "_" in text:
+        text = _SUB_BRACE_RE.sub(_to_subscript, text)
+        text = _SUB_RE.sub(_to_subscript, text)
+    # Chuẩn hóa công thức hóa học (chỉ có tác dụng khi còn chữ số)
+    if _ASCII_DIGIT_RE.search(text):
+        text = _CHEM_RE.sub(_chemical_subscripts, text)
+
+    # --- 3. Dọn dẹp cuối cùng ---
     text = text.replace("\\", "")
-    text = re.sub(r"\s+", " ", text).strip()
+    return " ".join(text.split())
+
+
+def normalize_math_symbols(text: str) -> str:
+    """
+    Chuẩn hóa một chuỗi văn bản chứa các ký hiệu và công thức toán học,
+    hóa học và vật lý về định dạng Unicode đẹp mắt.
 
-    return text
+    Kết quả được ghi nhớ trong LRU giới hạn (NORMALIZE_CACHE_SIZE) vì các
+    chuỗi như "A. Đúng"/"B. Sai" lặp lại ở hầu hết mọi đề.
 
+    Args:
+        text: Chuỗi văn bản đầu vào.
+
+    Returns:
+        Chuỗi văn bản đã được chuẩn hóa.
+    """
+    if not text or not isinstance(text, str):
+        return text
+    return _normalize_math_symbols_cached(text)
+
+
+def normalize_question(q):
+    """Chuẩn hóa ký hiệu trong câu hỏi, đáp án và các lựa chọn (sửa tại chỗ)."""
+    for field in ["question", "answer"]:
+        if field in q and isinstance(q[field], str):
+            q[field] = normalize_math_symbols(q[field])
+    if "options" in q and isinstance(q["options"], list):
+        q["options"] = [normalize_math_symbols(opt) for opt in q["options"]]
+    return q
 
 # ---------------------------
-# 🧩 API sinh đề trắc nghiệm (bản có TTL + force_regen)
+# 📝 Prompt sinh câu hỏi
 # ---------------------------
-@app.route("/api/generate-quiz", methods=["POST", "OPTIONS"])
-def api_generate_quiz():
-    start_time = time.time()
-    try:
-        # Try to parse JSON more robustly
-        try:
-            data = request.get_json(force=False, silent=True)
-            if data is None:
-                # Fallback: try reading raw data as text then json loads
-                raw = request.data.decode("utf-8", errors="ignore")
-                data = json.loads(raw) if raw else {}
-        except Exception:
-            data = {}
-        # If still None -> empty dict
-        data = data or {}
-
-        # Log incoming payload (giúp debug)
-        app.logger.info(f"Payload received: {data}")
-
-        subject = data.get("subject", "")
-        grade = str(data.get("grade", ""))
-        topic = data.get("topic", "").strip()
-
-        # Parse numbers an toàn (nếu frontend không gửi, dùng default)
-        try:
-            num_mcq = int(data.get("num_mcq", 10) or 10)
-        except (ValueError, TypeError):
-            num_mcq = 10
-        try:
-            num_tf = int(data.get("num_tf", 4) or 4)
-        except (ValueError, TypeError):
-            num_tf = 4
+QUIZ_LEVELS = ("nhận biết", "hiểu", "vận dụng")
+# Tỉ lệ câu theo mức độ (nhận biết, hiểu, vận dụng) của từng dạng câu hỏi
+LEVEL_MIX = {"mcq": (0.4, 0.3, 0.3), "truefalse": (0.5, 0.25, 0.25)}
 
-        force_regen = bool(data.get("force_regen", False))
+_PROMPT_KINDS = {
+    "mcq": ("câu hỏi trắc nghiệm nhiều lựa chọn (MCQ)", '["A. ...", "B. ...", "C. ...", "D. ..."]'),
+    "truefalse": ("câu hỏi dạng Đúng/Sai", '["A. Đúng", "B. Sai"]'),
+}
 
-        CACHE_TTL = 120  # ⏱ 2 phút
-        cache_key = json.dumps(
-            {"subject": subject, "grade": grade, "topic": topic, "num_mcq": num_mcq, "num_tf": num_tf},
-            sort_keys=True
-        )
 
-        # ⚡ Kiểm tra cache
-        cached_entry = quiz_cache.get(cache_key)
-        if (
-            not force_regen
-            and cached_entry
-            and (time.time() - cached_entry["time"] < CACHE_TTL)
-        ):
-            app.logger.info("⚡ Trả đề từ cache RAM (hợp lệ trong TTL).")
-            return jsonify(cached_entry["data"])
-
-        # Nếu client gọi mà không có client AI config -> trả lỗi rõ
-        if genai is None or not GOOGLE_API_KEY:
-            app.logger.error("AI client not configured (genai or GOOGLE_API_KEY missing).")
-            return jsonify({"error": "AI service not configured"}), 503
+def build_quiz_prompt(kind, subject, grade, topic, count, levels=None):
+    """
+    Dựng prompt sinh `count` câu hỏi dạng `kind` ("mcq" hoặc "truefalse").
 
-        # ---------------------------
-        # PROMPT 1: MCQ
-        # ---------------------------
-        prompt_mcq = f"""
+    `levels` là số câu cụ thể cho từng mức độ trong QUIZ_LEVELS; mặc định
+    dùng tỉ lệ LEVEL_MIX của dạng câu hỏi.
+    """
+    description, options = _PROMPT_KINDS[kind]
+    if levels is None:
+        mix = ", ".join(f"{round(p * 100)}% câu ở mức độ {lv}" for lv, p in zip(QUIZ_LEVELS, LEVEL_MIX[kind]))
+    else:
+        mix = ", ".join(f"{n} câu ở mức độ {lv}" for lv, n in zip(QUIZ_LEVELS, levels))
+    return f"""
 Chỉ trả về JSON hợp lệ, không markdown.
-Tạo {num_mcq} câu hỏi trắc nghiệm nhiều lựa chọn (MCQ) cho học sinh:
+Tạo {count} {description} cho học sinh:
 - Môn học: {subject}
 - Lớp: {grade}
 - Chủ đề: {topic}
-- Trong đó có 40% câu ở mức độ nhận biết, 30% câu ở mức độ hiểu, 30% câu ở mức độ vận dụng.
+- Trong đó có {mix}.
+- Ghi mức độ của từng câu vào trường "level".
 Định dạng:
 {{
   "questions": [
     {{
-      "type": "mcq",
+      "type": "{kind}",
+      "level": "{QUIZ_LEVELS[0]}",
       "question": "...",
-      "options": ["A. ...", "B. ...", "C. ...", "D. ..."],
+      "options": {options},
       "answer": "A"
     }}
   ]
 }}
 """
 
-        # ---------------------------
-        # PROMPT 2: True/False
-        # ---------------------------
-        prompt_tf = f"""
-Chỉ trả về JSON hợp lệ, không markdown.
-Tạo {num_tf} câu hỏi dạng Đúng/Sai cho học sinh:
-- Môn học: {subject}
-- Lớp: {grade}
-- Chủ đề: {topic}
-- Trong đó có 50% câu ở mức độ nhận biết, 25% câu ở mức độ hiểu, 25% câu ở mức độ vận dụng.
-Định dạng:
-{{
-  "questions": [
-    {{
-      "type": "truefalse",
-      "question": "...",
-      "options": ["A. Đúng", "B. Sai"],
-      "answer": "A"
-    }}
-  ]
-}}
-"""
 
-        # 🧠 Sinh song song MCQ và True/False
-        fut_mcq = executor.submit(generate_text, prompt_mcq)
-        fut_tf = executor.submit(generate_text, prompt_tf)
-        raw_mcq, raw_tf = fut_mcq.result(timeout=25), fut_tf.result(timeout=25)
+def split_by_levels(total, mix):
+    """Chia `total` câu theo tỉ lệ `mix` (phần dư chia cho mức có phần lẻ lớn nhất): 10 × (0.4, 0.3, 0.3) -> [4, 3, 3]."""
+    raw = [total * p for p in mix]
+    counts = [int(round(r, 9)) for r in raw]
+    by_remainder = sorted(range(len(mix)), key=lambda i: raw[i] - counts[i], reverse=True)
+    for i in by_remainder[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
 
-        data_mcq = safe_parse_json(raw_mcq) or {"questions": []}
-        data_tf = safe_parse_json(raw_tf) or {"questions": []}
 
-        all_questions = data_mcq.get("questions", []) + data_tf.get("questions", [])
-        expected_total = num_mcq + num_tf
+# Đề lớn được chia thành nhiều phần ≤ QUIZ_CHUNK_SIZE câu, sinh song song;
+# mỗi phần có budget token riêng để JSON không bị cắt cụt.
+QUIZ_CHUNK_SIZE = max(1, int(os.getenv("QUIZ_CHUNK_SIZE", 10)))
+TOKENS_PER_QUESTION = int(os.getenv("TOKENS_PER_QUESTION", 180))
+PROMPT_TOKEN_OVERHEAD = int(os.getenv("PROMPT_TOKEN_OVERHEAD", 200))
 
-        # 🔧 Nếu thiếu câu hỏi, sinh bổ sung
-        if len(all_questions) < expected_total:
-            missing = expected_total - len(all_questions)
-            app.logger.warning(f"⚠️ Thiếu {missing} câu, sinh bổ sung.")
-            prompt_fix = f"Tạo thêm {missing} câu hỏi cho {subject} lớp {grade} chủ đề {topic}, định dạng JSON như trước."
-            extra = generate_text(prompt_fix)
-            data_extra = safe_parse_json(extra)
-            if data_extra and isinstance(data_extra, dict):
-                all_questions += data_extra.get("questions", [])
 
-        # 🔢 Chuẩn hóa ký hiệu toán học
-        for q in all_questions:
-            for field in ["question", "answer"]:
-                if field in q and isinstance(q[field], str):
-                    q[field] = normalize_math_symbols(q[field])
-            if "options" in q and isinstance(q["options"], list):
-                q["options"] = [normalize_math_symbols(opt) for opt in q["options"]]
+def plan_chunks(kind, total, chunk_size=QUIZ_CHUNK_SIZE):
+    """
+    Chia `total` câu dạng `kind` thành các phần đều nhau, mỗi phần ≤ `chunk_size`
+    câu và trộn đủ các mức độ: 20 MCQ, chunk 8 -> [(3, 2, 2), (3, 2, 2), (2, 2, 2)].
+    """
+    if total <= 0:
+        return []
+    n_chunks = -(-total // chunk_size)
+    counts = [[0] * len(QUIZ_LEVELS) for _ in range(n_chunks)]
+    levels = [lv for lv, n in enumerate(split_by_levels(total, LEVEL_MIX[kind])) for _ in range(n)]
+    for i, lv in enumerate(levels):
+        counts[i % n_chunks][lv] += 1
+    return [tuple(c) for c in counts]
 
-        result = {"questions": all_questions[:expected_total]}
 
-        # 💾 Lưu cache cùng timestamp
-        quiz_cache[cache_key] = {"data": result, "time": time.time()}
+def chunk_token_budget(count):
+    return PROMPT_TOKEN_OVERHEAD + count * TOKENS_PER_QUESTION
 
-        elapsed = round((time.time() - start_time) * 1000)
-        app.logger.info(f"✅ Sinh đề hoàn tất: {len(result['questions'])} câu ({elapsed} ms)")
-        return jsonify(result)
 
-    except MethodNotAllowed:
-        app.logger.warning("⚠️ Method not allowed on /api/generate-quiz")
-        return jsonify({"error": "Method not allowed"}), 405
+def canonical_level(value):
+    """Đưa mức độ model trả về ("Nhận biết", "thông hiểu", "Vận dụng cao"...) về một giá trị trong QUIZ_LEVELS."""
+    v = canonical_text(value)
+    if "nhận biết" in v or "nhan biet" in v:
+        return QUIZ_LEVELS[0]
+    if "vận dụng" in v or "van dung" in v:
+        return QUIZ_LEVELS[2]
+    if "hiểu" in v or "hieu" in v:
+        return QUIZ_LEVELS[1]
+    return None
 
-    except Exception as e:
-        app.logger.error(f"❌ Exception: {e}\n{traceback.format_exc()}")
-        return jsonify({"error": "Internal server error"}), 500
+
+def question_key(q):
+    """Khóa so trùng câu hỏi: nội dung câu hỏi sau canonical_text."""
+    return canonical_text(q.get("question") if isinstance(q, dict) else q)
+
+
+def is_valid_question(q):
+    return (
+        isinstance(q, dict)
+        and isinstance(q.get("question"), str) and q["question"].strip() != ""
+        and isinstance(q.get("options"), list) and len(q["options"]) >= 2
+        and isinstance(q.get("answer"), str) and q["answer"].strip() != ""
+    )
+
+# ---------------------------
+# 🏦 Ngân hàng câu hỏi sinh sẵn
+# ---------------------------
+class QuestionBank(SQLiteStore):
+    """
+    Ngân hàng câu hỏi theo môn × lớp × chủ đề × dạng × mức độ, lưu trong SQLite.
+
+    /api/generate-quiz ghép đề bằng cách lấy ngẫu nhiên từ ngân hàng theo đúng
+    tỉ lệ LEVEL_MIX và chỉ gọi Gemini khi chủ đề đó còn thiếu câu. Warmer nền
+    (QUESTION_BANK_WARMER=1) duyệt topics.json để bổ sung câu hỏi, tối đa
+    `calls_per_hour` lần gọi generate_text mỗi giờ; một khóa thuê (lease) trong
+    SQLite bảo đảm chỉ một worker chạy warmer tại một thời điểm.
+
+    Chỉ ghép đề khi mỗi mức độ có ít nhất `surplus` lần số câu cần: ngân hàng vừa
+    đủ đúng một đề (vd. chỉ chứa đề vừa sinh) thì lần sau sẽ trả lại y hệt đề cũ.
+    """
+
+    def __init__(self, path, topics_file, target=None, batch_size=10, calls_per_hour=60,
+                 lease_ttl=600, idle_interval=1800, surplus=2.0):
+        super().__init__(path)
+        self.topics_file = topics_file
+        self.surplus = max(1.0, surplus)
+        self.target = target or {"mcq": 40, "truefalse": 16}
+        self.batch_size = batch_size
+        self.calls_per_hour = calls_per_hour
+        self.lease_ttl = lease_ttl
+        self.idle_interval = idle_interval
+        self._calls = deque()
+        self._warmer = None
+        self._warmer_lock = threading.Lock()
+
+    def _init_schema(self, conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS question_bank ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " subject TEXT NOT NULL,"
+            " grade TEXT NOT NULL,"
+            " topic TEXT NOT NULL,"
+            " type TEXT NOT NULL,"
+            " level TEXT NOT NULL,"
+            " question_hash TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " UNIQUE (subject, grade, topic, question_hash)"
+            ")"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_question_bank_lookup"
+            " ON question_bank (subject, grade, topic, type, level)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS bank_lease ("
+            " name TEXT PRIMARY KEY,"
+            " owner TEXT NOT NULL,"
+            " expires_at REAL NOT NULL"
+            ")"
+        )
+
+    @staticmethod
+    def _topic_key(subject, grade, topic):
+        return canonical_text(subject), canonical_grade(grade), canonical_text(topic)
+
+    def add(self, subject, grade, topic, kind, questions):
+        """Thêm các câu hợp lệ có mức độ nhận diện được; bỏ qua câu trùng. Trả về số câu đã thêm."""
+        key = self._topic_key(subject, grade, topic)
+        now = time.time()
+        rows = []
+        for q in questions:
+            if not is_valid_question(q):
+                continue
+            level = canonical_level(q.get("level"))
+            if level is None:
+                continue
+            q = dict(q, type=kind, level=level)
+            digest = hashlib.sha1(question_key(q).encode("utf-8")).hexdigest()
+            rows.append((*key, kind, level, digest, json.dumps(q, ensure_ascii=False), now))
+        if not rows:
+            return 0
+        try:
+            with self._transaction() as conn:
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT OR IGNORE INTO question_bank"
+                    " (subject, grade, topic, type, level, question_hash, data, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                return conn.total_changes - before
+        except sqlite3.Error as e:
+            app.logger.warning(f"⚠️ Question bank insert failed: {e}")
+            return 0
+
+    def count_levels(self, subject, grade, topic, kind):
+        rows = self._connect().execute(
+            "SELECT level, COUNT(*) FROM question_bank"
+            " WHERE subject = ? AND grade = ? AND topic = ? AND type = ? GROUP BY level",
+            (*self._topic_key(subject, grade, topic), kind),
+        ).fetchall()
+        return dict(rows)
+
+    def sample(self, subject, grade, topic, kind, count, pick=None):
+        """
+        Lấy ngẫu nhiên `count` câu theo tỉ lệ LEVEL_MIX[kind]; None nếu ngân hàng
+        chưa đủ dư (`surplus`). `pick(candidates, n)` chọn n câu trong các ứng viên
+        của một mức độ (vd. bỏ câu đã phục vụ gần đây); chọn không đủ cũng trả None.
+        """
+        if count <= 0:
+            return []
+        key = self._topic_key(subject, grade, topic)
+        picked = []
+        try:
+            conn = self._connect()
+            for level, n in zip(QUIZ_LEVELS, split_by_levels(count, LEVEL_MIX[kind])):
+                if n == 0:
+                    continue
+                needed = math.ceil(n * self.surplus)
+                rows = conn.execute(
+                    "SELECT data FROM question_bank"
+                    " WHERE subject = ? AND grade = ? AND topic = ? AND type = ? AND level = ?"
+                    " ORDER BY RANDOM() LIMIT ?",
+                    (*key, kind, level, 2 * needed),
+                ).fetchall()
+                if len(rows) < needed:
+                    return None
+                candidates = [loads_json(row[0]) for row in rows]
+                chosen = pick(candidates, n) if pick is not None else candidates[:n]
+                if len(chosen) < n:
+                    return None
+                picked.extend(chosen)
+        except sqlite3.Error as e:
+            app.logger.warning(f"⚠️ Question bank lookup failed: {e}")
+            return None
+        return picked
+
+    # ---- Warmer nền ----
+    def start_warmer(self):
+        # Khởi động trễ (request đầu tiên) để thread được tạo sau khi gunicorn fork worker
+        if self._warmer is not None:
+            return
+        with self._warmer_lock:
+            if self._warmer is None:
+                self._warmer = threading.Thread(target=self._warm_loop, name="question-bank-warmer", daemon=True)
+                self._warmer.start()
+
+    def iter_topics(self):
+        with open(self.topics_file, "r", encoding="utf-8") as f:
+            topics = json.load(f)
+        for subject, grades in topics.items():
+            for grade, names in grades.items():
+                for topic in names:
+                    yield subject, grade, topic
+
+    def warm_once(self):
+        """Một lượt duyệt topics.json, bổ sung các chủ đề chưa đạt `target`. Trả về số câu đã thêm."""
+        added = 0
+        for subject, grade, topic in self.iter_topics():
+            for kind in ("mcq", "truefalse"):
+                while True:
+                    have = self.count_levels(subject, grade, topic, kind)
+                    targets = split_by_levels(self.target[kind], LEVEL_MIX[kind])
+                    need = [max(0, t - have.get(lv, 0)) for lv, t in zip(QUIZ_LEVELS, targets)]
+                    if not any(need):
+                        break
+                    self._wait_for_quota()
+                    if not self._acquire_lease():
+                        return added
+                    batch = min(self.batch_size, sum(need))
+                    levels = [min(n, c) for n, c in zip(need, split_by_levels(batch, [n / sum(need) for n in need]))]
+                    inserted = self._generate_batch(subject, grade, topic, kind, levels)
+                    added += inserted
+                    if not inserted:
+                        break  # Model lỗi hoặc toàn câu trùng -> chuyển sang chủ đề khác
+        return added
+
+    def _generate_batch(self, subject, grade, topic, kind, levels):
+        prompt = build_quiz_prompt(kind, subject, grade, topic, sum(levels), levels=levels)
+        try:
+            questions, _ = extract_questions(generate_text(prompt))
+        except Exception as e:
+            app.logger.warning(f"⚠️ Warmer: sinh câu hỏi thất bại ({subject} {grade} - {topic}): {e}")
+            return 0
+        return self.add(subject, grade, topic, kind, [normalize_question(q) for q in questions])
+
+    def _wait_for_quota(self):
+        while True:
+            now = time.time()
+            while self._calls and now - self._calls[0] >= 3600:
+                self._calls.popleft()
+            if len(self._calls) < self.calls_per_hour:
+                self._calls.append(now)
+                return
+            time.sleep(3600 - (now - self._calls[0]))
+
+    def _acquire_lease(self):
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        now = time.time()
+        try:
+            with self._transaction(immediate=True) as conn:
+                row = conn.execute("SELECT owner, expires_at FROM bank_lease WHERE name = 'warmer'").fetchone()
+                if row and row[0] != owner and row[1] > now:
+                    return False
+                conn.execute(
+                    "INSERT OR REPLACE INTO bank_lease (name, owner, expires_at) VALUES ('warmer', ?, ?)",
+                    (owner, now + self.lease_ttl),
+                )
+                return True
+        except sqlite3.Error as e:
+            app.logger.warning(f"⚠️ Warmer: không lấy được lease: {e}")
+            return False
+
+    def _warm_loop(self):
+        while True:
+            try:
+                added = self.warm_once()
+                if added:
+                    app.logger.info(f"🏦 Warmer đã thêm {added} câu vào ngân hàng câu hỏi.")
+            except Exception as e:
+                app.logger.error(f"❌ Warmer error: {e}\n{traceback.format_exc()}")
+            time.sleep(self.idle_interval)
+
+
+TOPICS_FILE = os.getenv("TOPICS_FILE", os.path.join(BASE_DIR, "..", "data", "topics.json"))
+# Đặt QUESTION_BANK_DB="" để tắt ngân hàng câu hỏi
+QUESTION_BANK_DB = os.getenv("QUESTION_BANK_DB", os.path.join(BASE_DIR, "question_bank.db"))
+QUESTION_BANK_WARMER = os.getenv("QUESTION_BANK_WARMER", "0") == "1"
+question_bank = QuestionBank(
+    QUESTION_BANK_DB,
+    TOPICS_FILE,
+    target={
+        "mcq": int(os.getenv("QUESTION_BANK_TARGET_MCQ", 40)),
+        "truefalse": int(os.getenv("QUESTION_BANK_TARGET_TF", 16)),
+    },
+    batch_size=int(os.getenv("QUESTION_BANK_BATCH_SIZE", 10)),
+    calls_per_hour=int(os.getenv("QUESTION_BANK_CALLS_PER_HOUR", 60)),
+    surplus=float(os.getenv("QUESTION_BANK_SURPLUS", 2)),
+) if QUESTION_BANK_DB else None
+
+
+@app.before_request
+def start_question_bank_warmer():
+    if QUESTION_BANK_WARMER and question_bank is not None and genai is not None and GOOGLE_API_KEY:
+        question_bank.start_warmer()
+
+
+# ---------------------------
+# 🧬 Phát hiện câu hỏi gần trùng (MinHash)
+# ---------------------------
+_SHINGLE_BASE = 1000003
+_MASK32 = 0xFFFFFFFF
+
+
+def _mix32(y):
+    return y ^ (y >> 16)
+
+
+class MinHasher:
+    """
+    Chữ ký MinHash trên các k-shingle ký tự của văn bản đã chuẩn hóa. Hash shingle
+    là đa thức trên mã Unicode (không dùng hash() của Python vốn đổi theo process),
+    nên chữ ký giống nhau giữa các worker và giữa hai cách tính. Mỗi hoán vị là
+    y = (a*h + b) mod 2^32 (a lẻ) rồi trộn y ^ (y >> 16): toàn phép toán uint32,
+    không cần chia lấy dư. Có NumPy thì cả lô được tính trong một phép toán vector,
+    không có thì tính bằng Python thuần.
+    """
+
+    def __init__(self, num_perm=64, shingle=5, seed=26):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.shingle = shingle
+        self.a = [rng.getrandbits(32) | 1 for _ in range(num_perm)]
+        self.b = [rng.getrandbits(32) for _ in range(num_perm)]
+        if np is not None:
+            self._a = np.array(self.a, dtype=np.uint32)[:, None]
+            self._b = np.array(self.b, dtype=np.uint32)[:, None]
+        self._scratch = threading.local()
+
+    def _buffers(self, width):
+        # Ma trận tạm num_perm × số shingle dùng lại theo thread: cấp phát mới mỗi lô tốn hơn cả phép tính.
+        # Cắt từ mảng phẳng để ma trận liền bộ nhớ (cắt cột của ma trận rộng làm lô nhỏ chậm gấp đôi)
+        size = self.num_perm * width
+        bufs = getattr(self._scratch, "bufs", None)
+        if bufs is None or len(bufs[0]) < size:
+            bufs = tuple(np.empty(max(size, self.num_perm * 4096), dtype=np.uint32) for _ in range(2))
+            self._scratch.bufs = bufs
+        return tuple(buf[:size].reshape(self.num_perm, width) for buf in bufs)
+
+    def signatures(self, texts):
+        """Chữ ký của từng văn bản: mảng (len(texts), num_perm) nếu có NumPy, ngược lại list các tuple."""
+        texts = [t.ljust(self.shingle) for t in texts]  # văn bản ngắn hơn k -> một shingle
+        if np is None:
+            return [self._signature_py(t) for t in texts]
+        if not texts:
+            return np.empty((0, self.num_perm), dtype=np.uint32)
+
+        k = self.shingle
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        codes = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        m = len(codes) - k + 1
+        hashes = np.zeros(m, dtype=np.uint64)
+        for i in range(k):
+            hashes = (hashes * _SHINGLE_BASE + codes[i:i + m]) & _MASK32
+        # Bỏ các shingle vắt qua ranh giới hai văn bản
+        owner = np.repeat(np.arange(len(texts)), lengths)
+        hashes = hashes[owner[:m] == owner[k - 1:]].astype(np.uint32)
+        starts = np.concatenate(([0], np.cumsum(lengths - k + 1)[:-1]))
+        permuted, shifted = self._buffers(len(hashes))
+        np.multiply(self._a, hashes, out=permuted)  # uint32 tự quay vòng mod 2^32
+        permuted += self._b
+        np.right_shift(permuted, 16, out=shifted)
+        permuted ^= shifted
+        return np.minimum.reduceat(permuted, starts, axis=1).T
+
+    def _signature_py(self, text):
+        k = self.shingle
+        hashes = set()
+        for i in range(len(text) - k + 1):
+            h = 0
+            for ch in text[i:i + k]:
+                h = (h * _SHINGLE_BASE + ord(ch)) & _MASK32
+            hashes.add(h)
+        return tuple(min(_mix32((a * h + b) & _MASK32) for h in hashes) for a, b in zip(self.a, self.b))
+
+    @staticmethod
+    def matches(sigs, others):
+        """Số hoán vị trùng giá trị giữa từng cặp (Jaccard ≈ matches / num_perm): ma trận (len(sigs), len(others))."""
+        if np is not None:
+            equal = sigs[:, None, :] == others[None, :, :]
+            # Cộng trên byte của mảng bool nhanh gấp đôi bool.sum (không phải đổi kiểu từng phần tử)
+            return equal.view(np.uint8).sum(axis=2, dtype=np.uint16)
+        return [[sum(x == y for x, y in zip(s, o)) for o in others] for s in sigs]
+
+    @staticmethod
+    def low_bytes(sigs):
+        """Byte thấp của chữ ký (b-bit MinHash, b = 8) để sàng trong close: mảng (num_perm, len(sigs)) liền bộ nhớ."""
+        return sigs.T.astype(np.uint8, order="C")
+
+    @staticmethod
+    def close(sigs, others, min_matches, others_low=None):
+        """
+        Ma trận bool (len(sigs), len(others)): cặp có ≥ `min_matches` hoán vị trùng giá trị.
+
+        Với NumPy, so trước trên byte thấp (`others_low`: low_bytes(others) đã tính
+        sẵn, vd. cho lịch sử) - ít bộ nhớ hơn 4 lần so với uint32 - rồi chỉ đếm lại
+        bằng giá trị đầy đủ cho các cặp qua sàng. Hai giá trị bằng nhau thì byte thấp
+        cũng bằng nhau, nên kết quả giống hệt đếm trực tiếp bằng matches.
+        """
+        if np is None:
+            return [[c >= min_matches for c in row] for row in MinHasher.matches(sigs, others)]
+        if others_low is None:
+            others_low = MinHasher.low_bytes(others)
+        # Hoán vị là trục ngoài cùng: cộng từng lớp (len(sigs), len(others)) thay vì hàng nghìn dãy num_perm phần tử
+        equal = MinHasher.low_bytes(sigs)[:, :, None] == others_low[:, None, :]
+        counts = equal.view(np.uint8).sum(axis=0, dtype=np.uint8 if len(others_low) < 256 else np.uint16)
+        close = counts >= min_matches
+        rows, cols = np.nonzero(close)
+        if len(rows):
+            close[rows, cols] = (sigs[rows] == others[cols]).sum(axis=1) >= min_matches
+        return close
+
+    @staticmethod
+    def concat(*groups):
+        if np is not None:
+            return np.concatenate(groups)
+        return [sig for group in groups for sig in group]
+
+
+class ServedQuestions:
+    """Chữ ký các câu đã phục vụ gần đây theo môn × lớp × chủ đề (trong process, LRU theo chủ đề)."""
+
+    def __init__(self, hasher, per_topic=300, max_topics=256):
+        self.hasher = hasher
+        self.per_topic = per_topic
+        self.max_topics = max_topics
+        self._topics = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def topic_key(subject, grade, topic):
+        return canonical_text(subject), canonical_grade(grade), canonical_text(topic)
+
+    def get(self, key):
+        with self._lock:
+            sigs = self._topics.get(key)
+            if sigs is not None:
+                self._topics.move_to_end(key)
+            return sigs
+
+    def add(self, key, questions):
+        sigs = self.hasher.signatures([question_key(q) for q in questions])
+        with self._lock:
+            old = self._topics.pop(key, None)
+            merged = sigs if old is None else MinHasher.concat(old, sigs)
+            self._topics[key] = merged[-self.per_topic:]
+            while len(self._topics) > self.max_topics:
+                self._topics.popitem(last=False)
+
+
+class NearDuplicateFilter:
+    """
+    Lọc câu gần trùng cho một đề: câu có độ tương đồng MinHash ≥ `threshold` với
+    câu đã nhận trong đề bị bỏ; câu chỉ giống câu đã phục vụ trước đó (`history`)
+    được giữ lại riêng để dùng khi sinh bổ sung vẫn không đủ.
+    """
+
+    def __init__(self, hasher, threshold, history=None):
+        self.hasher = hasher
+        self.threshold = threshold
+        self.min_matches = math.ceil(threshold * hasher.num_perm - 1e-9)
+        self.history = history if history is not None and len(history) else None
+        # Byte thấp của lịch sử tính một lần cho cả đề, dùng lại ở mọi chunk và vòng bổ sung
+        self._history_low = MinHasher.low_bytes(self.history) if np is not None and self.history is not None else None
+        self.accepted = hasher.signatures([])
+        self.dropped = 0
+        self.held_back = 0
+
+    def add(self, questions):
+        """Ghi nhận các câu đã có sẵn trong đề (vd. từ ngân hàng) mà không lọc."""
+        if questions:
+            self.accepted = MinHasher.concat(self.accepted, self.hasher.signatures([question_key(q) for q in questions]))
+
+    def filter(self, questions, limit=None, use_history=True):
+        """Trả về (câu nhận, câu chỉ trùng lịch sử); nhận tối đa `limit` câu."""
+        if not questions:
+            return [], []
+        sigs = self.hasher.signatures([question_key(q) for q in questions])
+        # So một lần với cả lô, các câu đã nhận và lịch sử: mỗi lần gọi NumPy có chi phí cố định
+        groups = [sigs, self.accepted]
+        if use_history and self.history is not None:
+            groups.append(self.history)
+        others_low = None
+        if np is not None:
+            others_low = np.concatenate([MinHasher.low_bytes(g) for g in groups[:2]] + [self._history_low][:len(groups) - 2], axis=1)
+        close = MinHasher.close(sigs, MinHasher.concat(*groups), self.min_matches, others_low)
+        n, known = len(sigs), len(sigs) + len(self.accepted)
+        if np is not None:
+            quiz_dup = close[:, n:known].any(axis=1).tolist()
+            history_dup = close[:, known:].any(axis=1).tolist()
+            close = close[:, :n].tolist()
+        else:
+            quiz_dup = [any(row[n:known]) for row in close]
+            history_dup = [any(row[known:]) for row in close]
+
+        accepted, held, taken = [], [], []
+        for i, q in enumerate(questions):
+            if limit is not None and len(accepted) >= limit:
+                break
+            if quiz_dup[i] or any(close[i][j] for j in taken):
+                self.dropped += 1
+            elif history_dup[i]:
+                self.held_back += 1
+                held.append(q)
+            else:
+                taken.append(i)
+                accepted.append(q)
+        if taken:
+            new = sigs[taken] if np is not None else [sigs[i] for i in taken]
+            self.accepted = MinHasher.concat(self.accepted, new)
+        return accepted, held
+
+
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.6))  # Jaccard ước lượng trên 5-shingle ký tự
+minhasher = MinHasher(num_perm=int(os.getenv("DEDUP_PERMUTATIONS", 64)))
+served_questions = ServedQuestions(minhasher, per_topic=int(os.getenv("DEDUP_HISTORY_PER_TOPIC", 300)))
+
+# ---------------------------
+# 🔗 Gộp các lần sinh đề trùng nhau (single-flight)
+# ---------------------------
+class SingleFlight:
+    """
+    Gộp các lời gọi cùng khóa đang chạy dở: lời gọi đầu tiên thực thi, các lời
+    gọi đến sau trong lúc đó chờ chung một Future và nhận cùng kết quả (hoặc
+    cùng exception).
+    """
+
+    def __init__(self, wait_timeout=60):
+        self.wait_timeout = wait_timeout
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def begin(self, key):
+        """Trả về (future, leader). Leader phải gọi finish(key, ...) khi xong, kể cả khi lỗi."""
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is None:
+                fut = self._inflight[key] = Future()
+                self.leaders += 1
+                return fut, True
+            self.coalesced += 1
+            return fut, False
+
+    def finish(self, key, result=None, error=None):
+        with self._lock:
+            fut = self._inflight.pop(key, None)
+        if fut is None or fut.done():
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+    def wait(self, fut, deadline=None):
+        """Chờ kết quả của leader, không quá wait_timeout và `deadline` của người chờ."""
+        app.logger.info("🔗 Chờ chung đề đang được sinh cho yêu cầu giống hệt.")
+        timeout = self.wait_timeout if deadline is None else deadline.cap(self.wait_timeout)
+        try:
+            return fut.result(timeout=timeout)
+        except FuturesTimeout:
+            raise DeadlineExceeded("❌ Hết thời gian chờ đề đang được sinh.")
+
+    def run(self, key, fn, *args, deadline=None, **kwargs):
+        """
+        Như fn(*args, deadline=deadline, **kwargs), nhưng gộp các lời gọi cùng `key`
+        đang chạy dở. Trả về (kết quả, leader): leader=False nếu chỉ chờ chung.
+        """
+        fut, leader = self.begin(key)
+        if not leader:
+            return self.wait(fut, deadline), False
+        try:
+            result = fn(*args, deadline=deadline, **kwargs)
+        except BaseException as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result, True
+
+    def running(self, key):
+        """True nếu đang có lời gọi cùng `key` chạy dở (yêu cầu đến lúc này sẽ chờ chung)."""
+        with self._lock:
+            return key in self._inflight
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._inflight), "leaders": self.leaders, "coalesced": self.coalesced}
+
+
+quiz_inflight = SingleFlight(wait_timeout=float(os.getenv("QUIZ_INFLIGHT_WAIT", 60)))
+
+
+class AIServiceUnavailable(Exception):
+    """Cần gọi model nhưng genai hoặc GOOGLE_API_KEY chưa được cấu hình."""
+
+# ---------------------------
+# 🧠 Sinh một đề hoàn chỉnh
+# ---------------------------
+QUIZ_DEADLINE = float(os.getenv("QUIZ_DEADLINE", 50))  # giây tối đa cho cả một request sinh đề (kể cả bổ sung)
+QUIZ_CHUNK_TIMEOUT = float(os.getenv("QUIZ_CHUNK_TIMEOUT", 25))  # giây chờ lượt sinh đầu tiên
+QUIZ_TOPUP_ROUNDS = int(os.getenv("QUIZ_TOPUP_ROUNDS", 2))
+
+
+def _submit_chunks(subject, grade, topic, shortfall, deadline, hedges):
+    """Gửi song song các chunk cho số câu cần sinh của từng dạng; trả về {future: (part, count)}."""
+    futures = {}
+    for part, total in shortfall.items():
+        for levels in plan_chunks(part, total):
+            count = sum(levels)
+            prompt = build_quiz_prompt(part, subject, grade, topic, count, levels=levels)
+            fut = submit_generation(prompt, max_output_tokens=chunk_token_budget(count), deadline=deadline, hedges=hedges)
+            futures[fut] = (part, count)
+    return futures
+
+
+def _iter_chunk_results(futures, dedupe, held_back, deadline, errors):
+    """
+    Yield (part, [câu hỏi]) cho từng chunk xong trước `deadline` (Deadline),
+    đã chuẩn hóa và lọc câu gần trùng qua `dedupe` (câu chỉ trùng lịch sử được thêm
+    vào held_back[part]). Chunk lỗi bị bỏ qua, chunk quá hạn bị hủy; lỗi của chúng
+    được thêm vào `errors`.
+    """
+    try:
+        for fut in as_completed(futures, timeout=deadline.remaining()):
+            part, count = futures[fut]
+            try:
+                parsed, stats = extract_questions(fut.result())
+            except Exception as e:
+                # Một chunk lỗi không làm hỏng cả đề: phần thiếu sẽ được sinh bổ sung
+                app.logger.warning(f"⚠️ Chunk {part} ({count} câu) thất bại: {e}")
+                metrics.inc("quiz_chunks_total", outcome="timeout" if isinstance(e, DeadlineExceeded) else "failed")
+                errors.append(e)
+                continue
+            if stats["dropped"] or stats["repaired"]:
+                app.logger.info(f"🩹 Chunk {part}: {stats['recovered']} câu ({stats['repaired']} đã sửa), bỏ {stats['dropped']} object hỏng")
+                metrics.inc("quiz_parse_failures_total", stats["dropped"], reason="dropped")
+                metrics.inc("quiz_parse_repairs_total", stats["repaired"])
+            if not parsed:
+                metrics.inc("quiz_parse_failures_total", reason="no_questions")
+            metrics.inc("quiz_chunks_total", outcome="ok" if parsed else "empty")
+            # 🔢 Chuẩn hóa ký hiệu toán học (câu từ ngân hàng đã được chuẩn hóa khi lưu)
+            questions, held = dedupe.filter([normalize_question(q) for q in parsed], limit=count)
+            held_back[part] += held
+            yield part, questions
+    except FuturesTimeout:
+        stragglers = sum(not fut.done() for fut in futures)
+        app.logger.warning(f"⏱️ {stragglers} chunk quá hạn, bỏ qua.")
+        metrics.inc("quiz_chunks_total", stragglers, outcome="timeout")
+        errors.append(DeadlineExceeded(f"❌ {stragglers} chunk chưa xong khi hết hạn."))
+    finally:
+        # Quá hạn hoặc client ngắt stream -> hủy các lời gọi model còn dở
+        for fut in futures:
+            fut.cancel()
+
+
+def iter_quiz_generation(subject, grade, topic, num_mcq, num_tf, cache_key, force_regen=False, deadline=None):
+    """
+    Sinh một đề (ngân hàng câu hỏi -> Gemini theo từng chunk song song -> bổ sung
+    phần còn thiếu) và yield từng phần ngay khi phần đó đã được parse và chuẩn hóa:
+
+        ("mcq" | "truefalse", [câu hỏi...])  ... rồi cuối cùng ("done", result)
+
+    Mọi bước dừng trước `deadline` (Deadline, mặc định QUIZ_DEADLINE giây). Hết
+    hạn mà chưa đủ câu thì `result` ({"questions": [...], "partial": True,
+    "missing": {...}}) chứa các câu hợp lệ đã có và không được lưu cache; đề đủ
+    câu có "partial": False và đã được lưu cache. Ném AIServiceUnavailable nếu cần
+    gọi model mà chưa cấu hình, DeadlineExceeded nếu hết hạn khi chưa có câu nào.
+    """
+    start_time = time.time()
+    deadline = deadline or Deadline(QUIZ_DEADLINE)
+
+    # 🧬 Bỏ câu gần trùng trong đề; câu giống câu đã phục vụ trước đó cho chủ đề này thì để dành
+    topic_key = ServedQuestions.topic_key(subject, grade, topic)
+    dedupe = NearDuplicateFilter(minhasher, DEDUP_THRESHOLD, history=served_questions.get(topic_key))
+
+    # 🏦 Ghép đề từ ngân hàng câu hỏi (phần nào đủ câu thì không cần gọi model), bỏ câu đã phục vụ gần đây
+    bank_mcq = bank_tf = None
+    if question_bank is not None and not force_regen:
+        def sample_bank(kind, count):
+            # Bộ lọc riêng cho lần chọn: ngân hàng không đủ thì không để lại dấu vết trong dedupe
+            chooser = NearDuplicateFilter(minhasher, DEDUP_THRESHOLD, history=dedupe.history)
+            questions = question_bank.sample(subject, grade, topic, kind, count,
+                                             pick=lambda candidates, n: chooser.filter(candidates, limit=n)[0])
+            if questions:
+                dedupe.add(questions)
+            return questions
+
+        bank_mcq = sample_bank("mcq", num_mcq)
+        bank_tf = sample_bank("truefalse", num_tf)
+        if bank_mcq is not None and bank_tf is not None:
+            result = {"questions": bank_mcq + bank_tf, "partial": False}
+            store_cached_quiz(cache_key, result)
+            served_questions.add(topic_key, result["questions"])
+            elapsed = round((time.time() - start_time) * 1000)
+            app.logger.info(f"🏦 Ghép đề từ ngân hàng câu hỏi: {len(result['questions'])} câu ({elapsed} ms)")
+            yield "mcq", bank_mcq
+            yield "truefalse", bank_tf
+            yield "done", result
+            return
+
+    # Nếu client gọi mà không có client AI config -> trả lỗi rõ
+    if genai is None or not GOOGLE_API_KEY:
+        raise AIServiceUnavailable()
+
+    targets = {"mcq": num_mcq, "truefalse": num_tf}
+    parts = {"mcq": [], "truefalse": []}
+    generated = {"mcq": [], "truefalse": []}
+    held_back = {"mcq": [], "truefalse": []}
+    for part, questions in (("mcq", bank_mcq), ("truefalse", bank_tf)):
+        if questions is not None:
+            parts[part] = questions
+            yield part, questions
+
+    # 🧠 Sinh song song từng chunk (≤ QUIZ_CHUNK_SIZE câu) của phần ngân hàng chưa đủ, chunk nào
+    # xong trước trả trước; 🔧 sau đó chỉ sinh bổ sung đúng dạng còn thiếu (giữ câu đã có)
+    # cho tới khi đủ, hết QUIZ_TOPUP_ROUNDS vòng hoặc hết QUIZ_DEADLINE
+    errors = []
+    topup_rounds = 0
+    first_round = True
+    hedges = HedgeBudget()
+    while True:
+        shortfall = {part: total - len(parts[part]) for part, total in targets.items()}
+        shortfall = {part: n for part, n in shortfall.items() if n > 0}
+        if not shortfall:
+            break
+        if first_round:
+            round_deadline = deadline.within(QUIZ_CHUNK_TIMEOUT)
+            first_round = False
+        else:
+            if topup_rounds >= QUIZ_TOPUP_ROUNDS or deadline.expired():
+                break
+            topup_rounds += 1
+            metrics.inc("quiz_topup_rounds_total", part=",".join(sorted(shortfall)))
+            round_deadline = deadline
+            app.logger.warning(f"⚠️ Thiếu {shortfall}, sinh bổ sung (vòng {topup_rounds}).")
+
+        futures = _submit_chunks(subject, grade, topic, shortfall, round_deadline, hedges)
+        if len(futures) > 2:
+            app.logger.info(f"🧩 Chia {shortfall} thành {len(futures)} chunk sinh song song")
+        for part, questions in _iter_chunk_results(futures, dedupe, held_back, round_deadline, errors):
+            questions = questions[:targets[part] - len(parts[part])]
+            parts[part] = parts[part] + questions
+            generated[part] += questions
+            yield part, questions
+
+    # Hết vòng bổ sung mà vẫn thiếu -> dùng câu đã để dành (chỉ trùng với đề cũ, không trùng trong đề)
+    for part, n in shortfall.items():
+        questions, _ = dedupe.filter(held_back[part], limit=n, use_history=False)
+        if questions:
+            parts[part] = parts[part] + questions
+            generated[part] += questions
+            yield part, questions
+    shortfall = {part: total - len(parts[part]) for part, total in targets.items() if len(parts[part]) < total}
+
+    if errors and not parts["mcq"] and not parts["truefalse"]:
+        raise next((e for e in errors if isinstance(e, DeadlineExceeded)), errors[0])
+
+    # 🏦 Bổ sung câu vừa sinh vào ngân hàng
+    if question_bank is not None:
+        for part, questions in generated.items():
+            if questions:
+                question_bank.add(subject, grade, topic, part, questions)
+
+    # ⏳ Thiếu câu (hết hạn / model lỗi) -> trả các câu hợp lệ đã có kèm cờ partial thay vì lỗi
+    result = {"questions": parts["mcq"] + parts["truefalse"], "partial": bool(shortfall)}
+    if shortfall:
+        result["missing"] = shortfall
+        metrics.inc("quiz_partial_total")
+    else:
+        # 💾 Lưu cache cùng timestamp (đề thiếu câu không được cache để lần sau sinh lại)
+        store_cached_quiz(cache_key, result)
+    served_questions.add(topic_key, result["questions"])
+
+    if dedupe.dropped:
+        metrics.inc("quiz_near_duplicates_total", dedupe.dropped)
+    if HEDGE_REQUESTS:
+        metrics.observe("quiz_hedges_per_request", hedges.fired)
+    elapsed = round((time.time() - start_time) * 1000)
+    app.logger.info(
+        f"✅ Sinh đề hoàn tất: {len(result['questions'])} câu, {topup_rounds} vòng bổ sung"
+        + (f", bỏ {dedupe.dropped} câu gần trùng" if dedupe.dropped else "")
+        + (f", {hedges.fired} hedge" if hedges.fired else "")
+        + (f", còn thiếu {shortfall}" if shortfall else "") + f" ({elapsed} ms)"
+    )
+    yield "done", result
+
+
+def generate_quiz(subject, grade, topic, num_mcq, num_tf, cache_key, force_regen=False, deadline=None):
+    """Sinh một đề và trả về {"questions": [...], "partial": bool, ...} (xem iter_quiz_generation)."""
+    for part, payload in iter_quiz_generation(subject, grade, topic, num_mcq, num_tf, cache_key, force_regen, deadline):
+        if part == "done":
+            return payload
+
+# ---------------------------
+# 📥 Đọc payload yêu cầu sinh đề
+# ---------------------------
+def read_json_payload():
+    # Body JSON (kể cả thiếu Content-Type) hoặc MessagePack nếu Content-Type là application/x-msgpack
+    raw = request.get_data(cache=True)
+    if not raw:
+        return {}
+    try:
+        if request.mimetype == MSGPACK_MIMETYPE and msgpack is not None:
+            data = loads_msgpack(raw)
+        else:
+            data = loads_json(raw)
+    except Exception:
+        data = {}
+    # Không phải object -> coi như rỗng
+    return data if isinstance(data, dict) else {}
+
+
+# Client gửi timeout của mình qua X-Request-Timeout (giây): backend dừng sớm hơn một khoảng
+# REQUEST_DEADLINE_MARGIN để kịp trả các câu đã có thay vì bị client cắt kết nối
+REQUEST_DEADLINE_MARGIN = float(os.getenv("REQUEST_DEADLINE_MARGIN", 3))
+
+
+def request_deadline(seconds=None):
+    """Deadline của request hiện tại: `seconds` (mặc định QUIZ_DEADLINE), rút ngắn theo X-Request-Timeout nếu client gửi."""
+    seconds = QUIZ_DEADLINE if seconds is None else seconds
+    try:
+        client_timeout = float(request.headers.get("X-Request-Timeout", ""))
+    except ValueError:
+        client_timeout = 0
+    if client_timeout > 0:
+        seconds = min(seconds, max(1.0, client_timeout - REQUEST_DEADLINE_MARGIN))
+    return Deadline(seconds)
+
+
+# Giới hạn kích thước đề để một request không chiếm hết executor/quota model
+QUIZ_MAX_MCQ = int(os.getenv("QUIZ_MAX_MCQ", 50))
+QUIZ_MAX_TF = int(os.getenv("QUIZ_MAX_TF", 20))
+
+
+class InvalidQuizRequest(ValueError):
+    """Payload sinh đề không hợp lệ (trả 400 kèm thông báo)."""
+
+
+def _parse_count(data, field, default, maximum):
+    # Không gửi / null / chuỗi rỗng -> dùng default; giá trị đã gửi đều được kiểm tra, 0 = bỏ phần này
+    value = data.get(field)
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        raise InvalidQuizRequest(f"{field} phải là số nguyên")
+    try:
+        count = int(value)
+    except (ValueError, TypeError):
+        raise InvalidQuizRequest(f"{field} phải là số nguyên")
+    if isinstance(value, float) and value != count:
+        raise InvalidQuizRequest(f"{field} phải là số nguyên")
+    if not 0 <= count <= maximum:
+        raise InvalidQuizRequest(f"{field} phải trong khoảng 0..{maximum}")
+    return count
+
+
+def _parse_text(data, field, allow_int=False):
+    # Không gửi / null -> chuỗi rỗng; kiểu khác chuỗi (số, list, object...) -> 400 thay vì 500
+    value = data.get(field)
+    if value is None:
+        return ""
+    if allow_int and isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    if not isinstance(value, str):
+        raise InvalidQuizRequest(f"{field} phải là chuỗi")
+    return value
+
+
+def parse_quiz_request(data):
+    """Trả về (subject, grade, topic, num_mcq, num_tf, force_regen) từ payload; ném InvalidQuizRequest nếu sai."""
+    subject = _parse_text(data, "subject")
+    grade = _parse_text(data, "grade", allow_int=True)  # frontend cũ có thể gửi lớp dạng số
+    topic = _parse_text(data, "topic").strip()
+    # Thiếu môn/chủ đề thì đề sinh ra vô nghĩa mà vẫn tốn quota model
+    if not subject.strip() or not topic:
+        raise InvalidQuizRequest("Thiếu subject hoặc topic")
+
+    # Parse numbers an toàn (nếu frontend không gửi, dùng default)
+    num_mcq = _parse_count(data, "num_mcq", 10, QUIZ_MAX_MCQ)
+    num_tf = _parse_count(data, "num_tf", 4, QUIZ_MAX_TF)
+    # Đề chỉ trắc nghiệm hoặc chỉ Đúng/Sai được; đề không có câu nào thì không
+    if num_mcq + num_tf == 0:
+        raise InvalidQuizRequest("num_mcq và num_tf không được cùng bằng 0")
+
+    force_regen = bool(data.get("force_regen", False))
+    return subject, grade, topic, num_mcq, num_tf, force_regen
+
+# ---------------------------
+# 🚦 Giới hạn tải: admission control & rate limit theo client
+# ---------------------------
+# Chỉ áp dụng cho yêu cầu phải sinh đề; cache hit trả ngay, không tốn lượt.
+class RequestRejected(Exception):
+    """Từ chối nhanh thay vì để request chờ tới timeout: 429 (vượt rate limit) hoặc 503 (server quá tải)."""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(f"{reason} (thử lại sau {retry_after} s)")
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ClientRateLimiter:
+    """
+    Token bucket cho từng client: `rate` lượt/giây, tích tối đa `burst` lượt.
+    Giữ tối đa `max_clients` bucket gần nhất (LRU); rate <= 0 thì không giới hạn.
+    """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # client -> [số lượt còn, thời điểm cập nhật]
+        self._lock = threading.Lock()
+
+    def acquire(self, client):
+        """Trừ một lượt của `client`; ném RequestRejected(429) nếu đã hết."""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client, None) or [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets[client] = bucket
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return
+            wait = (1 - bucket[0]) / self.rate
+        raise RequestRejected(429, "rate_limited", math.ceil(wait))
+
+
+class AdmissionController:
+    """
+    Giới hạn số lần sinh đề chạy đồng thời (`max_concurrent`). Yêu cầu vượt mức
+    xếp hàng (tối đa `max_queue`) và chờ không quá `max_wait` giây; hàng đầy hoặc
+    chờ quá lâu thì ném RequestRejected(503) kèm Retry-After ước lượng từ thời gian
+    sinh đề trung bình.
+    """
+
+    def __init__(self, max_concurrent, max_queue, max_wait):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting = 0
+        self.avg_duration = 5.0  # EWMA thời gian giữ một lượt (giây)
+        self._cond = threading.Condition()
+
+    def retry_after(self):
+        # Số "lượt" phía trước chia cho số lượt chạy song song, nhân thời gian trung bình
+        ahead = (self.active + self.waiting + 1) / self.max_concurrent
+        return max(1, math.ceil(ahead * self.avg_duration))
+
+    @contextmanager
+    def slot(self, deadline=None, max_wait=None):
+        """Giữ một lượt trong khối `with`; `max_wait` thay cho self.max_wait (vd. batch chờ được lâu hơn)."""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        with self._cond:
+            if self.active >= self.max_concurrent:
+                if self.waiting >= self.max_queue:
+                    raise RequestRejected(503, "overloaded", self.retry_after())
+                wait = max_wait if deadline is None else deadline.cap(max_wait)
+                self.waiting += 1
+                try:
+                    admitted = self._cond.wait_for(lambda: self.active < self.max_concurrent, timeout=wait)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    raise RequestRejected(503, "queue_timeout", self.retry_after())
+            self.active += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active -= 1
+                self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - started)
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {"active": self.active, "waiting": self.waiting, "max_concurrent": self.max_concurrent}
+
+
+def _env_set(name):
+    return {k.strip() for k in os.getenv(name, "").split(",") if k.strip()}
+
+
+# RATE_LIMIT_PER_MINUTE=0 tắt rate limit. Khóa client là IP; X-API-Key chỉ được dùng làm khóa
+# riêng khi nằm trong RATE_LIMIT_API_KEYS (key lạ -> vẫn tính theo IP, đổi key không lách được).
+# Frontend dùng chung (Streamlit: mọi học sinh cùng một IP) gửi một key trong RATE_LIMIT_TRUSTED_KEYS
+# kèm X-Client-Id của từng phiên -> mỗi học sinh một bucket riêng thay vì cả lớp chung một bucket.
+# RATE_LIMIT_TRUST_PROXY=N: chạy sau N proxy -> ProxyFix lấy IP do proxy ngoài cùng ghi vào
+# X-Forwarded-For (không lấy mục đầu tiên, vì client tự đặt được)
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", 20))
+RATE_LIMIT_TRUST_PROXY = int(os.getenv("RATE_LIMIT_TRUST_PROXY", 0))
+RATE_LIMIT_API_KEYS = _env_set("RATE_LIMIT_API_KEYS")
+RATE_LIMIT_TRUSTED_KEYS = _env_set("RATE_LIMIT_TRUSTED_KEYS")
+if RATE_LIMIT_TRUST_PROXY > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=RATE_LIMIT_TRUST_PROXY)
+rate_limiter = ClientRateLimiter(RATE_LIMIT_PER_MINUTE / 60, burst=float(os.getenv("RATE_LIMIT_BURST", 5)))
+# Sinh bất đồng bộ chỉ tốn một coroutine mỗi lời gọi model nên cho chạy hàng chục đề cùng lúc;
+# đường đồng bộ bị giới hạn bởi số worker của executor. Chờ lượt tối đa nửa QUIZ_DEADLINE
+# (một đề mất vài chục giây, chờ 5 s thì hàng đợi gần như luôn hết hạn)
+QUIZ_MAX_CONCURRENT = int(os.getenv("QUIZ_MAX_CONCURRENT", 32 if async_generation_enabled() else 4))
+admission = AdmissionController(
+    max_concurrent=QUIZ_MAX_CONCURRENT,
+    max_queue=int(os.getenv("QUIZ_ADMISSION_QUEUE", 2 * QUIZ_MAX_CONCURRENT)),
+    max_wait=float(os.getenv("QUIZ_ADMISSION_WAIT", QUIZ_DEADLINE / 2)),
+)
+
+metrics.counter("quiz_rejected_total", "Số yêu cầu sinh đề bị từ chối, theo lý do (rate_limited, overloaded, queue_timeout).")
+metrics.gauge("quiz_admission_active", "Số lần sinh đề đang chạy.")
+metrics.gauge("quiz_admission_waiting", "Số yêu cầu đang xếp hàng chờ sinh đề.")
+
+
+@metrics.collector
+def _admission_metrics():
+    stats = admission.stats()
+    yield "quiz_admission_active", {}, stats["active"]
+    yield "quiz_admission_waiting", {}, stats["waiting"]
+
+
+def client_key():
+    api_key = request.headers.get("X-API-Key")
+    if api_key in RATE_LIMIT_TRUSTED_KEYS:
+        client_id = request.headers.get("X-Client-Id")
+        if client_id:
+            return "client:" + hashlib.sha256(client_id.encode("utf-8")).hexdigest()[:16]
+    if api_key in RATE_LIMIT_API_KEYS or api_key in RATE_LIMIT_TRUSTED_KEYS:
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    # remote_addr đã được ProxyFix thay bằng IP thật khi bật RATE_LIMIT_TRUST_PROXY
+    return f"ip:{request.remote_addr}"
+
+
+def charge_rate_limit(*pending):
+    """
+    Trừ một lượt rate limit của client nếu ít nhất một đề trong `pending`
+    ((cache_key, force_regen), ...) phải sinh mới. Yêu cầu chỉ chờ chung lần sinh
+    đang chạy (single-flight) không tốn quota model nên không bị tính lượt.
+    """
+    if any(force_regen or not quiz_inflight.running(key) for key, force_regen in pending):
+        rate_limiter.acquire(client_key())
+
+
+def admitted(fn, wait_for_deadline=False):
+    """
+    Bọc hàm sinh đề: chỉ chạy khi admission còn lượt. Thời gian chờ lượt là
+    QUIZ_ADMISSION_WAIT, hoặc tới hết `deadline` nếu wait_for_deadline (batch).
+    """
+    def wrapper(*args, deadline=None, **kwargs):
+        max_wait = deadline.remaining() if wait_for_deadline and deadline is not None else None
+        with admission.slot(deadline, max_wait=max_wait):
+            return fn(*args, deadline=deadline, **kwargs)
+    return wrapper
+
+
+def rejected_response(error):
+    app.logger.warning(f"🚦 Từ chối yêu cầu sinh đề: {error}")
+    metrics.inc("quiz_rejected_total", reason=error.reason)
+    response = jsonify({"error": "Too many requests" if error.status == 429 else "Server busy",
+                        "retry_after": error.retry_after})
+    response.status_code = error.status
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+# ---------------------------
+# 🧩 API sinh đề trắc nghiệm (bản có TTL + force_regen)
+# ---------------------------
+def observe_quiz_request(endpoint, source, started):
+    metrics.observe("quiz_request_duration_seconds", time.monotonic() - started, endpoint=endpoint, source=source)
+
+
+# Body nhỏ hơn ngưỡng này thì nén không đáng (header + CPU)
+QUIZ_COMPRESS_MIN_BYTES = int(os.getenv("QUIZ_COMPRESS_MIN_BYTES", 1024))
+metrics.counter("quiz_not_modified_total", "Số response 304 (client đã có đúng đề theo ETag).")
+metrics.counter("quiz_response_bytes_total", "Số byte body đề đã gửi, theo Content-Encoding.")
+
+
+def negotiate_encoding(size):
+    """Content-Encoding tốt nhất mà client chấp nhận (br > gzip) theo Accept-Encoding."""
+    if size < QUIZ_COMPRESS_MIN_BYTES:
+        return "identity"
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered) or "identity"
+
+
+def encoded_result(cache_key, result):
+    """EncodedQuiz của đề vừa sinh: dùng lại mục cache nếu chính đề này vừa được lưu, khỏi serialize lại."""
+    entry = quiz_cache.peek(cache_key)
+    return entry if entry is not None and entry.data is result else EncodedQuiz(result)
+
+
+def quiz_response(quiz, source, started, force_regen=False):
+    """
+    Response cho một đề (EncodedQuiz): JSON hoặc MessagePack theo Accept, ETag
+    theo nội dung, body nén theo Accept-Encoding (các bản đã serialize/nén được
+    giữ cùng mục cache). 304 nếu If-None-Match khớp, chỉ với GET/HEAD (RFC 9110;
+    POST bỏ qua header) và không áp dụng cho force_regen.
+    """
+    # X-Quiz-Source: "cache" | "generated" | "shared" (chờ chung lần sinh giống hệt) -> load test đo cache hit
+    observe_quiz_request("generate-quiz", source, started)
+    mimetype = negotiate_format()
+    etag = quiz.etag_for(mimetype)
+    conditional = request.method in ("GET", "HEAD") and not force_regen
+    if conditional and request.if_none_match.contains_weak(etag):
+        metrics.inc("quiz_not_modified_total")
+        response = Response(status=304)
+    else:
+        encoding = negotiate_encoding(len(quiz.body))
+        body = quiz.encode(encoding, mimetype)
+        metrics.inc("quiz_response_bytes_total", len(body), encoding=encoding)
+        response = Response(body, mimetype=mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept")
+    response.vary.add("Accept-Encoding")
+    response.headers["X-Quiz-Source"] = source
+    return response
+
+
+def quiz_request_payload():
+    # GET (tham số trên URL) để trình duyệt/proxy dùng lại đề theo ETag; POST gửi JSON như trước
+    if request.method not in ("GET", "HEAD"):
+        return read_json_payload()
+    data = request.args.to_dict()
+    data["force_regen"] = data.get("force_regen", "").lower() in ("1", "true", "yes")
+    return data
+
+
+@app.route("/api/generate-quiz", methods=["GET", "POST", "OPTIONS"])
+def api_generate_quiz():
+    """
+    Sinh (hoặc lấy từ cache) một đề. Nhận POST JSON hoặc GET với cùng tham số
+    trên URL. Response có ETag theo nội dung: GET gửi lại If-None-Match thì nhận
+    304 nếu đề không đổi; POST và force_regen luôn nhận body đầy đủ.
+    """
+    started = time.monotonic()
+    try:
+        deadline = request_deadline()
+        subject, grade, topic, num_mcq, num_tf, force_regen = parse_quiz_request(quiz_request_payload())
+        annotate_access_log(subject=subject, grade=grade, topic=topic, num_mcq=num_mcq, num_tf=num_tf, force_regen=force_regen)
+
+        cache_key = QuizCache.make_key(subject, grade, topic, num_mcq, num_tf)
+
+        # ⚡ Kiểm tra cache
+        cached = None if force_regen else get_cached_encoded(cache_key)
+        if cached is not None:
+            return quiz_response(cached, "cache", started)
+
+        # 🚦 Cache miss: chỉ lần sinh thật (leader) mới tính vào rate limit và chiếm lượt admission
+        charge_rate_limit((cache_key, force_regen))
+
+        # 🔗 Yêu cầu giống hệt đang sinh dở thì chờ chung kết quả (force_regen luôn sinh mới)
+        if force_regen:
+            result = admitted(generate_quiz)(subject, grade, topic, num_mcq, num_tf, cache_key, force_regen=True,
+                                             deadline=deadline)
+            return quiz_response(encoded_result(cache_key, result), "generated", started, force_regen=True)
+        result, leader = quiz_inflight.run(cache_key, admitted(generate_quiz), subject, grade, topic, num_mcq, num_tf, cache_key,
+                                           deadline=deadline)
+        return quiz_response(encoded_result(cache_key, result), "generated" if leader else "shared", started)
+
+    except InvalidQuizRequest as e:
+        return jsonify({"error": str(e)}), 400
+
+    except RequestRejected as e:
+        observe_quiz_request("generate-quiz", "rejected", started)
+        return rejected_response(e)
+
+    except DeadlineExceeded as e:
+        app.logger.warning(f"⏱️ {e}")
+        observe_quiz_request("generate-quiz", "timeout", started)
+        return jsonify({"error": "Quiz generation timed out", "questions": [], "partial": True}), 504
+
+    except AIServiceUnavailable:
+        app.logger.error("AI client not configured (genai or GOOGLE_API_KEY missing).")
+        return jsonify({"error": "AI service not configured"}), 503
+
+    except MethodNotAllowed:
+        app.logger.warning("⚠️ Method not allowed on /api/generate-quiz")
+        return jsonify({"error": "Method not allowed"}), 405
+
+    except Exception as e:
+        app.logger.error(f"❌ Exception: {e}\n{traceback.format_exc()}")
+        observe_quiz_request("generate-quiz", "error", started)
+        return jsonify({"error": "Internal server error"}), 500
+
+# ---------------------------
+# 📡 API sinh đề dạng stream (NDJSON)
+# ---------------------------
+def _ndjson(event):
+    return dumps_json(event) + b"\n"
+
+
+def stream_framing():
+    """
+    (mimetype, hàm đóng khung một sự kiện) theo Accept: NDJSON mặc định, hoặc
+    chuỗi object MessagePack nối tiếp nhau (tự phân tách, không cần ký tự xuống dòng).
+    """
+    if msgpack is not None and request.accept_mimetypes.best_match(
+            ["application/x-ndjson", MSGPACK_MIMETYPE], default="application/x-ndjson") == MSGPACK_MIMETYPE:
+        return MSGPACK_MIMETYPE, dumps_msgpack
+    return "application/x-ndjson", _ndjson
+
+
+@app.route("/api/generate-quiz/stream", methods=["POST", "OPTIONS"])
+def api_generate_quiz_stream():
+    """
+    Như /api/generate-quiz nhưng trả về NDJSON, mỗi dòng một sự kiện:
+
+    - {"event": "questions", "part": "mcq" | "truefalse", "questions": [...]}
+      gửi ngay khi từng chunk (kể cả chunk bổ sung) đã được parse và chuẩn hóa;
+    - {"event": "done", "source": ..., "total": n, "partial": bool, "elapsed_ms": ..., "questions": [...]}
+      chứa đề hoàn chỉnh (đúng thứ tự, đã cắt đủ số câu); hết hạn mà chưa đủ câu thì
+      "partial" là true, kèm "missing" = số câu còn thiếu của từng dạng;
+    - {"event": "error", "error": "..."} nếu có lỗi ("retry_after" nếu server quá tải).
+
+    Vượt rate limit thì trả 429 (Retry-After) trước khi mở stream. Gửi
+    Accept: application/x-msgpack để nhận cùng các sự kiện dạng MessagePack.
+    """
+    start_time = time.time()
+    started = time.monotonic()
+    deadline = request_deadline()
+    try:
+        subject, grade, topic, num_mcq, num_tf, force_regen = parse_quiz_request(read_json_payload())
+    except InvalidQuizRequest as e:
+        return jsonify({"error": str(e)}), 400
+    annotate_access_log(subject=subject, grade=grade, topic=topic, num_mcq=num_mcq, num_tf=num_tf, force_regen=force_regen)
+    cache_key = QuizCache.make_key(subject, grade, topic, num_mcq, num_tf)
+
+    # ⚡ Kiểm tra cache trước khi mở stream: chỉ cache miss phải sinh mới (không chờ chung) tính vào rate limit
+    cached_data = None if force_regen else get_cached_quiz(cache_key)
+    if cached_data is None:
+        try:
+            charge_rate_limit((cache_key, force_regen))
+        except RequestRejected as e:
+            observe_quiz_request("generate-quiz-stream", "rejected", started)
+            return rejected_response(e)
+    mimetype, frame = stream_framing()
+
+    def done(result, source):
+        observe_quiz_request("generate-quiz-stream", source, started)
+        event = {
+            "event": "done",
+            "source": source,
+            "total": len(result["questions"]),
+            "partial": result.get("partial", False),
+            "elapsed_ms": round((time.time() - start_time) * 1000),
+            "questions": result["questions"],
+        }
+        if result.get("missing"):
+            event["missing"] = result["missing"]
+        return frame(event)
+
+    def events():
+        try:
+            if cached_data is not None:
+                yield done(cached_data, "cache")
+                return
+
+            # 🔗 Yêu cầu giống hệt đang sinh dở thì chờ chung kết quả
+            leader = True
+            if not force_regen:
+                fut, leader = quiz_inflight.begin(cache_key)
+                if not leader:
+                    yield done(quiz_inflight.wait(fut, deadline), "shared")
+                    return
+
+            result = None
+            try:
+                with admission.slot(deadline):
+                    generation = iter_quiz_generation(subject, grade, topic, num_mcq, num_tf, cache_key, force_regen, deadline)
+                    for part, payload in generation:
+                        if part == "done":
+                            result = payload
+                        else:
+                            yield frame({"event": "questions", "part": part, "questions": payload})
+            except BaseException as e:
+                if not force_regen:
+                    # Client ngắt kết nối (GeneratorExit) -> báo lỗi thường cho các yêu cầu đang chờ chung
+                    quiz_inflight.finish(cache_key, error=e if isinstance(e, Exception) else RuntimeError("Stream closed"))
+                raise
+            if not force_regen:
+                quiz_inflight.finish(cache_key, result)
+            yield done(result, "generated")
+
+        except AIServiceUnavailable:
+            app.logger.error("AI client not configured (genai or GOOGLE_API_KEY missing).")
+            yield frame({"event": "error", "error": "AI service not configured"})
+
+        except RequestRejected as e:
+            app.logger.warning(f"🚦 Từ chối yêu cầu sinh đề: {e}")
+            metrics.inc("quiz_rejected_total", reason=e.reason)
+            observe_quiz_request("generate-quiz-stream", "rejected", started)
+            yield frame({"event": "error", "error": "Server busy", "retry_after": e.retry_after})
+
+        except DeadlineExceeded as e:
+            app.logger.warning(f"⏱️ {e}")
+            observe_quiz_request("generate-quiz-stream", "timeout", started)
+            yield frame({"event": "error", "error": "Quiz generation timed out"})
+
+        except Exception as e:
+            app.logger.error(f"❌ Exception: {e}\n{traceback.format_exc()}")
+            observe_quiz_request("generate-quiz-stream", "error", started)
+            yield frame({"event": "error", "error": "Internal server error"})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype=mimetype,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ---------------------------
+# 📦 API sinh nhiều đề một lần (batch, NDJSON)
+# ---------------------------
+QUIZ_BATCH_MAX_ITEMS = int(os.getenv("QUIZ_BATCH_MAX_ITEMS", 50))
+# Số đề của một batch được sinh cùng lúc: một batch lớn không chiếm hết lượt admission của người khác
+QUIZ_BATCH_CONCURRENCY = int(os.getenv("QUIZ_BATCH_CONCURRENCY", 2))
+QUIZ_BATCH_DEADLINE = float(os.getenv("QUIZ_BATCH_DEADLINE", 300))  # giây tối đa cho cả batch
+batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("QUIZ_BATCH_WORKERS", 4)), thread_name_prefix="quiz-batch")
+
+
+def _batch_item_error(error):
+    """(HTTP status, thông báo, retry_after) cho lỗi của một đề trong batch."""
+    if isinstance(error, InvalidQuizRequest):
+        return 400, str(error), None
+    if isinstance(error, RequestRejected):
+        return error.status, "Server busy", error.retry_after
+    if isinstance(error, DeadlineExceeded):
+        return 504, "Quiz generation timed out", None
+    if isinstance(error, AIServiceUnavailable):
+        return 503, "AI service not configured", None
+    return 500, "Internal server error", None
+
+
+def _generate_batch_item(spec, cache_key, batch_deadline):
+    """Sinh một đề của batch (chạy trong batch_executor); trả về (result, source)."""
+    subject, grade, topic, num_mcq, num_tf, force_regen = spec
+    if not force_regen:
+        cached_data = get_cached_quiz(cache_key)
+        if cached_data is not None:
+            return cached_data, "cache"
+    # Mỗi đề có QUIZ_DEADLINE riêng tính từ lúc bắt đầu sinh; chờ lượt admission tới hết hạn thay vì bị 503 ngay
+    deadline = batch_deadline.within(QUIZ_DEADLINE)
+    generate = admitted(generate_quiz, wait_for_deadline=True)
+    if force_regen:
+        return generate(subject, grade, topic, num_mcq, num_tf, cache_key, force_regen=True, deadline=deadline), "generated"
+    result, leader = quiz_inflight.run(cache_key, generate, subject, grade, topic, num_mcq, num_tf, cache_key, deadline=deadline)
+    return result, "generated" if leader else "shared"
+
+
+@app.route("/api/generate-quiz-batch", methods=["POST", "OPTIONS"])
+def api_generate_quiz_batch():
+    """
+    Sinh nhiều đề trong một request. Payload: {"items": [{"subject", "grade", "topic",
+    "num_mcq", "num_tf", "force_regen"?}, ...]} (tối đa QUIZ_BATCH_MAX_ITEMS).
+
+    Các đề giống hệt nhau (cùng khóa cache) chỉ sinh một lần; đề có sẵn trong cache
+    được trả ngay, đề còn lại được sinh song song (tối đa QUIZ_BATCH_CONCURRENCY
+    đề một lúc, qua admission control chung). Trả về NDJSON (hoặc MessagePack theo Accept), mỗi đề một sự kiện ngay
+    khi xong (không theo thứ tự gửi):
+
+    - {"event": "item", "indices": [i, ...], "request": {...}, "source": ..., "total": n,
+      "partial": bool, "questions": [...]} ("missing" nếu thiếu câu);
+    - {"event": "item_error", "indices": [...], "status": ..., "error": "..."} ("retry_after" nếu server bận);
+    - {"event": "done", "items": ..., "unique": ..., "ok": ..., "failed": ..., "elapsed_ms": ...}.
+    """
+    started = time.monotonic()
+    data = read_json_payload()
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items phải là danh sách yêu cầu sinh đề"}), 400
+    if len(items) > QUIZ_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Tối đa {QUIZ_BATCH_MAX_ITEMS} đề mỗi batch"}), 400
+    batch_deadline = request_deadline(QUIZ_BATCH_DEADLINE)
+
+    # 🧮 Gộp các đề giống hệt nhau; đề sai định dạng báo lỗi riêng, không làm hỏng cả batch
+    unique = OrderedDict()  # (cache_key, force_regen) -> {"spec", "indices"}
+    invalid = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise InvalidQuizRequest("Mỗi item phải là một object yêu cầu sinh đề")
+            spec = parse_quiz_request(item)
+        except InvalidQuizRequest as e:
+            invalid.append((index, e))
+            continue
+        key = (QuizCache.make_key(*spec[:5]), spec[5])
+        unique.setdefault(key, {"spec": spec, "indices": []})["indices"].append(index)
+    annotate_access_log(batch_items=len(items), batch_unique=len(unique), batch_invalid=len(invalid))
+
+    # ⚡ Cache hit trả ngay; chỉ batch có đề phải sinh mới (không chờ chung) tính vào rate limit (một lượt cho cả batch)
+    hits, misses = [], []
+    for (cache_key, force_regen), entry in unique.items():
+        cached_data = None if force_regen else get_cached_quiz(cache_key)
+        (hits if cached_data is not None else misses).append((cache_key, entry, cached_data))
+    if misses:
+        try:
+            charge_rate_limit(*((cache_key, entry["spec"][5]) for cache_key, entry, _ in misses))
+        except RequestRejected as e:
+            observe_quiz_request("generate-quiz-batch", "rejected", started)
+            return rejected_response(e)
+    mimetype, frame = stream_framing()
+
+    def item_event(entry, result, source):
+        subject, grade, topic, num_mcq, num_tf, _ = entry["spec"]
+        event = {
+            "event": "item",
+            "indices": entry["indices"],
+            "request": {"subject": subject, "grade": grade, "topic": topic, "num_mcq": num_mcq, "num_tf": num_tf},
+            "source": source,
+            "total": len(result["questions"]),
+            "partial": result.get("partial", False),
+            "questions": result["questions"],
+        }
+        if result.get("missing"):
+            event["missing"] = result["missing"]
+        return frame(event)
+
+    def error_event(indices, error):
+        status, message, retry_after = _batch_item_error(error)
+        event = {"event": "item_error", "indices": indices, "status": status, "error": message}
+        if retry_after is not None:
+            event["retry_after"] = retry_after
+        if status >= 500 and not isinstance(error, (RequestRejected, DeadlineExceeded, AIServiceUnavailable)):
+            app.logger.error(f"❌ Batch item {indices} failed: {error}")
+        return frame(event)
+
+    def events():
+        ok = failed = 0
+        for index, error in invalid:
+            failed += 1
+            yield error_event([index], error)
+        for _, entry, cached_data in hits:
+            ok += 1
+            yield item_event(entry, cached_data, "cache")
+
+        queued = iter(misses)
+        pending = {}
+
+        def submit_next():
+            for cache_key, entry, _ in queued:
+                fut = batch_executor.submit(_generate_batch_item, entry["spec"], cache_key, batch_deadline)
+                pending[fut] = entry
+                return
+
+        for _ in range(max(1, QUIZ_BATCH_CONCURRENCY)):
+            submit_next()
+        try:
+            while pending:
+                finished, _ = wait(pending, timeout=batch_deadline.remaining(), return_when=FIRST_COMPLETED)
+                if not finished:
+                    break
+                for fut in finished:
+                    entry = pending.pop(fut)
+                    try:
+                        result, source = fut.result()
+                    except Exception as e:
+                        failed += 1
+                        yield error_event(entry["indices"], e)
+                    else:
+                        ok += 1
+                        yield item_event(entry, result, source)
+                    submit_next()
+            # ⏳ Hết hạn batch: các đề đang sinh và chưa bắt đầu đều báo quá hạn
+            timed_out = [entry for entry in pending.values()] + [entry for _, entry, _ in queued]
+            for entry in timed_out:
+                failed += 1
+                yield error_event(entry["indices"], DeadlineExceeded("❌ Hết thời gian của batch."))
+        finally:
+            # Client ngắt stream -> bỏ các đề chưa bắt đầu (đề đang sinh vẫn chạy xong và được cache)
+            for fut in pending:
+                fut.cancel()
+
+        observe_quiz_request("generate-quiz-batch", "done", started)
+        app.logger.info(f"📦 Batch xong: {len(items)} yêu cầu, {len(unique)} đề khác nhau, {ok} thành công, {failed} lỗi")
+        yield frame({
+            "event": "done",
+            "items": len(items),
+            "unique": len(unique),
+            "ok": ok,
+            "failed": failed,
+            "elapsed_ms": round((time.monotonic() - started) * 1000),
+        })
+
+    return Response(
+        stream_with_context(events()),
+        mimetype=mimetype,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ---------------------------
+# 🗂️ Lưu kết quả làm bài (quiz_results.db)
+# ---------------------------
+class InvalidResult(ValueError):
+    """Kết quả nộp lên không hợp lệ (trả 400 kèm thông báo)."""
+
+
+class ResultQueueFull(Exception):
+    """Hàng đợi ghi kết quả đã đầy (trả 503)."""
+
+
+STATS_BUCKETS = 10  # phân bố điểm theo 10 khoảng 10%
+ALL_TOPICS = "*"  # dòng gộp mọi chủ đề của một (môn, lớp) trong bảng thống kê
+
+
+def question_id(text):
+    return hashlib.sha1(canonical_text(text).encode("utf-8")).hexdigest()[:16]
+
+
+class ResultAggregate:
+    """
+    Cộng dồn thống kê của một nhóm kết quả trong bộ nhớ rồi ghi vào các bảng
+    tổng hợp bằng UPSERT (cộng thêm vào giá trị cũ):
+
+      stats_summary   (môn, lớp, chủ đề) -> số lượt, tổng điểm, tổng số câu, tổng tỉ lệ đúng
+      stats_histogram (môn, lớp, chủ đề, khoảng 10%) -> số lượt
+      stats_questions (môn, lớp, mã câu) -> số lượt làm, số lượt đúng
+
+    Chủ đề ALL_TOPICS là dòng gộp của cả (môn, lớp). `details` chỉ được parse một
+    lần ở đây, khi kết quả được ghi (hoặc khi rebuild).
+    """
+
+    def __init__(self):
+        self.summary = {}
+        self.histogram = {}
+        self.questions = {}
+
+    def add(self, row):
+        """`row`: bộ giá trị theo ResultStore.COLUMNS."""
+        _, subject, grade, score, total, _, details = row
+        if not total:
+            return
+        try:
+            details = json.loads(details) if details else {}
+        except ValueError:
+            details = {}
+        if not isinstance(details, dict):
+            details = {}
+        grade = canonical_grade(grade)
+        topic = str(details.get("topic") or "").strip()
+        ratio = score / total
+        bucket = min(STATS_BUCKETS - 1, int(ratio * STATS_BUCKETS))
+        for scope in {topic, ALL_TOPICS}:
+            entry = self.summary.setdefault((subject, grade, scope), [0, 0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += score
+            entry[2] += total
+            entry[3] += ratio
+            key = (subject, grade, scope, bucket)
+            self.histogram[key] = self.histogram.get(key, 0) + 1
+        questions = details.get("questions")
+        for q in questions if isinstance(questions, list) else ():
+            if not isinstance(q, dict) or not q.get("question") or not isinstance(q.get("correct"), bool):
+                continue
+            entry = self.questions.setdefault((subject, grade, question_id(q["question"])),
+                                              [topic, str(q["question"])[:500], 0, 0])
+            entry[2] += 1
+            entry[3] += q["correct"]
+
+    def apply(self, conn):
+        conn.executemany(
+            "INSERT INTO stats_summary (subject, grade, topic, attempts, score_sum, total_sum, ratio_sum)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (subject, grade, topic) DO UPDATE SET"
+            " attempts = attempts + excluded.attempts, score_sum = score_sum + excluded.score_sum,"
+            " total_sum = total_sum + excluded.total_sum, ratio_sum = ratio_sum + excluded.ratio_sum",
+            [key + tuple(values) for key, values in self.summary.items()],
+        )
+        conn.executemany(
+            "INSERT INTO stats_histogram (subject, grade, topic, bucket, count) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (subject, grade, topic, bucket) DO UPDATE SET count = count + excluded.count",
+            [key + (count,) for key, count in self.histogram.items()],
+        )
+        conn.executemany(
+            "INSERT INTO stats_questions (subject, grade, question_id, topic, question, attempts, correct)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (subject, grade, question_id) DO UPDATE SET"
+            " attempts = attempts + excluded.attempts, correct = correct + excluded.correct",
+            [key + tuple(values) for key, values in self.questions.items()],
+        )
+
+
+class ResultStore(SQLiteStore):
+    """
+    Bảng `results` trong quiz_results.db. Request chỉ bỏ kết quả vào hàng đợi
+    (không chạm tới đĩa); một thread ghi duy nhất gom mọi kết quả đang chờ rồi
+    ghi cả lô bằng một executemany trong một transaction, nên một lớp nộp bài
+    cùng lúc chỉ tốn vài lần commit. Đọc dùng kết nối riêng của từng thread (WAL
+    cho phép đọc song song với thread ghi).
+
+    Các bảng thống kê (ResultAggregate) được cập nhật trong cùng transaction với
+    lô kết quả, nên /api/stats đọc số liệu đã tổng hợp sẵn thay vì GROUP BY trên
+    toàn bộ lịch sử; rebuild_stats() tính lại từ đầu.
+    """
+
+    COLUMNS = ("student_name", "subject", "grade", "score", "total", "date", "details")
+
+    def __init__(self, path, batch_size=500, linger=0.05, max_queue=10000):
+        super().__init__(path)
+        self.batch_size = batch_size
+        self.linger = linger  # giây chờ thêm kết quả sau kết quả đầu tiên của một lô
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+
+    def _init_schema(self, conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " student_name TEXT,"
+            " subject TEXT,"
+            " grade TEXT,"
+            " score INTEGER,"
+            " total INTEGER,"
+            " date TEXT,"
+            " details TEXT"
+            ")"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_student_date ON results (student_name, date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_subject_grade_date ON results (subject, grade, date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_date ON results (date)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats_summary ("
+            " subject TEXT NOT NULL, grade TEXT NOT NULL, topic TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL, score_sum INTEGER NOT NULL, total_sum INTEGER NOT NULL, ratio_sum REAL NOT NULL,"
+            " PRIMARY KEY (subject, grade, topic)"
+            ") WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats_histogram ("
+            " subject TEXT NOT NULL, grade TEXT NOT NULL, topic TEXT NOT NULL, bucket INTEGER NOT NULL,"
+            " count INTEGER NOT NULL,"
+            " PRIMARY KEY (subject, grade, topic, bucket)"
+            ") WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats_questions ("
+            " subject TEXT NOT NULL, grade TEXT NOT NULL, question_id TEXT NOT NULL, topic TEXT NOT NULL,"
+            " question TEXT NOT NULL, attempts INTEGER NOT NULL, correct INTEGER NOT NULL,"
+            " PRIMARY KEY (subject, grade, question_id)"
+            ") WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_questions_topic ON stats_questions (subject, grade, topic)")
+
+    def submit(self, row):
+        """Xếp một kết quả (dict theo COLUMNS) vào hàng đợi ghi; ném ResultQueueFull nếu đầy."""
+        self._start_writer()
+        try:
+            self._queue.put_nowait(tuple(row[column] for column in self.COLUMNS))
+        except queue.Full:
+            raise ResultQueueFull("❌ Hàng đợi ghi kết quả đã đầy.")
+
+    def _start_writer(self):
+        # Khởi động trễ (lần dùng đầu tiên) để thread được tạo sau khi gunicorn fork worker
+        if self._writer is not None:
+            return
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="result-writer", daemon=True)
+                self._writer.start()
+
+    def _next_batch(self):
+        """Chờ kết quả đầu tiên rồi gom thêm những kết quả tới trong `linger` giây (tối đa batch_size)."""
+        rows = [self._queue.get()]
+        flush_at = time.monotonic() + self.linger
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        return rows
+
+    def _write_loop(self):
+        while True:
+            rows = self._next_batch()
+            stop = None in rows
+            rows = [row for row in rows if row is not None]
+            if rows:
+                self._write(rows)
+            for _ in range(len(rows) + stop):
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, rows, attempts=3):
+        for attempt in range(attempts):
+            try:
+                aggregate = ResultAggregate()
+                for row in rows:
+                    aggregate.add(row)
+                with self._transaction(immediate=True) as conn:
+                    conn.executemany(
+                        f"INSERT INTO results ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                        rows,
+                    )
+                    aggregate.apply(conn)
+                self.written += len(rows)
+                self.batches += 1
+                return
+            except sqlite3.Error as e:
+                app.logger.warning(f"⚠️ Ghi {len(rows)} kết quả thất bại (lần {attempt + 1}): {e}")
+                time.sleep(0.2 * (attempt + 1))
+        self.errors += len(rows)
+        app.logger.error(f"❌ Bỏ {len(rows)} kết quả sau {attempts} lần ghi thất bại.")
+
+    def flush(self):
+        """Chờ thread ghi ghi xong mọi kết quả đang chờ."""
+        if self._writer is not None:
+            self._queue.join()
+
+    def close(self, timeout=5):
+        # Ghi nốt hàng đợi khi tắt process
+        if self._writer is not None and self._writer.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self._writer.join(timeout)
+
+    def rebuild_stats(self):
+        """
+        Tính lại mọi bảng thống kê từ bảng results; trả về số kết quả đã duyệt.
+        Phần lớn được đọc trong một snapshot (không chặn thread ghi); chỉ các dòng
+        ghi thêm trong lúc đó và việc thay bảng nằm trong transaction ghi ngắn.
+        """
+        conn = self._connect()
+        aggregate = ResultAggregate()
+        select = f"SELECT id, {', '.join(self.COLUMNS)} FROM results WHERE id > ? ORDER BY id"
+        last_id = count = 0
+        conn.execute("BEGIN")
+        try:
+            for row in conn.execute(select, (0,)):
+                aggregate.add(row[1:])
+                last_id, count = row[0], count + 1
+        finally:
+            conn.execute("COMMIT")
+        with self._transaction(immediate=True) as conn:
+            for row in conn.execute(select, (last_id,)).fetchall():
+                aggregate.add(row[1:])
+                count += 1
+            for table in ("stats_summary", "stats_histogram", "stats_questions"):
+                conn.execute(f"DELETE FROM {table}")
+            aggregate.apply(conn)
+        return count
+
+    def summary(self, subject, grade, topic=None, hardest=10, min_attempts=3):
+        """Thống kê đã tổng hợp của (môn, lớp[, chủ đề]); None nếu chưa có kết quả nào."""
+        conn = self._connect()
+        grade = canonical_grade(grade)
+        scope = topic or ALL_TOPICS
+        row = conn.execute(
+            "SELECT attempts, score_sum, total_sum, ratio_sum FROM stats_summary WHERE subject = ? AND grade = ? AND topic = ?",
+            (subject, grade, scope),
+        ).fetchone()
+        if row is None:
+            return None
+        attempts, score_sum, total_sum, ratio_sum = row
+        counts = dict(conn.execute(
+            "SELECT bucket, count FROM stats_histogram WHERE subject = ? AND grade = ? AND topic = ?",
+            (subject, grade, scope),
+        ).fetchall())
+        step = 100 // STATS_BUCKETS
+        distribution = [{"range": f"{b * step}-{(b + 1) * step}%", "count": counts.get(b, 0)} for b in range(STATS_BUCKETS)]
+        query = ("SELECT question, topic, attempts, correct FROM stats_questions"
+                 " WHERE subject = ? AND grade = ?" + (" AND topic = ?" if topic else "")
+                 + " AND attempts >= ? ORDER BY CAST(correct AS REAL) / attempts, attempts DESC LIMIT ?")
+        params = (subject, grade) + ((topic,) if topic else ()) + (min_attempts, hardest)
+        hardest_questions = [
+            {"question": q, "topic": t, "attempts": a, "correct": c, "correct_rate": round(c / a, 4)}
+            for q, t, a, c in conn.execute(query, params).fetchall()
+        ]
+        return {
+            "subject": subject,
+            "grade": grade,
+            "topic": topic,
+            "attempts": attempts,
+            "avg_score": round(score_sum / attempts, 2),
+            "avg_total": round(total_sum / attempts, 2),
+            "avg_percent": round(ratio_sum / attempts * 100, 2),
+            "distribution": distribution,
+            "hardest_questions": hardest_questions,
+        }
+
+    def groups(self):
+        """Tóm tắt mọi (môn, lớp) đã có kết quả."""
+        rows = self._connect().execute(
+            "SELECT subject, grade, attempts, ratio_sum FROM stats_summary WHERE topic = ? ORDER BY subject, grade",
+            (ALL_TOPICS,),
+        ).fetchall()
+        return [{"subject": s, "grade": g, "attempts": a, "avg_percent": round(r / a * 100, 2)} for s, g, a, r in rows]
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "written": self.written, "batches": self.batches, "errors": self.errors}
+
+
+# Đặt RESULTS_DB="" để tắt lưu kết quả
+RESULTS_DB = os.getenv("RESULTS_DB", os.path.join(BASE_DIR, "quiz_results.db"))
+RESULTS_MAX_DETAILS_BYTES = int(os.getenv("RESULTS_MAX_DETAILS_BYTES", 64 * 1024))
+# Câu hỏi cần ít nhất từng này lượt làm mới được xếp vào danh sách câu khó
+STATS_MIN_ATTEMPTS = int(os.getenv("STATS_MIN_ATTEMPTS", 3))
+result_store = ResultStore(
+    RESULTS_DB,
+    batch_size=int(os.getenv("RESULTS_BATCH_SIZE", 500)),
+    linger=float(os.getenv("RESULTS_LINGER", 0.05)),
+    max_queue=int(os.getenv("RESULTS_QUEUE_SIZE", 10000)),
+) if RESULTS_DB else None
+if result_store is not None:
+    atexit.register(result_store.close)
+
+metrics.gauge("results_queued", "Số kết quả làm bài đang chờ ghi.")
+metrics.counter("results_written_total", "Số kết quả làm bài đã ghi vào quiz_results.db.")
+metrics.counter("results_batches_total", "Số lô (transaction) ghi kết quả.")
+metrics.counter("results_write_errors_total", "Số kết quả bị bỏ vì ghi SQLite thất bại.")
+
+
+@metrics.collector
+def _result_metrics():
+    if result_store is None:
+        return
+    stats = result_store.stats()
+    yield "results_queued", {}, stats["queued"]
+    yield "results_written_total", {}, stats["written"]
+    yield "results_batches_total", {}, stats["batches"]
+    yield "results_write_errors_total", {}, stats["errors"]
+
+
+def _parse_int(data, field, minimum=0):
+    value = data.get(field)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != int(value) or value < minimum:
+        raise InvalidResult(f"{field} phải là số nguyên >= {minimum}")
+    return int(value)
+
+
+def parse_result(data):
+    """Dòng `results` từ payload nộp bài; ném InvalidResult nếu sai."""
+    if not isinstance(data, dict):
+        raise InvalidResult("Payload phải là object JSON")
+    student_name = str(data.get("student_name") or "").strip()[:100]
+    subject = str(data.get("subject") or "").strip()
+    grade = str(data.get("grade") or "").strip()
+    if not subject or not grade:
+        raise InvalidResult("Thiếu subject hoặc grade")
+    score = _parse_int(data, "score")
+    total = _parse_int(data, "total", minimum=1)
+    if score > total:
+        raise InvalidResult("score không được lớn hơn total")
+    details = data.get("details")
+    details = json.dumps(details, ensure_ascii=False) if details is not None else None
+    if details is not None and len(details.encode("utf-8")) > RESULTS_MAX_DETAILS_BYTES:
+        raise InvalidResult(f"details vượt quá {RESULTS_MAX_DETAILS_BYTES} byte")
+    return {
+        "student_name": student_name or None,
+        "subject": subject,
+        "grade": grade,
+        "score": score,
+        "total": total,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "details": details,
+    }
+
+
+@app.route("/api/submit-result", methods=["POST", "OPTIONS"])
+def api_submit_result():
+    """
+    Nhận kết quả làm bài {"student_name", "subject", "grade", "score", "total", "details"?}.
+    Trả 202 ngay khi kết quả đã vào hàng đợi; thread ghi lưu xuống SQLite theo lô.
+    """
+    if result_store is None:
+        return jsonify({"error": "Result storage disabled"}), 503
+    try:
+        row = parse_result(read_json_payload())
+        result_store.submit(row)
+    except InvalidResult as e:
+        return jsonify({"error": str(e)}), 400
+    except ResultQueueFull as e:
+        app.logger.warning(f"⚠️ {e}")
+        response = jsonify({"error": "Server busy", "retry_after": 1})
+        response.status_code = 503
+        response.headers["Retry-After"] = "1"
+        return response
+    annotate_access_log(subject=row["subject"], grade=row["grade"])
+    return jsonify({"status": "accepted"}), 202
+
+
+@app.route("/api/stats", methods=["GET"])
+def api_stats():
+    """
+    Thống kê kết quả đã tổng hợp sẵn: ?subject=&grade=[&topic=] -> điểm trung bình,
+    phân bố điểm, các câu có tỉ lệ đúng thấp nhất; không có tham số -> danh sách (môn, lớp).
+    """
+    if result_store is None:
+        return jsonify({"error": "Result storage disabled"}), 503
+    subject = (request.args.get("subject") or "").strip()
+    grade = (request.args.get("grade") or "").strip()
+    topic = (request.args.get("topic") or "").strip() or None
+    try:
+        if not subject and not grade:
+            return jsonify({"groups": result_store.groups()})
+        if not subject or not grade:
+            return jsonify({"error": "Cần cả subject và grade"}), 400
+        summary = result_store.summary(subject, grade, topic, min_attempts=STATS_MIN_ATTEMPTS)
+    except sqlite3.Error as e:
+        app.logger.error(f"❌ Đọc thống kê thất bại: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+    if summary is None:
+        return jsonify({"error": "Chưa có kết quả nào"}), 404
+    return jsonify(summary)
+
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Tính lại các bảng thống kê từ bảng results (flask --app app rebuild-stats)."""
+    if result_store is None:
+        print("RESULTS_DB đang tắt.")
+        return
+    started = time.time()
+    count = result_store.rebuild_stats()
+    print(f"✅ Đã tính lại thống kê từ {count} kết quả ({round((time.time() - started) * 1000)} ms).")
+
+# ---------------------------
+# 📈 Metrics cho Prometheus
+# ---------------------------
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.route("/", methods=["GET"])
 def home():
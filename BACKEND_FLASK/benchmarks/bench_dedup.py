@@ -0,0 +1,132 @@
+"""
+Microbenchmark cho bộ lọc câu hỏi gần trùng (MinHash).
+
+Dựng một đề 50 câu từ benchmarks/corpus/questions_50.json (45 câu khác nhau
+thuộc nhiều môn + 5 câu gần trùng được cấy vào: thêm vài từ, đổi dấu câu) và
+một lịch sử 300 câu đã phục vụ, rồi đo:
+
+  - lọc cả đề trong một lô, có/không có lịch sử 300 câu đã phục vụ;
+  - lọc theo từng chunk 10 câu như khi sinh song song;
+  - bản Python thuần (khi không cài NumPy) để so sánh.
+
+Kiểm tra mọi câu cấy vào đều bị loại và không câu gốc nào bị loại nhầm, và
+hai phép đo có lịch sử (cả lô, theo chunk) không vượt `--max-ms` (mặc định
+1 ms: bộ lọc chạy trên đường phục vụ của mọi đề); exit 1 nếu sai hoặc chậm hơn.
+
+Chạy từ thư mục BACKEND_FLASK:
+    python benchmarks/bench_dedup.py [--rounds 200] [--max-ms 1.0]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+
+# Không dùng key thật: benchmark không được gọi mạng, chạy warm-up hay ghi vào DB của app
+os.environ["GEMINI_FAKE"] = "1"
+os.environ["GOOGLE_API_KEY"] = ""
+os.environ["GOOGLE_API_FALLBACK"] = ""
+os.environ["MODEL_POOL_WARMUP"] = "0"
+os.environ["ACCESS_LOG"] = "0"
+_tmp = tempfile.mkdtemp(prefix="chiron26-bench-")
+for _name in ("QUIZ_CACHE_DB", "QUESTION_BANK_DB", "RESULTS_DB"):
+    os.environ[_name] = os.path.join(_tmp, _name.lower() + ".db")
+
+import app  # noqa: E402
+
+CORPUS_FILE = os.path.join(BASE_DIR, "corpus", "questions_50.json")
+QUIZ_SIZE = 50
+HISTORY_SIZE = 300
+
+
+def load_questions():
+    with open(CORPUS_FILE, encoding="utf-8") as f:
+        return [app.normalize_question(q) for q in json.load(f)]
+
+
+def near_duplicate(q, i):
+    edits = (
+        lambda t: t.rstrip("?.") + " ?",
+        lambda t: "Hãy cho biết: " + t,
+        lambda t: t.replace(" là ", " sẽ là ", 1) if " là " in t else t + " (chọn một)",
+    )
+    return dict(q, question=edits[i % len(edits)](q["question"]))
+
+
+def history_texts(questions, n, seed=26):
+    # Câu "đã phục vụ" giả lập: ghép ngẫu nhiên từ vựng của corpus, không trùng với câu nào trong đề
+    rng = random.Random(seed)
+    words = " ".join(q["question"] for q in questions).split()
+    return [" ".join(rng.choice(words) for _ in range(14)) for _ in range(n)]
+
+
+def timed(fn, rounds):
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        best = min(best, (time.perf_counter() - started) / rounds)
+    return best * 1000  # ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200, help="số lần lặp cho mỗi phép đo")
+    parser.add_argument("--max-ms", type=float, default=1.0, help="ngưỡng ms cho các phép đo có lịch sử")
+    args = parser.parse_args()
+
+    pool = load_questions()
+    originals = pool[:QUIZ_SIZE - 5]
+    planted = [near_duplicate(originals[i * 9], i) for i in range(5)]
+    quiz = originals + planted
+    history = app.minhasher.signatures([app.canonical_text(t) for t in history_texts(pool, HISTORY_SIZE)])
+
+    dedupe = app.NearDuplicateFilter(app.minhasher, app.DEDUP_THRESHOLD, history=history)
+    accepted, held = dedupe.filter(quiz)
+    ok = accepted == originals and dedupe.dropped == len(planted) and not held
+    print(f"NumPy: {'có' if app.np is not None else 'không'}  |  {len(quiz)} câu, cấy {len(planted)} câu gần trùng "
+          f"-> bỏ {dedupe.dropped}, giữ {len(accepted)} {'✅' if ok else '❌'}")
+
+    def one_batch(history_sigs=None):
+        return app.NearDuplicateFilter(app.minhasher, app.DEDUP_THRESHOLD, history=history_sigs).filter(quiz)
+
+    def chunked():
+        f = app.NearDuplicateFilter(app.minhasher, app.DEDUP_THRESHOLD, history=history)
+        for i in range(0, len(quiz), 10):
+            f.filter(quiz[i:i + 10])
+
+    batch_ms = timed(lambda: one_batch(history), args.rounds)
+    chunked_ms = timed(chunked, args.rounds)
+    print(f"Lọc 50 câu trong một lô:               {timed(one_batch, args.rounds):7.3f} ms")
+    print(f"Lọc 50 câu, lịch sử {HISTORY_SIZE} câu:         {batch_ms:7.3f} ms")
+    print(f"Lọc 5 chunk × 10 câu, lịch sử {HISTORY_SIZE} câu: {chunked_ms:7.3f} ms")
+    slow = max(batch_ms, chunked_ms)
+    if slow > args.max_ms:
+        print(f"❌ Chậm hơn ngưỡng {args.max_ms} ms ({slow:.3f} ms)")
+        ok = False
+
+    if app.np is not None:
+        np, app.np = app.np, None
+        try:
+            hasher = app.MinHasher(num_perm=app.minhasher.num_perm)
+            py_history = [tuple(int(x) for x in row) for row in history]
+            same = [tuple(int(x) for x in row) for row in app.minhasher.signatures(
+                [app.question_key(q) for q in quiz])] == hasher.signatures([app.question_key(q) for q in quiz])
+            py_ms = timed(lambda: app.NearDuplicateFilter(hasher, app.DEDUP_THRESHOLD, history=py_history).filter(quiz),
+                          max(1, args.rounds // 20))
+            print(f"Python thuần, lịch sử {HISTORY_SIZE} câu:          {py_ms:7.3f} ms "
+                  f"(chữ ký {'khớp' if same else 'KHÔNG khớp'} bản NumPy)")
+            ok = ok and same
+        finally:
+            app.np = np
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""
+Microbenchmark cho model pool (ModelPool).
+
+So sánh chi phí phía client của một lần gọi model, không tính thời gian mạng
+(client gRPC được thay bằng client giả trả về ngay một response dựng sẵn):
+
+  - cũ:  genai.GenerativeModel(name) + generate_content(prompt, generation_config=...)
+         ở mỗi lần thử, như generate_text trước đây;
+  - mới: model_pool.get(name).generate_content(prompt) với handle dựng sẵn.
+
+Ngoài ra đo chi phí dựng client/channel lần đầu, phần mà warm-up khi khởi động
+đưa ra khỏi request đầu tiên.
+
+Chạy từ thư mục BACKEND_FLASK:
+    python benchmarks/bench_model_pool.py [--calls 2000]
+"""
+import argparse
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+
+# Không dùng key thật: benchmark không được gọi mạng hay chạy warm-up
+os.environ["GOOGLE_API_KEY"] = ""
+os.environ["GOOGLE_API_FALLBACK"] = ""
+
+import app  # noqa: E402
+from google.generativeai import client as genai_client, protos  # noqa: E402
+
+MODEL_NAME = app.MODELS_TO_TRY[0]
+PROMPT = app.build_quiz_prompt("mcq", "Toán", "10", "Hàm số bậc hai", 10)
+RESPONSE_TEXT = '{"questions": []}'
+
+
+class FakeGenerativeClient:
+    """Thay GenerativeServiceClient: trả response dựng sẵn, không mở kết nối."""
+
+    def __init__(self):
+        self.response = protos.GenerateContentResponse(
+            candidates=[{"content": {"parts": [{"text": RESPONSE_TEXT}], "role": "model"}, "finish_reason": 1}]
+        )
+
+    def generate_content(self, request, **kwargs):
+        return self.response
+
+
+def legacy_call():
+    model = app.genai.GenerativeModel(MODEL_NAME)
+    return model.generate_content(PROMPT, generation_config=app.GENERATION_CONFIG)
+
+
+def pooled_call():
+    return app.model_pool.get(MODEL_NAME).generate_content(PROMPT)
+
+
+def bench(fn, calls):
+    fn()  # làm nóng
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - started) / calls * 1e6  # µs / lần gọi
+
+
+def bench_client_creation(transport, rounds=5):
+    total = 0.0
+    for _ in range(rounds):
+        app.genai.configure(api_key="bench", transport=transport)
+        started = time.perf_counter()
+        genai_client.get_default_generative_client()
+        total += time.perf_counter() - started
+    return total / rounds * 1000  # ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=2000, help="số lần gọi cho mỗi cách")
+    args = parser.parse_args()
+
+    if app.genai is None:
+        print("google-generativeai chưa được cài, không chạy được benchmark.")
+        return 1
+
+    for transport in ("grpc", "rest"):
+        print(f"Dựng client lần đầu ({transport}):  {bench_client_creation(transport):8.2f} ms")
+
+    app.genai.configure(api_key="bench")
+    genai_client._client_manager.clients["generative"] = FakeGenerativeClient()
+    app.model_pool.reset()
+
+    assert app._response_text(legacy_call()) == app._response_text(pooled_call()) == RESPONSE_TEXT
+
+    legacy = bench(legacy_call, args.calls)
+    pooled = bench(pooled_call, args.calls)
+    print(f"Mỗi lần gọi, cũ (dựng model mỗi lần): {legacy:8.1f} µs")
+    print(f"Mỗi lần gọi, mới (model pool):         {pooled:8.1f} µs")
+    print(f"Tiết kiệm:                             {legacy - pooled:8.1f} µs ({legacy / pooled:.2f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Microbenchmark cho normalize_math_symbols.
+
+Kiểm tra engine chuẩn hóa mới cho kết quả giống hệt bản cũ trên golden corpus
+(benchmarks/corpus/normalize_golden.json), sau đó đo thời gian hậu xử lý một
+đề 14 câu (10 MCQ + 4 Đúng/Sai, ~70 lần gọi) với bản cũ và bản mới.
+
+Chạy từ thư mục BACKEND_FLASK:
+    python benchmarks/bench_normalize.py [--rounds 200]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+
+# Không dùng key thật: benchmark không được gọi mạng, chạy warm-up hay ghi vào DB của app
+os.environ["GEMINI_FAKE"] = "1"
+os.environ["GOOGLE_API_KEY"] = ""
+os.environ["GOOGLE_API_FALLBACK"] = ""
+os.environ["MODEL_POOL_WARMUP"] = "0"
+os.environ["ACCESS_LOG"] = "0"
+_tmp = tempfile.mkdtemp(prefix="chiron26-bench-")
+for _name in ("QUIZ_CACHE_DB", "QUESTION_BANK_DB", "RESULTS_DB"):
+    os.environ[_name] = os.path.join(_tmp, _name.lower() + ".db")
+
+import app  # noqa: E402
+
+GOLDEN_FILE = os.path.join(BASE_DIR, "corpus", "normalize_golden.json")
+
+
+# ---------------------------
+# Bản cũ (tham chiếu): dựng lại bảng và chạy ~80 lượt re.sub mỗi lần gọi
+# ---------------------------
+def legacy_normalize_math_symbols(text: str) -> str:
+    """Bản gốc của normalize_math_symbols, giữ nguyên để làm mốc so sánh."""
+    if not text or not isinstance(text, str):
+        return text
+
+    # --- 1. Từ điển chuyển đổi (Giữ nguyên như cũ) ---
+    latex_unicode_map = {
+        r'\\alpha': 'α', r'\\beta': 'β', r'\\gamma': 'γ', r'\\delta': 'δ', r'\\epsilon': 'ε',
+        r'\\zeta': 'ζ', r'\\eta': 'η', r'\\theta': 'θ', r'\\iota': 'ι', r'\\kappa': 'κ',
+        r'\\lambda': 'λ', r'\\mu': 'μ', r'\\nu': 'ν', r'\\xi': 'ξ', r'\\omicron': 'ο',
+        r'\\pi': 'π', r'\\rho': 'ρ', r'\\sigma': 'σ', r'\\tau': 'τ', r'\\upsilon': 'υ',
+        r'\\phi': 'φ', r'\\chi': 'χ', r'\\psi': 'ψ', r'\\omega': 'ω',
+        r'\\Gamma': 'Γ', r'\\Delta': 'Δ', r'\\Theta': 'Θ', r'\\Lambda': 'Λ', r'\\Xi': 'Ξ',
+        r'\\Pi': 'Π', r'\\Sigma': 'Σ', r'\\Upsilon': 'Υ', r'\\Phi': 'Φ', r'\\Psi': 'Ψ',
+        r'\\Omega': 'Ω',
+        r'\\pm': '±', r'\\times': '×', r'\\div': '÷', r'\\cdot': '⋅', r'\\neq': '≠',
+        r'\\leq': '≤', r'\\geq': '≥', r'\\approx': '≈', r'\\equiv': '≡', r'\\in': '∈',
+        r'\\notin': '∉', r'\\subset': '⊂', r'\\supset': '⊃', r'\\subseteq': '⊆',
+        r'\\supseteq': '⊇', r'\\sum': '∑', r'\\int': '∫', r'\\partial': '∂',
+        r'\\nabla': '∇', r'\\infty': '∞', r'\\forall': '∀', r'\\exists': '∃',
+        r'\\angle': '∠', r'\\perp': '⊥',
+        r'\\rightarrow': '→', r'\\leftarrow': '←', r'\\leftrightarrow': '↔',
+        r'\\Rightarrow': '⇒', r'\\Leftarrow': '⇐', r'\\Leftrightarrow': '⇔',
+        r'\\uparrow': '↑', r'\\downarrow': '↓',
+        r'\\ldots': '…', r'\\cdots': '⋯', r'\\vdots': '⋮', r'\\ddots': '⋱',
+        r'\\circ': '°',
+    }
+    keyword_map = {
+        r'sqrt': '√', 'inf': '∞',
+    }
+    operator_map = {
+        '>=': '≥', '<=': '≤', '!=': '≠', '->': '→', '<-': '←', '<=>': '⇔'
+    }
+    superscript_map = str.maketrans("0123456789+-=()n", "⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ⁿ")
+    subscript_map = str.maketrans("0123456789+-=()aehijklmnoprstuvx", "₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎ₐₑₕᵢⱼₖₗₘₙₒₚᵣₛₜᵤᵥₓ")
+
+    # --- 2. Thực hiện chuyển đổi ---
+    # Thay thế các toán tử đặc biệt
+    for op, uni in operator_map.items():
+        text = text.replace(op, uni)
+    # Thay thế các lệnh LaTeX
+    for latex, uni in latex_unicode_map.items():
+        text = re.sub(latex + r'\b', uni, text)
+    # Thay thế các từ khóa
+    for keyword, uni in keyword_map.items():
+        text = re.sub(r'\b' + keyword + r'\b', uni, text, flags=re.IGNORECASE)
+    # Thay thế ký hiệu độ dạng `^o`
+    text = re.sub(r'\^o\b', '°', text)
+
+    # --- 3. Xử lý các cấu trúc phức tạp hơn bằng Regex ---
+
+    # CẢI TIẾN: Chuẩn hóa căn bậc hai và thêm ngoặc để rõ ràng
+    # Thay vì r"√\1", ta dùng r"√(\1)"
+    text = re.sub(r"√\s*[{<(]([^})>]+)[})>]", r"√(\1)", text)
+
+    # Chuẩn hóa phân số
+    text = re.sub(r"\\frac{([^}]+)}{([^}]+)}", r"(\1/\2)", text)
+    # Chuẩn hóa vector
+    text = re.sub(r"\\vec{([^}]+)}", r"\1⃗", text)
+    # Chuẩn hóa góc dạng "hat"
+    def add_hat(m):
+        return m.group(1) + '\u0302'
+    text = re.sub(r"\\hat{([A-Za-z])}", add_hat, text)
+    # Chuẩn hóa chỉ số trên (superscript)
+    def to_superscript(m):
+        return m.group(1).translate(superscript_map)
+    text = re.sub(r"\^\{([^}]+)\}", to_superscript, text)
+    text = re.sub(r"\^([0-9n()+\-]+)", to_superscript, text)
+    # Chuẩn hóa chỉ số dưới (subscript)
+    def to_subscript(m):
+        return m.group(1).translate(subscript_map)
+    text = re.sub(r"_{([^}]+)}", to_subscript, text)
+    text = re.sub(r"_([0-9aehijklmnoprstuvx]+)", to_subscript, text)
+    # Chuẩn hóa công thức hóa học
+    def chemical_subscripts(match):
+        formula = match.group(0)
+        return re.sub(r"(?<=[A-Za-z])([0-9]+)", lambda m: m.group(1).translate(subscript_map), formula)
+    text = re.sub(r"\b([A-Z][a-z]?\d*)+", chemical_subscripts, text)
+
+    # --- 4. Dọn dẹp cuối cùng ---
+    text = text.replace("\\", "")
+    text = re.sub(r"\s+", " ", text).strip()
+
+    return text
+
+
+def load_golden():
+    with open(GOLDEN_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check_golden(golden):
+    mismatches = 0
+    for case in golden:
+        got = app.normalize_math_symbols(case["input"])
+        if got != case["expected"]:
+            mismatches += 1
+            print(f"❌ {case['input']!r}\n   expected: {case['expected']!r}\n   got:      {got!r}")
+    return mismatches
+
+
+def build_quiz(golden):
+    """Dựng một đề 10 MCQ + 4 Đúng/Sai từ các chuỗi trong corpus."""
+    texts = [case["input"] for case in golden if len(case["input"]) > 1]
+    questions = []
+    for i in range(10):
+        questions.append({
+            "type": "mcq",
+            "question": texts[i % len(texts)],
+            "options": [f"{letter}. {texts[(i + k + 1) % len(texts)]}" for k, letter in enumerate("ABCD")],
+            "answer": "A",
+        })
+    for i in range(4):
+        questions.append({
+            "type": "truefalse",
+            "question": texts[(i + 10) % len(texts)],
+            "options": ["A. Đúng", "B. Sai"],
+            "answer": "B",
+        })
+    return questions
+
+
+def post_process(questions, normalize):
+    # Giống vòng chuẩn hóa trong api_generate_quiz
+    for q in questions:
+        for field in ["question", "answer"]:
+            if field in q and isinstance(q[field], str):
+                normalize(q[field])
+        if "options" in q and isinstance(q["options"], list):
+            [normalize(opt) for opt in q["options"]]
+
+
+def time_quiz(questions, normalize, rounds, before_round=None):
+    best = float("inf")
+    for _ in range(rounds):
+        if before_round:
+            before_round()
+        start = time.perf_counter()
+        post_process(questions, normalize)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    golden = load_golden()
+    mismatches = check_golden(golden)
+    print(f"Golden corpus: {len(golden) - mismatches}/{len(golden)} khớp")
+    if mismatches:
+        sys.exit(1)
+
+    questions = build_quiz(golden)
+    calls = sum(2 + len(q["options"]) for q in questions)
+    legacy_ms = time_quiz(questions, legacy_normalize_math_symbols, args.rounds)
+    cold_ms = time_quiz(questions, app.normalize_math_symbols, args.rounds,
+                        before_round=app._normalize_math_symbols_cached.cache_clear)
+    warm_ms = time_quiz(questions, app.normalize_math_symbols, args.rounds)
+
+    print(f"Hậu xử lý 1 đề ({len(questions)} câu, {calls} lần gọi), best of {args.rounds}:")
+    print(f"  bản cũ           : {legacy_ms:8.3f} ms")
+    print(f"  engine mới (cold): {cold_ms:8.3f} ms  (x{legacy_ms / cold_ms:.1f})")
+    print(f"  engine mới (LRU) : {warm_ms:8.3f} ms  (x{legacy_ms / warm_ms:.1f})")
+
+
+if __name__ == "__main__":
+    main()
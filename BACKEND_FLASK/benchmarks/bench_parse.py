@@ -0,0 +1,145 @@
+"""
+Microbenchmark cho việc tách câu hỏi từ output của model.
+
+So sánh safe_parse_json cũ (regex tham lam + tối đa ba lần json.loads sau khi
+thay ký tự trên toàn văn bản) với extract_questions / QuestionStreamParser mới
+trên các output mẫu trong benchmarks/corpus/model_outputs.json: số câu hợp lệ
+tách được và thời gian mỗi output. Đo thêm chế độ stream (nạp từng đoạn 64 ký
+tự) và kiểm tra kết quả giống hệt khi nạp cả chuỗi.
+
+Chạy từ thư mục BACKEND_FLASK:
+    python benchmarks/bench_parse.py [--rounds 200]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+
+# Không dùng key thật: benchmark không được gọi mạng, chạy warm-up hay ghi vào DB của app
+os.environ["GEMINI_FAKE"] = "1"
+os.environ["GOOGLE_API_KEY"] = ""
+os.environ["GOOGLE_API_FALLBACK"] = ""
+os.environ["MODEL_POOL_WARMUP"] = "0"
+os.environ["ACCESS_LOG"] = "0"
+_tmp = tempfile.mkdtemp(prefix="chiron26-bench-")
+for _name in ("QUIZ_CACHE_DB", "QUESTION_BANK_DB", "RESULTS_DB"):
+    os.environ[_name] = os.path.join(_tmp, _name.lower() + ".db")
+
+import app  # noqa: E402
+
+CORPUS_FILE = os.path.join(BASE_DIR, "corpus", "model_outputs.json")
+STREAM_CHUNK = 64
+
+
+# ---------------------------
+# Bản cũ (tham chiếu)
+# ---------------------------
+def legacy_safe_parse_json(text):
+    """Bản gốc của safe_parse_json (bỏ log), giữ nguyên để làm mốc so sánh."""
+    def try_load(s):
+        try:
+            return json.loads(s)
+        except Exception:
+            return None
+
+    if not text:
+        return None
+
+    try:
+        json_match = re.search(r'\{[\s\S]*\}', text)
+        if not json_match:
+            raise ValueError("No JSON object found.")
+        clean_text = json_match.group(0).strip()
+
+        parsed = try_load(clean_text)
+        if parsed:
+            return parsed
+
+        fix_text = (
+            clean_text.replace("\n", " ")
+            .replace("\r", "")
+            .replace(", }", "}")
+            .replace(",]", "]")
+            .replace("’", "'")
+            .replace("“", '"')
+            .replace("”", '"')
+            .replace("'", '"')
+        )
+
+        parsed = try_load(fix_text)
+        if parsed:
+            return parsed
+
+        first, last = fix_text.find("{"), fix_text.rfind("}")
+        if first != -1 and last != -1:
+            parsed = try_load(fix_text[first:last + 1])
+            if parsed:
+                return parsed
+
+        raise ValueError("Could not parse cleaned JSON.")
+    except Exception:
+        return None
+
+
+def legacy_questions(text):
+    parsed = legacy_safe_parse_json(text) or {"questions": []}
+    return [q for q in parsed.get("questions", []) if app.is_valid_question(q)]
+
+
+def stream_questions(text):
+    parser = app.QuestionStreamParser()
+    questions = []
+    for i in range(0, len(text), STREAM_CHUNK):
+        questions += parser.feed(text[i:i + STREAM_CHUNK])
+    return questions + parser.close()
+
+
+def timed(fn, text, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn(text)
+    return (time.perf_counter() - started) / rounds * 1e6  # µs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200, help="số lần lặp cho mỗi output")
+    args = parser.parse_args()
+
+    with open(CORPUS_FILE, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    print(f"{'output':28s} {'cũ':>4s} {'mới':>4s} {'sửa':>4s} {'bỏ':>4s} {'cũ µs':>9s} {'mới µs':>9s} {'stream µs':>10s}")
+    totals = {"legacy": 0, "new": 0, "legacy_us": 0.0, "new_us": 0.0, "stream_us": 0.0}
+    mismatches = 0
+    for sample in corpus:
+        text = sample["text"]
+        old = legacy_questions(text)
+        new, stats = app.extract_questions(text)
+        if stream_questions(text) != new:
+            mismatches += 1
+            print(f"❌ {sample['name']}: kết quả stream khác khi nạp cả chuỗi")
+        legacy_us = timed(legacy_questions, text, args.rounds)
+        new_us = timed(app.extract_questions, text, args.rounds)
+        stream_us = timed(stream_questions, text, args.rounds)
+        print(f"{sample['name']:28s} {len(old):4d} {len(new):4d} {stats['repaired']:4d} {stats['dropped']:4d} "
+              f"{legacy_us:9.1f} {new_us:9.1f} {stream_us:10.1f}")
+        totals["legacy"] += len(old)
+        totals["new"] += len(new)
+        totals["legacy_us"] += legacy_us
+        totals["new_us"] += new_us
+        totals["stream_us"] += stream_us
+
+    print(f"{'Tổng':28s} {totals['legacy']:4d} {totals['new']:4d} {'':4s} {'':4s} "
+          f"{totals['legacy_us']:9.1f} {totals['new_us']:9.1f} {totals['stream_us']:10.1f}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
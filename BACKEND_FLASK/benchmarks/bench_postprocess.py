@@ -0,0 +1,272 @@
+"""
+Microbenchmark cho phần hậu xử lý output của model (thuần CPU, chạy trên mọi câu hỏi):
+tách câu hỏi (extract_questions) và chuẩn hóa ký hiệu (normalize_question).
+
+Corpus benchmarks/corpus/subject_outputs.json có output mẫu cho từng môn trong
+data/topics.json (6 MCQ + 2 Đúng/Sai mỗi môn) ở các dạng: clean, fenced (có
+```json), malformed (dấu phẩy thừa, thiếu nháy), truncated (bị cắt cụt) và
+latex_raw (LaTeX với một dấu "\\" — escape JSON sai, thường gặp ở môn tự nhiên).
+
+Đo cho từng môn và từng nhóm môn (tự nhiên: Toán, Vật lý, Hóa học; xã hội: Ngữ
+văn, Lịch sử):
+
+  - parse: µs mỗi output, µs mỗi câu tách được;
+  - normalize: µs mỗi câu khi LRU của normalize_math_symbols còn trống (cold)
+    và khi đã có sẵn (warm), theo độ dài câu;
+  - một đề (2 output clean -> parse + normalize cold): µs và bộ nhớ cấp phát
+    (tracemalloc: đỉnh và phần còn giữ lại).
+
+Chế độ regression: `--baseline kết_quả_cũ.json` so throughput (câu/giây) với
+lần chạy trước, exit 1 nếu giảm quá `--max-regression` (mặc định 25%). Ghi kết
+quả lần chạy bằng `--out`.
+
+Chạy từ thư mục BACKEND_FLASK:
+    python benchmarks/bench_postprocess.py [--rounds 50] [--out base.json]
+    python benchmarks/bench_postprocess.py --baseline base.json --max-regression 0.2
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+
+# Không dùng key thật: benchmark không được gọi mạng, chạy warm-up hay ghi vào DB của app
+os.environ["GEMINI_FAKE"] = "1"
+os.environ["GOOGLE_API_KEY"] = ""
+os.environ["GOOGLE_API_FALLBACK"] = ""
+os.environ["MODEL_POOL_WARMUP"] = "0"
+os.environ["ACCESS_LOG"] = "0"
+_tmp = tempfile.mkdtemp(prefix="chiron26-bench-")
+for _name in ("QUIZ_CACHE_DB", "QUESTION_BANK_DB", "RESULTS_DB"):
+    os.environ[_name] = os.path.join(_tmp, _name.lower() + ".db")
+
+import app  # noqa: E402
+
+CORPUS_FILE = os.path.join(BASE_DIR, "corpus", "subject_outputs.json")
+GROUPS = {
+    "tự nhiên": ("Toán", "Vật lý", "Hóa học"),
+    "xã hội": ("Ngữ văn", "Lịch sử"),
+}
+LENGTH_BUCKETS = ((0, 150), (150, 300), (300, 600), (600, None))
+
+
+def load_corpus():
+    with open(CORPUS_FILE, encoding="utf-8") as f:
+        return json.load(f)["subjects"]
+
+
+def median_ns(fn, rounds, setup=None):
+    """Trung vị thời gian (ns) của fn() qua `rounds` lần; `setup` chạy trước mỗi lần, không tính giờ."""
+    samples = []
+    for _ in range(rounds):
+        if setup is not None:
+            setup()
+        started = time.perf_counter_ns()
+        fn()
+        samples.append(time.perf_counter_ns() - started)
+    return statistics.median(samples)
+
+
+def clear_normalize_cache():
+    app._normalize_math_symbols_cached.cache_clear()
+
+
+def parse_all(outputs):
+    return [q for o in outputs for q in app.extract_questions(o["text"])[0]]
+
+
+def normalize_all(questions):
+    return [app.normalize_question(q) for q in questions]
+
+
+def question_length(q):
+    return len(q.get("question", "")) + sum(len(o) for o in q.get("options", []))
+
+
+def allocations(fn):
+    """(đỉnh KiB, KiB còn giữ lại) khi chạy fn() một lần."""
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = fn()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return round((peak - before) / 1024, 1), round((current - before) / 1024, 1)
+
+
+def bench_subject(data, rounds):
+    outputs = data["outputs"]
+    questions = parse_all(outputs)
+    quiz = [o for o in outputs if o["kind"] == "clean"]
+
+    def quiz_pass():
+        return normalize_all(parse_all(quiz))
+
+    parse_ns = median_ns(lambda: parse_all(outputs), rounds)
+    cold_ns = median_ns(lambda: normalize_all(questions), rounds, setup=clear_normalize_cache)
+    normalize_all(questions)
+    warm_ns = median_ns(lambda: normalize_all(questions), rounds)
+    quiz_ns = median_ns(quiz_pass, rounds, setup=clear_normalize_cache)
+    clear_normalize_cache()
+    peak_kib, retained_kib = allocations(quiz_pass)
+
+    by_kind = {}
+    for o in outputs:
+        ns = median_ns(lambda: app.extract_questions(o["text"]), rounds)
+        entry = by_kind.setdefault(o["kind"], {"ns": 0, "bytes": 0, "questions": 0})
+        entry["ns"] += ns
+        entry["bytes"] += len(o["text"].encode("utf-8"))
+        entry["questions"] += len(app.extract_questions(o["text"])[0])
+
+    return {
+        "outputs": len(outputs),
+        "questions": len(questions),
+        "parse_us_per_output": round(parse_ns / len(outputs) / 1000, 2),
+        "parse_us_per_question": round(parse_ns / max(1, len(questions)) / 1000, 2),
+        "normalize_cold_us_per_question": round(cold_ns / max(1, len(questions)) / 1000, 2),
+        "normalize_warm_us_per_question": round(warm_ns / max(1, len(questions)) / 1000, 2),
+        "quiz_questions": sum(len(app.extract_questions(o["text"])[0]) for o in quiz),
+        "quiz_us": round(quiz_ns / 1000, 1),
+        "quiz_alloc_peak_kib": peak_kib,
+        "quiz_alloc_retained_kib": retained_kib,
+        "throughput": {
+            "parse_q_per_s": round(len(questions) / (parse_ns / 1e9)),
+            "normalize_cold_q_per_s": round(len(questions) / (cold_ns / 1e9)),
+            "quiz_per_s": round(1e9 / quiz_ns, 1),
+        },
+        "_by_kind": by_kind,
+        "_questions": questions,
+    }
+
+
+def bench_lengths(questions, rounds):
+    """normalize cold (µs/câu) theo độ dài câu hỏi + phương án."""
+    result = {}
+    for low, high in LENGTH_BUCKETS:
+        bucket = [q for q in questions if question_length(q) >= low and (high is None or question_length(q) < high)]
+        if not bucket:
+            continue
+        ns = median_ns(lambda: normalize_all(bucket), rounds, setup=clear_normalize_cache)
+        label = f"{low}-{high}" if high else f"{low}+"
+        result[label] = {"questions": len(bucket), "normalize_cold_us_per_question": round(ns / len(bucket) / 1000, 2)}
+    return result
+
+
+def aggregate(subjects, names):
+    rows = [subjects[n] for n in names if n in subjects]
+    questions = sum(r["questions"] for r in rows)
+    parse_us = sum(r["parse_us_per_question"] * r["questions"] for r in rows)
+    cold_us = sum(r["normalize_cold_us_per_question"] * r["questions"] for r in rows)
+    return {
+        "subjects": [n for n in names if n in subjects],
+        "questions": questions,
+        "parse_us_per_question": round(parse_us / questions, 2),
+        "normalize_cold_us_per_question": round(cold_us / questions, 2),
+        "quiz_us": round(statistics.mean(r["quiz_us"] for r in rows), 1),
+        "throughput": {
+            "parse_q_per_s": round(questions / (parse_us / 1e6)),
+            "normalize_cold_q_per_s": round(questions / (cold_us / 1e6)),
+            "quiz_per_s": round(1e6 / statistics.mean(r["quiz_us"] for r in rows), 1),
+        },
+    }
+
+
+def compare(current, baseline, max_regression):
+    """Danh sách (tên chỉ số, cũ, mới, tỉ lệ thay đổi) giảm quá max_regression."""
+    failures = []
+    scopes = [("overall", current["overall"], baseline.get("overall", {}))]
+    scopes += [(f"subject:{name}", row, baseline.get("subjects", {}).get(name, {}))
+               for name, row in current["subjects"].items()]
+    for scope, row, old_row in scopes:
+        for metric, new in row["throughput"].items():
+            old = old_row.get("throughput", {}).get(metric)
+            if not old:
+                continue
+            change = (new - old) / old
+            if change < -max_regression:
+                failures.append((f"{scope}.{metric}", old, new, change))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--out", help="ghi kết quả ra file JSON")
+    parser.add_argument("--baseline", help="file JSON của lần chạy trước để kiểm tra regression")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="tỉ lệ giảm throughput tối đa cho phép")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    subjects = {name: bench_subject(data, args.rounds) for name, data in corpus.items()}
+    all_questions = [q for row in subjects.values() for q in row.pop("_questions")]
+
+    by_kind = {}
+    for row in subjects.values():
+        for kind, entry in row.pop("_by_kind").items():
+            total = by_kind.setdefault(kind, {"ns": 0, "bytes": 0, "questions": 0})
+            for key in total:
+                total[key] += entry[key]
+    kinds = {
+        kind: {
+            "questions": e["questions"],
+            "parse_mb_per_s": round(e["bytes"] / 1e6 / (e["ns"] / 1e9), 1),
+            "parse_us_per_question": round(e["ns"] / max(1, e["questions"]) / 1000, 2),
+        }
+        for kind, e in by_kind.items()
+    }
+
+    result = {
+        "rounds": args.rounds,
+        "numpy": app.np is not None,
+        "subjects": subjects,
+        "groups": {group: aggregate(subjects, names) for group, names in GROUPS.items()},
+        "overall": aggregate(subjects, list(subjects)),
+        "by_kind": kinds,
+        "by_length": bench_lengths(all_questions, args.rounds),
+    }
+
+    print(f"{'Môn':<10} {'câu':>4} {'parse µs/câu':>13} {'norm cold':>10} {'norm warm':>10} {'đề µs':>9} {'đỉnh KiB':>9} {'giữ KiB':>8}")
+    for name, row in subjects.items():
+        print(f"{name:<10} {row['questions']:>4} {row['parse_us_per_question']:>13} {row['normalize_cold_us_per_question']:>10} "
+              f"{row['normalize_warm_us_per_question']:>10} {row['quiz_us']:>9} {row['quiz_alloc_peak_kib']:>9} "
+              f"{row['quiz_alloc_retained_kib']:>8}")
+    print()
+    for group, row in list(result["groups"].items()) + [("tất cả", result["overall"])]:
+        print(f"Nhóm {group:<9} parse {row['parse_us_per_question']:>7} µs/câu   normalize cold "
+              f"{row['normalize_cold_us_per_question']:>7} µs/câu   đề {row['quiz_us']:>8} µs")
+    print()
+    for kind, row in kinds.items():
+        print(f"Output {kind:<10} {row['parse_mb_per_s']:>6} MB/s   {row['parse_us_per_question']:>7} µs/câu tách được ({row['questions']} câu)")
+    print()
+    for label, row in result["by_length"].items():
+        print(f"Độ dài {label:<8} ký tự: normalize cold {row['normalize_cold_us_per_question']:>7} µs/câu ({row['questions']} câu)")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Đã ghi {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        failures = compare(result, baseline, args.max_regression)
+        if failures:
+            print(f"\n❌ Throughput giảm quá {args.max_regression:.0%} so với {args.baseline}:")
+            for metric, old, new, change in failures:
+                print(f"  {metric:<45} {old:>10} -> {new:<10} ({change:+.1%})")
+            return 1
+        print(f"\n✅ Không chỉ số throughput nào giảm quá {args.max_regression:.0%} so với {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
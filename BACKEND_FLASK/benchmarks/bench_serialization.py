@@ -0,0 +1,162 @@
+"""
+Microbenchmark cho phần serialize đề thi (chạy trên mọi response, cache và stream).
+
+Đề mẫu lấy từ benchmarks/corpus/subject_outputs.json: mỗi môn ghép các output
+clean (tách + chuẩn hóa như khi sinh thật) thành một đề {"questions": [...]}.
+So sánh các định dạng:
+
+  - json_ascii: json chuẩn, escape \\uXXXX (cách jsonify trả trước đây);
+  - json_utf8:  json chuẩn, UTF-8 gọn (separators không khoảng trắng);
+  - orjson:     dumps_json/loads_json của app khi có orjson;
+  - msgpack:    MessagePack (Accept: application/x-msgpack).
+
+Với mỗi định dạng: µs encode/decode mỗi đề và số byte (thô và sau gzip) so với
+json_ascii. Ngoài ra đo chi phí dựng khóa cache: chuỗi json.dumps(sort_keys)
+cũ so với tuple của QuizCache.make_key, cả phần tra dict.
+
+Chạy từ thư mục BACKEND_FLASK:
+    python benchmarks/bench_serialization.py [--rounds 200] [--out ser.json]
+"""
+import argparse
+import gzip
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+
+# Không dùng key thật: benchmark không được gọi mạng, chạy warm-up hay ghi vào DB của app
+os.environ["GEMINI_FAKE"] = "1"
+os.environ["GOOGLE_API_KEY"] = ""
+os.environ["GOOGLE_API_FALLBACK"] = ""
+os.environ["MODEL_POOL_WARMUP"] = "0"
+os.environ["ACCESS_LOG"] = "0"
+_tmp = tempfile.mkdtemp(prefix="chiron26-bench-")
+for _name in ("QUIZ_CACHE_DB", "QUESTION_BANK_DB", "RESULTS_DB"):
+    os.environ[_name] = os.path.join(_tmp, _name.lower() + ".db")
+
+import app  # noqa: E402
+
+CORPUS_FILE = os.path.join(BASE_DIR, "corpus", "subject_outputs.json")
+
+
+def load_quizzes():
+    with open(CORPUS_FILE, encoding="utf-8") as f:
+        subjects = json.load(f)["subjects"]
+    quizzes = {}
+    for name, data in subjects.items():
+        questions = [app.normalize_question(q)
+                     for o in data["outputs"] if o["kind"] == "clean"
+                     for q in app.extract_questions(o["text"])[0]]
+        quizzes[name] = {"questions": questions, "partial": False}
+    return quizzes
+
+
+def formats():
+    result = {
+        "json_ascii": (lambda d: json.dumps(d).encode("utf-8"), json.loads),
+        "json_utf8": (lambda d: json.dumps(d, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), json.loads),
+    }
+    if app.orjson is not None:
+        result["orjson"] = (app.dumps_json, app.loads_json)
+    if app.msgpack is not None:
+        result["msgpack"] = (app.dumps_msgpack, app.loads_msgpack)
+    return result
+
+
+def median_ns(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter_ns()
+        fn()
+        samples.append(time.perf_counter_ns() - started)
+    return statistics.median(samples)
+
+
+def bench_formats(quizzes, rounds):
+    result = {}
+    for name, (dumps, loads) in formats().items():
+        encode_ns = decode_ns = raw = packed = 0
+        for quiz in quizzes.values():
+            body = dumps(quiz)
+            assert loads(body) == quiz, f"{name}: decode khác dữ liệu gốc"
+            encode_ns += median_ns(lambda: dumps(quiz), rounds)
+            decode_ns += median_ns(lambda: loads(body), rounds)
+            raw += len(body)
+            packed += len(gzip.compress(body, compresslevel=6, mtime=0))
+        n = len(quizzes)
+        result[name] = {
+            "encode_us": round(encode_ns / n / 1000, 1),
+            "decode_us": round(decode_ns / n / 1000, 1),
+            "bytes": round(raw / n),
+            "gzip_bytes": round(packed / n),
+        }
+    base = result["json_ascii"]
+    for row in result.values():
+        row["bytes_saved"] = base["bytes"] - row["bytes"]
+        row["gzip_bytes_saved"] = base["gzip_bytes"] - row["gzip_bytes"]
+    return result
+
+
+def old_make_key(subject, grade, topic, num_mcq, num_tf):
+    return json.dumps(
+        {
+            "subject": app.canonical_text(subject),
+            "grade": app.canonical_grade(grade),
+            "topic": app.canonical_text(topic),
+            "num_mcq": int(num_mcq),
+            "num_tf": int(num_tf),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+
+
+def bench_cache_key(rounds):
+    args = ("Toán", "Lớp 10", "Hàm số bậc hai", 10, 4)
+    result = {}
+    for name, make_key in (("json_string", old_make_key), ("tuple", app.QuizCache.make_key)):
+        table = {make_key(*args): True}
+        build_ns = median_ns(lambda: [make_key(*args) for _ in range(100)], rounds) / 100
+        lookup_ns = median_ns(lambda: [table.get(make_key(*args)) for _ in range(100)], rounds) / 100
+        result[name] = {"build_us": round(build_ns / 1000, 2), "build_and_lookup_us": round(lookup_ns / 1000, 2)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--out", help="ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    quizzes = load_quizzes()
+    result = {
+        "rounds": args.rounds,
+        "quizzes": len(quizzes),
+        "mean_questions": round(statistics.mean(len(q["questions"]) for q in quizzes.values()), 1),
+        "formats": bench_formats(quizzes, args.rounds),
+        "cache_key": bench_cache_key(args.rounds),
+    }
+
+    print(f"{result['quizzes']} đề, trung bình {result['mean_questions']} câu/đề (số liệu là trung bình mỗi đề)")
+    print(f"{'Định dạng':<11} {'encode µs':>10} {'decode µs':>10} {'byte':>7} {'gzip':>6} {'tiết kiệm':>10} {'tk gzip':>8}")
+    for name, row in result["formats"].items():
+        print(f"{name:<11} {row['encode_us']:>10} {row['decode_us']:>10} {row['bytes']:>7} {row['gzip_bytes']:>6} "
+              f"{row['bytes_saved']:>10} {row['gzip_bytes_saved']:>8}")
+    print()
+    for name, row in result["cache_key"].items():
+        print(f"Khóa cache {name:<12} dựng {row['build_us']:>6} µs   dựng + tra dict {row['build_and_lookup_us']:>6} µs")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Đã ghi {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
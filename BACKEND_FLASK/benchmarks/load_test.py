@@ -0,0 +1,248 @@
+"""
+Load test cho /api/generate-quiz.
+
+Gửi `--requests` yêu cầu với `--concurrency` client song song, chủ đề chọn
+ngẫu nhiên trong `--distinct` bộ (môn, lớp, chủ đề) của data/topics.json (ít bộ
+hơn -> nhiều cache hit / chờ chung hơn), rồi báo cáo:
+
+  - độ trễ p50/p95/p99/mean/max (ms) và throughput (request/giây);
+  - tỉ lệ cache hit / chờ chung / sinh mới (theo header X-Quiz-Source);
+  - tỉ lệ lỗi theo mã HTTP (429/503 = bị giới hạn tải), tỉ lệ đề thiếu câu
+    (partial), lỗi kết nối/timeout.
+
+Mặc định chạy app ngay trong process với Gemini giả lập (GEMINI_FAKE=1, cấu hình
+qua các biến FAKE_GENAI_* của fake_genai.py) và cache/ngân hàng SQLite trong thư
+mục tạm, nên không tốn quota. Dùng `--url` để đo một server đang chạy.
+
+Kết quả được ghi ra JSON (`--out`) để so sánh giữa các thay đổi; `--compare`
+in chênh lệch so với một file kết quả trước đó.
+
+Chạy từ thư mục BACKEND_FLASK:
+    python benchmarks/load_test.py --requests 200 --concurrency 16 --distinct 40
+    FAKE_GENAI_QUOTA_RATE=0.1 python benchmarks/load_test.py --out /tmp/quota.json --compare /tmp/base.json
+    python benchmarks/load_test.py --url http://127.0.0.1:5000/api/generate-quiz
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BASE_DIR)
+TOPICS_FILE = os.path.join(BACKEND_DIR, "..", "data", "topics.json")
+RESULTS_DIR = os.path.join(BASE_DIR, "results")
+
+
+def load_combos(distinct, seed):
+    with open(TOPICS_FILE, encoding="utf-8") as f:
+        topics = json.load(f)
+    combos = [(subject, grade, topic)
+              for subject, grades in topics.items()
+              for grade, names in grades.items()
+              for topic in names]
+    random.Random(seed).shuffle(combos)
+    return combos[:distinct]
+
+
+def start_local_server():
+    """Chạy app trong process (werkzeug, đa luồng) với Gemini giả lập; trả về (url, app module, server)."""
+    tmp = tempfile.mkdtemp(prefix="chiron26-load-")
+    os.environ["GEMINI_FAKE"] = "1"
+    os.environ["GOOGLE_API_KEY"] = ""
+    os.environ["GOOGLE_API_FALLBACK"] = ""
+    os.environ.setdefault("QUIZ_CACHE_DB", os.path.join(tmp, "quiz_cache.db"))
+    os.environ.setdefault("QUESTION_BANK_DB", os.path.join(tmp, "question_bank.db"))
+    # Mọi client của load test dùng chung một IP: tắt rate limit theo client trừ khi đặt rõ
+    os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+    os.environ.setdefault("ACCESS_LOG", "0")
+    sys.path.insert(0, BACKEND_DIR)
+
+    import logging
+    from werkzeug.serving import make_server
+
+    import app  # noqa: E402
+
+    app.app.logger.setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="load-test-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/api/generate-quiz", app, server
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return round(ordered[index], 1)
+
+
+def run_load(url, combos, args):
+    rng = random.Random(args.seed)
+    plan = [rng.choice(combos) for _ in range(args.requests)]
+    local = threading.local()
+    records = []
+    records_lock = threading.Lock()
+
+    def one(combo):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        subject, grade, topic = combo
+        payload = {"subject": subject, "grade": grade, "topic": topic, "num_mcq": args.num_mcq, "num_tf": args.num_tf}
+        started = time.perf_counter()
+        record = {"status": None, "source": None, "partial": False, "questions": 0}
+        try:
+            res = session.post(url, json=payload, timeout=args.timeout,
+                               headers={"X-Request-Timeout": str(args.timeout)})
+            record["status"] = res.status_code
+            record["source"] = res.headers.get("X-Quiz-Source")
+            if res.headers.get("Content-Type", "").startswith("application/json"):
+                body = res.json()
+                record["partial"] = bool(body.get("partial"))
+                record["questions"] = len(body.get("questions", []))
+        except requests.exceptions.Timeout:
+            record["status"] = "timeout"
+        except requests.exceptions.RequestException:
+            record["status"] = "connection_error"
+        record["latency_ms"] = (time.perf_counter() - started) * 1000
+        with records_lock:
+            records.append(record)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, plan))
+    return records, time.perf_counter() - started
+
+
+def summarize(records, duration):
+    total = len(records)
+    latencies = sorted(r["latency_ms"] for r in records)
+    ok = [r for r in records if r["status"] == 200]
+    statuses = Counter(str(r["status"]) for r in records)
+    sources = Counter(r["source"] for r in ok)
+    return {
+        "requests": total,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(total / duration, 2) if duration else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "mean": round(sum(latencies) / total, 1) if total else None,
+            "max": round(latencies[-1], 1) if latencies else None,
+        },
+        "ok_latency_p50_by_source_ms": {
+            source: percentile(sorted(r["latency_ms"] for r in ok if r["source"] == source), 0.50)
+            for source in sorted(s for s in sources if s)
+        },
+        "cache_hit_rate": round(sources["cache"] / total, 4) if total else None,
+        "shared_rate": round(sources["shared"] / total, 4) if total else None,
+        "generated_rate": round(sources["generated"] / total, 4) if total else None,
+        "error_rate": round((total - len(ok)) / total, 4) if total else None,
+        "partial_rate": round(sum(r["partial"] for r in ok) / total, 4) if total else None,
+        "status_counts": dict(sorted(statuses.items())),
+        "mean_questions": round(sum(r["questions"] for r in ok) / len(ok), 2) if ok else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def print_summary(summary):
+    lat = summary["latency_ms"]
+    print(f"Requests: {summary['requests']} trong {summary['duration_s']} s -> {summary['throughput_rps']} req/s")
+    print(f"Độ trễ (ms): p50 {lat['p50']}  p95 {lat['p95']}  p99 {lat['p99']}  mean {lat['mean']}  max {lat['max']}")
+    print(f"Cache hit {summary['cache_hit_rate']:.1%}  |  chờ chung {summary['shared_rate']:.1%}  |  "
+          f"sinh mới {summary['generated_rate']:.1%}")
+    print(f"Lỗi {summary['error_rate']:.1%} {summary['status_counts']}  |  đề thiếu câu {summary['partial_rate']:.1%}  |  "
+          f"trung bình {summary['mean_questions']} câu/đề")
+
+
+def print_comparison(current, previous):
+    print(f"\nSo với {previous.get('revision') or '?'} ({previous.get('started_at')}):")
+    rows = [("throughput_rps", None)] + [("latency_ms", q) for q in ("p50", "p95", "p99")] + \
+           [("cache_hit_rate", None), ("error_rate", None), ("partial_rate", None)]
+    for key, sub in rows:
+        old = previous["summary"].get(key)
+        new = current["summary"].get(key)
+        if sub:
+            old, new = (old or {}).get(sub), (new or {}).get(sub)
+        if old is None or new is None:
+            continue
+        change = f" ({(new - old) / old:+.1%})" if old else ""
+        print(f"  {key + ('.' + sub if sub else ''):<20} {old:>10} -> {new:<10}{change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="endpoint của server đang chạy; mặc định chạy app trong process với Gemini giả lập")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--distinct", type=int, default=40, help="số bộ (môn, lớp, chủ đề) khác nhau")
+    parser.add_argument("--num-mcq", type=int, default=10)
+    parser.add_argument("--num-tf", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=60, help="timeout phía client (giây), gửi kèm X-Request-Timeout")
+    parser.add_argument("--seed", type=int, default=26)
+    parser.add_argument("--out", help="file JSON kết quả (mặc định benchmarks/results/load_<thời điểm>.json)")
+    parser.add_argument("--compare", help="file JSON của một lần chạy trước để in chênh lệch")
+    args = parser.parse_args()
+
+    combos = load_combos(args.distinct, args.seed)
+    app = None
+    url = args.url
+    if url is None:
+        url, app, server = start_local_server()
+        app.genai.reset_stats()
+
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+    records, duration = run_load(url, combos, args)
+    summary = summarize(records, duration)
+
+    result = {
+        "started_at": started_at,
+        "revision": git_revision(),
+        "target": "in-process (GEMINI_FAKE)" if app is not None else url,
+        "config": {**{k: v for k, v in vars(args).items() if k not in ("out", "compare", "url")},
+                   "distinct": len(combos)},
+        "env": {k: v for k, v in sorted(os.environ.items())
+                if k.startswith(("FAKE_GENAI_", "QUIZ_", "HEDGE_", "ASYNC_", "DEDUP_", "GEMINI_TRANSPORT", "RATE_LIMIT_"))},
+        "summary": summary,
+    }
+    if app is not None:
+        result["fake_genai"] = app.genai.snapshot_stats()
+        result["model_router"] = app.model_router.snapshot()
+        result["single_flight"] = app.quiz_inflight.stats()
+        server.shutdown()
+
+    print_summary(summary)
+    if app is not None:
+        print(f"Gemini giả lập: {result['fake_genai']}")
+
+    out = args.out or os.path.join(RESULTS_DIR, f"load_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"💾 Đã ghi {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(result, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
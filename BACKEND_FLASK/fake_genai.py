@@ -0,0 +1,261 @@
+"""
+Bản giả lập offline của phần google.generativeai mà app.py dùng: configure,
+GenerativeModel.generate_content[_async] và count_tokens[_async].
+
+Dùng để đo throughput của backend (benchmarks/load_test.py) mà không tốn quota.
+Bật bằng GEMINI_FAKE=1 khi chạy app.py. Hành vi được chỉnh qua biến môi trường:
+
+  FAKE_GENAI_LATENCY         phân phối độ trễ: "lognormal" (mặc định) | "uniform" | "fixed"
+  FAKE_GENAI_LATENCY_MS      trung vị (lognormal), trung bình (uniform) hoặc giá trị (fixed); mặc định 1200
+  FAKE_GENAI_LATENCY_SIGMA   sigma của lognormal, hoặc biên ±tỉ lệ của uniform; mặc định 0.5
+  FAKE_GENAI_MS_PER_QUESTION thời gian sinh thêm cho mỗi câu hỏi; mặc định 120
+  FAKE_GENAI_QUOTA_RATE      tỉ lệ lời gọi ném ResourceExhausted; mặc định 0
+  FAKE_GENAI_RETRY_AFTER     giây gợi ý trong thông báo ResourceExhausted; mặc định 2
+  FAKE_GENAI_TRUNCATE_RATE   tỉ lệ output bị cắt cụt giữa chừng; mặc định 0
+  FAKE_GENAI_MALFORMED_RATE  tỉ lệ output có một object câu hỏi hỏng; mặc định 0
+  FAKE_GENAI_EMPTY_RATE      tỉ lệ response không có candidate nào; mặc định 0
+  FAKE_GENAI_SEED            seed cho nội dung và độ trễ (mặc định ngẫu nhiên)
+
+Lời gọi có request_options={"timeout": t} mà độ trễ vượt t thì chờ đúng t rồi
+ném DeadlineExceeded như client thật; output vượt max_output_tokens (ước lượng
+4 ký tự một token) bị cắt cụt như khi model hết budget.
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+
+try:
+    from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted
+except ImportError:
+    class ResourceExhausted(Exception):
+        """429 hết quota (thay cho google.api_core khi chưa cài)."""
+
+    class DeadlineExceeded(Exception):
+        """504 quá timeout của request (thay cho google.api_core khi chưa cài)."""
+
+LATENCY = os.getenv("FAKE_GENAI_LATENCY", "lognormal").strip().lower()
+LATENCY_MS = float(os.getenv("FAKE_GENAI_LATENCY_MS", 1200))
+LATENCY_SIGMA = float(os.getenv("FAKE_GENAI_LATENCY_SIGMA", 0.5))
+MS_PER_QUESTION = float(os.getenv("FAKE_GENAI_MS_PER_QUESTION", 120))
+QUOTA_RATE = float(os.getenv("FAKE_GENAI_QUOTA_RATE", 0))
+RETRY_AFTER = float(os.getenv("FAKE_GENAI_RETRY_AFTER", 2))
+TRUNCATE_RATE = float(os.getenv("FAKE_GENAI_TRUNCATE_RATE", 0))
+MALFORMED_RATE = float(os.getenv("FAKE_GENAI_MALFORMED_RATE", 0))
+EMPTY_RATE = float(os.getenv("FAKE_GENAI_EMPTY_RATE", 0))
+CHARS_PER_TOKEN = 4
+
+_seed = os.getenv("FAKE_GENAI_SEED")
+_rng = random.Random(int(_seed) if _seed else None)
+_rng_lock = threading.Lock()
+
+# Từ vựng để ghép câu hỏi: câu ghép ngẫu nhiên đủ khác nhau để không bị lọc gần trùng
+_WORDS = (
+    "hàm số đồ thị phương trình nghiệm bất đẳng thức tam giác đường tròn vectơ tọa độ "
+    "xác suất thống kê dãy số giới hạn đạo hàm tích phân lực vận tốc gia tốc khối lượng "
+    "năng lượng điện trở cường độ hiệu điện thế từ trường ánh sáng thấu kính nguyên tử "
+    "phân tử liên kết phản ứng oxi hóa axit bazơ muối dung dịch nồng độ tế bào gen "
+    "nhiễm sắc thể quang hợp hô hấp enzim hệ sinh thái quần thể thuật toán biến vòng lặp "
+    "mảng chuỗi tệp mạng dữ liệu thuật ngữ đoạn văn nhân vật tác phẩm thời kỳ triều đại "
+    "khí hậu địa hình dân cư kinh tế giá trị chu kỳ tần số bước sóng áp suất nhiệt độ"
+).split()
+_STEMS = (
+    "Phát biểu nào sau đây đúng về", "Kết luận nào đúng khi xét", "Cho biết tính chất của",
+    "Giá trị nào phù hợp với", "Nhận định nào chính xác về", "Trường hợp nào thể hiện",
+)
+
+stats_lock = threading.Lock()
+stats = {"calls": 0, "quota": 0, "empty": 0, "truncated": 0, "malformed": 0, "timeouts": 0}
+
+_config = {}
+
+
+def configure(api_key=None, transport=None, **kwargs):
+    _config.update(api_key=api_key, transport=transport, **kwargs)
+
+
+def snapshot_stats():
+    with stats_lock:
+        return dict(stats)
+
+
+def reset_stats():
+    with stats_lock:
+        for key in stats:
+            stats[key] = 0
+
+
+def _count(key):
+    with stats_lock:
+        stats[key] += 1
+
+
+# ---------------------------
+# 📦 Response giống cấu trúc của client thật
+# ---------------------------
+class _Part:
+    def __init__(self, text):
+        self.text = text
+
+
+class _Content:
+    def __init__(self, text):
+        self.parts = [_Part(text)]
+
+
+class _Candidate:
+    def __init__(self, text):
+        self.content = _Content(text)
+
+
+class GenerateContentResponse:
+    def __init__(self, text):
+        self.candidates = [_Candidate(text)] if text is not None else []
+
+    @property
+    def text(self):
+        if not self.candidates:
+            raise ValueError("Response has no candidates.")
+        return self.candidates[0].content.parts[0].text
+
+
+class CountTokensResponse:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+
+# ---------------------------
+# 🧪 Nội dung giả theo prompt của build_quiz_prompt
+# ---------------------------
+_COUNT_RE = re.compile(r"Tạo (\d+)")
+_KIND_RE = re.compile(r'"type": "(\w+)"')
+_TOPIC_RE = re.compile(r"- Chủ đề: (.*)")
+_LEVEL_COUNT_RE = re.compile(r"(\d+) câu ở mức độ ([^,.]+)")
+_LEVEL_SHARE_RE = re.compile(r"(\d+)% câu ở mức độ ([^,.]+)")
+
+
+def _levels(prompt, count):
+    counts = [(int(n), level) for n, level in _LEVEL_COUNT_RE.findall(prompt)]
+    if not counts:
+        counts = [(round(count * int(p) / 100), level) for p, level in _LEVEL_SHARE_RE.findall(prompt)]
+    levels = [level for n, level in counts for _ in range(n)][:count]
+    return levels + ["nhận biết"] * (count - len(levels))
+
+
+def _question(rng, kind, topic, level):
+    words = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(14, 22)))
+    question = {"type": kind, "level": level, "question": f"{rng.choice(_STEMS)} {words} ({topic})?"}
+    if kind == "mcq":
+        question["options"] = [f"{letter}. " + " ".join(rng.choice(_WORDS) for _ in range(3)) for letter in "ABCD"]
+        question["answer"] = rng.choice("ABCD")
+    else:
+        question["options"] = ["A. Đúng", "B. Sai"]
+        question["answer"] = rng.choice("AB")
+    return question
+
+
+def quiz_payload(prompt, rng=_rng):
+    """Output JSON hợp lệ cho prompt sinh câu hỏi (số câu, dạng, mức độ theo prompt)."""
+    count = int(_COUNT_RE.search(prompt).group(1)) if _COUNT_RE.search(prompt) else 5
+    kind_match = _KIND_RE.search(prompt)
+    kind = kind_match.group(1) if kind_match else "mcq"
+    topic_match = _TOPIC_RE.search(prompt)
+    topic = topic_match.group(1).strip() if topic_match else "chủ đề"
+    with _rng_lock:
+        questions = [_question(rng, kind, topic, level) for level in _levels(prompt, count)]
+    return json.dumps({"questions": questions}, ensure_ascii=False, indent=2), count
+
+
+def _corrupt(text, rng):
+    # Bỏ nháy mở của một giá trị "answer": object đó không còn là JSON hợp lệ
+    spots = [m.start() for m in re.finditer(r'"answer": "', text)]
+    if not spots:
+        return text
+    at = rng.choice(spots) + len('"answer": ')
+    return text[:at] + text[at + 1:]
+
+
+def _latency(count):
+    with _rng_lock:
+        if LATENCY == "fixed":
+            base = LATENCY_MS
+        elif LATENCY == "uniform":
+            base = _rng.uniform(LATENCY_MS * (1 - LATENCY_SIGMA), LATENCY_MS * (1 + LATENCY_SIGMA))
+        else:
+            base = _rng.lognormvariate(0, LATENCY_SIGMA) * LATENCY_MS
+    return max(0.0, base + count * MS_PER_QUESTION) / 1000
+
+
+def _plan(prompt, generation_config, default_config):
+    """Quyết định kết quả một lời gọi: (độ trễ giây, text | None, lỗi | None)."""
+    _count("calls")
+    with _rng_lock:
+        roll = _rng.random()
+    if roll < QUOTA_RATE:
+        _count("quota")
+        return _latency(0) / 4, None, ResourceExhausted(f"429 Resource has been exhausted. Please retry in {RETRY_AFTER}s.")
+    roll -= QUOTA_RATE
+    text, count = quiz_payload(prompt)
+    latency = _latency(count)
+    if roll < EMPTY_RATE:
+        _count("empty")
+        return latency, None, None
+    roll -= EMPTY_RATE
+
+    config = dict(default_config or {})
+    config.update(generation_config or {})
+    budget = config.get("max_output_tokens")
+    if roll < TRUNCATE_RATE or (budget and len(text) > budget * CHARS_PER_TOKEN):
+        _count("truncated")
+        with _rng_lock:
+            cut = _rng.randint(len(text) // 3, len(text) - 2)
+        text = text[:min(cut, budget * CHARS_PER_TOKEN) if budget else cut]
+    elif roll - TRUNCATE_RATE < MALFORMED_RATE:
+        _count("malformed")
+        with _rng_lock:
+            text = _corrupt(text, _rng)
+    return latency, text, None
+
+
+def _timeout(request_options):
+    return (request_options or {}).get("timeout")
+
+
+class GenerativeModel:
+    def __init__(self, model_name="gemini-2.0-flash", generation_config=None, **kwargs):
+        self.model_name = model_name
+        self._generation_config = dict(generation_config or {})
+
+    def _finish(self, text, error):
+        if error is not None:
+            raise error
+        return GenerateContentResponse(text)
+
+    def generate_content(self, contents, *, generation_config=None, request_options=None, **kwargs):
+        latency, text, error = _plan(contents, generation_config, self._generation_config)
+        timeout = _timeout(request_options)
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            _count("timeouts")
+            raise DeadlineExceeded("504 Deadline Exceeded")
+        time.sleep(latency)
+        return self._finish(text, error)
+
+    async def generate_content_async(self, contents, *, generation_config=None, request_options=None, **kwargs):
+        latency, text, error = _plan(contents, generation_config, self._generation_config)
+        timeout = _timeout(request_options)
+        if timeout is not None and latency > timeout:
+            await asyncio.sleep(timeout)
+            _count("timeouts")
+            raise DeadlineExceeded("504 Deadline Exceeded")
+        await asyncio.sleep(latency)
+        return self._finish(text, error)
+
+    def count_tokens(self, contents, **kwargs):
+        return CountTokensResponse(len(str(contents)) // CHARS_PER_TOKEN)
+
+    async def count_tokens_async(self, contents, **kwargs):
+        return self.count_tokens(contents)
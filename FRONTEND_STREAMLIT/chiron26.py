@@ -5,9 +5,20 @@ import threading
 import requests
 import json
 import time
+import uuid
 import streamlit.components.v1 as components
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn: không có thì dùng json chuẩn
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # MessagePack là tùy chọn: không có thì nhận JSON
+    msgpack = None
+
 # ================================
 # 🎨 CẤU HÌNH TRANG
 # ================================
@@ -120,10 +131,14 @@ with st.sidebar:
 # ================================
 # ⚙️ SESSION STATE
 # ================================
-defaults = {"quiz_data": None, "user_answers": {}, "start_time": None, "submitted": False, "end_time": None}
+defaults = {"quiz_data": None, "user_answers": {}, "start_time": None, "submitted": False, "end_time": None,
+            "result_saved": False}
 for k, v in defaults.items():
     if k not in st.session_state:
         st.session_state[k] = v
+# 🚦 Mã phiên gửi kèm BACKEND_API_KEY: backend tính rate limit cho từng học sinh thay vì cả frontend
+if "client_id" not in st.session_state:
+    st.session_state.client_id = uuid.uuid4().hex
 
 # ================================
 # 📘 ĐỌC CHỦ ĐỀ
@@ -144,6 +159,46 @@ subject = col1.selectbox("📘 Môn học", subjects)
 grades = list(topics_data[subject].keys())
 grade = col2.selectbox("🎓 Khối lớp", grades)
 topic = st.selectbox("📖 Chủ đề", topics_data[subject][grade])
+st.text_input("👤 Họ tên (để lưu kết quả)", key="student_name")
+
+# ================================
+# 🧾 ĐỊNH DẠNG DỮ LIỆU VỚI BACKEND (JSON / MessagePack)
+# ================================
+MSGPACK_MIMETYPE = "application/x-msgpack"
+# BACKEND_FORMAT=json để luôn nhận JSON; mặc định dùng MessagePack nếu đã cài (gọn và parse nhanh hơn)
+BACKEND_FORMAT = os.getenv("BACKEND_FORMAT", "msgpack" if msgpack is not None else "json").strip().lower()
+if BACKEND_FORMAT == "msgpack" and msgpack is not None:
+    ACCEPT_STREAM = f"{MSGPACK_MIMETYPE}, application/x-ndjson;q=0.9"
+    ACCEPT_BODY = f"{MSGPACK_MIMETYPE}, application/json;q=0.9"
+else:
+    ACCEPT_STREAM = "application/x-ndjson"
+    ACCEPT_BODY = "application/json"
+
+
+def loads_json(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def is_msgpack(res):
+    # Backend cũ bỏ qua Accept và luôn trả JSON: quyết định theo Content-Type thực tế
+    return msgpack is not None and res.headers.get("Content-Type", "").startswith(MSGPACK_MIMETYPE)
+
+
+def iter_events(res):
+    """Các sự kiện của stream: object MessagePack nối tiếp hoặc NDJSON (mỗi dòng một object)."""
+    if is_msgpack(res):
+        unpacker = msgpack.Unpacker(raw=False)
+        for chunk in res.iter_content(chunk_size=None):
+            unpacker.feed(chunk)
+            yield from unpacker
+        return
+    for line in res.iter_lines():
+        if line:
+            yield loads_json(line)
+
+
+def decode_body(res):
+    return msgpack.unpackb(res.content, raw=False) if is_msgpack(res) else loads_json(res.content)
 
 # ================================
 # 🧠 GỌI BACKEND & LƯU SESSION
@@ -153,6 +208,12 @@ if st.button("🚀 Tạo đề trắc nghiệm", type="primary"):
         try:
             backend_url = os.getenv("BACKEND_URL", "https://ai-chiron26.onrender.com/api/generate-quiz")
             payload = {"subject": subject, "grade": grade, "topic": topic, "num_mcq": 10, "num_tf": 4}
+            # ⏳ Báo timeout cho backend để backend trả các câu đã sinh được trước khi mình cắt kết nối
+            request_timeout = float(os.getenv("BACKEND_TIMEOUT", 60))
+            headers = {"X-Request-Timeout": str(request_timeout)}
+            backend_api_key = os.getenv("BACKEND_API_KEY")
+            if backend_api_key:
+                headers.update({"X-API-Key": backend_api_key, "X-Client-Id": st.session_state.client_id})
             try:
                 # 🧩 Kiểm tra backend có đang hoạt động không
                 ping = requests.get("https://ai-chiron26.onrender.com", timeout=5)
@@ -164,28 +225,64 @@ if st.button("🚀 Tạo đề trắc nghiệm", type="primary"):
                 st.stop()
 
             # ✅ Nếu backend sẵn sàng thì mới gửi yêu cầu tạo đề
+            # 📡 Nhận đề qua stream (NDJSON/MessagePack): hiển thị câu hỏi ngay khi backend sinh xong từng phần
+            data = None
+            preview = st.empty()
+            received = []
             try:
-                res = requests.post(backend_url, json=payload, timeout=60)
-                if res.status_code != 200:
-                    st.error(f"❌ Backend trả về lỗi ({res.status_code}): {res.text}")
-                    st.stop()
+                with requests.post(f"{backend_url.rstrip('/')}/stream", json=payload,
+                                   headers={**headers, "Accept": ACCEPT_STREAM},
+                                   timeout=request_timeout, stream=True) as res:
+                    if res.status_code == 404:
+                        # Backend cũ chưa có endpoint stream
+                        res = requests.post(backend_url, json=payload, headers={**headers, "Accept": ACCEPT_BODY},
+                                            timeout=request_timeout)
+                        if res.status_code != 200:
+                            st.error(f"❌ Backend trả về lỗi ({res.status_code}): {res.text}")
+                            st.stop()
+                        data = decode_body(res)
+                    elif res.status_code in (429, 503):
+                        # 🚦 Backend đang giới hạn tải: báo thời gian chờ thay vì lỗi chung chung
+                        st.warning(f"⏳ Backend đang bận, vui lòng thử lại sau {res.headers.get('Retry-After', 'vài')} giây.")
+                        st.stop()
+                    elif res.status_code != 200:
+                        st.error(f"❌ Backend trả về lỗi ({res.status_code}): {res.text}")
+                        st.stop()
+                    else:
+                        for event in iter_events(res):
+                            if event.get("event") == "questions":
+                                received.extend(event.get("questions", []))
+                                with preview.container():
+                                    st.caption(f"⏳ Đã nhận {len(received)} câu, đang sinh tiếp...")
+                                    for idx, q in enumerate(received):
+                                        st.markdown(f"**Câu {idx+1}:** {q.get('question','')}")
+                            elif event.get("event") == "done":
+                                data = {"questions": event.get("questions", []), "partial": event.get("partial", False)}
+                            elif event.get("event") == "error" and event.get("retry_after"):
+                                st.warning(f"⏳ Backend đang bận, vui lòng thử lại sau {event['retry_after']} giây.")
+                                st.stop()
+                            elif event.get("event") == "error":
+                                st.error(f"❌ Backend trả về lỗi: {event.get('error')}")
+                                st.stop()
             except requests.exceptions.RequestException as e:
                 st.error(f"⚠️ Không thể gửi yêu cầu tới backend: {e}")
                 st.stop()
+            preview.empty()
 
-            if res.status_code == 200:
-                data = res.json()
-                if "questions" in data:
-                    st.session_state.quiz_data = data
-                    st.session_state.user_answers = {}
-                    st.session_state.submitted = False
-                    st.session_state.start_time = time.time()
-                    st.query_params["submitted"] = "0"
-                    st.success(f"✅ Đã tạo {len(data['questions'])} câu hỏi!")
+            if data and "questions" in data:
+                st.session_state.quiz_data = data
+                st.session_state.quiz_meta = {"subject": subject, "grade": grade, "topic": topic}
+                st.session_state.user_answers = {}
+                st.session_state.submitted = False
+                st.session_state.result_saved = False
+                st.session_state.start_time = time.time()
+                st.query_params["submitted"] = "0"
+                if data.get("partial"):
+                    st.warning(f"⏳ Backend hết thời gian, chỉ tạo được {len(data['questions'])} câu hỏi.")
                 else:
-                    st.warning("⚠️ Không có câu hỏi hợp lệ từ backend.")
+                    st.success(f"✅ Đã tạo {len(data['questions'])} câu hỏi!")
             else:
-                st.error(f"❌ Lỗi backend ({res.status_code})")
+                st.warning("⚠️ Không có câu hỏi hợp lệ từ backend.")
 
         except Exception as e:
             st.error(f"❌ Lỗi kết nối backend: {e}")
@@ -343,17 +440,35 @@ if st.session_state.get("quiz_data") and "questions" in st.session_state["quiz_d
                 return "B"
             return s[0].upper()
 
+        graded = []  # từng câu đúng/sai -> backend thống kê câu khó
         for idx, q in enumerate(questions):
             user_choice = st.session_state.user_answers.get(idx, "")
             correct_raw = (q.get("answer") or "").strip()
             user_letter = option_letter(user_choice)
             correct_letter = correct_raw.strip().upper()
-            if user_letter and correct_letter and user_letter.startswith(correct_letter):
+            correct = bool(user_letter and correct_letter and user_letter.startswith(correct_letter))
+            if correct:
                 score += 1
+            graded.append({"question": q.get("question", ""), "answer": user_choice, "correct": correct})
 
         st.success(f"🎯 Kết quả: {score}/{total} câu đúng ({(score/total*100) if total>0 else 0:.1f}%)")
         st.balloons()
 
+        # 🗂️ Lưu kết quả lên backend một lần cho mỗi lượt nộp (lỗi mạng không ảnh hưởng việc xem đáp án)
+        if not st.session_state.get("result_saved") and total > 0:
+            st.session_state.result_saved = True
+            meta = st.session_state.get("quiz_meta") or {"subject": subject, "grade": grade, "topic": topic}
+            backend_url = os.getenv("BACKEND_URL", "https://ai-chiron26.onrender.com/api/generate-quiz")
+            result_url = backend_url.split("/api/")[0].rstrip("/") + "/api/submit-result"
+            try:
+                requests.post(result_url, timeout=5, json={
+                    "student_name": st.session_state.get("student_name", ""),
+                    "subject": meta["subject"], "grade": meta["grade"], "score": score, "total": total,
+                    "details": {"topic": meta["topic"], "questions": graded},
+                })
+            except requests.exceptions.RequestException:
+                pass
+
         st.markdown("### 🔍 Đáp án chi tiết:")
         for idx, q in enumerate(questions):
             st.markdown(f"**Câu {idx+1}:** {q.get('question','')}")
@@ -372,6 +487,7 @@ if st.session_state.get("quiz_data") and "questions" in st.session_state["quiz_d
         with col1:
             if st.button("🔄 Làm lại bài này"):
                 st.session_state.submitted = False
+                st.session_state.result_saved = False
                 st.session_state.user_answers = {}
                 st.session_state.start_time = time.time()
                 try:
@@ -382,7 +498,7 @@ if st.session_state.get("quiz_data") and "questions" in st.session_state["quiz_d
 
         with col2:
             if st.button("🆕 Làm bài khác"):
-                for key in ["quiz_data", "user_answers", "submitted", "start_time", "end_time"]:
+                for key in ["quiz_data", "user_answers", "submitted", "start_time", "end_time", "result_saved", "quiz_meta"]:
                     if key in st.session_state:
                         del st.session_state[key]
                 try: